@@ -0,0 +1,176 @@
+import collections
+import contextlib
+import contextvars
+import threading
+import time
+import storage
+
+# Statements kept per measurement, the later ones are only counted
+MAX_STATEMENTS = 100
+
+
+# The statements run and the time spent in the database and serialising
+# while a measurement is active
+class QueryStats:
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.statements = []  # (query, seconds)
+        self.by_query = {}  # query -> [count, seconds]
+        # statements of one measurement may run on several threads
+        self.lock = threading.Lock()
+
+    def add_query(self, query, seconds):
+        with self.lock:
+            self.queries += 1
+            self.db_seconds += seconds
+            if len(self.statements) < MAX_STATEMENTS:
+                self.statements.append((query, seconds))
+            totals = self.by_query.get(query)
+            if totals is None:
+                self.by_query[query] = [1, seconds]
+            else:
+                totals[0] += 1
+                totals[1] += seconds
+
+    def add_serialize(self, seconds):
+        with self.lock:
+            self.serialize_seconds += seconds
+
+    # The count queries that took the most time in total, as
+    # (query, times run, seconds) rows
+    def top_queries(self, count=10):
+        with self.lock:
+            rows = [(query, runs, seconds)
+                    for query, (runs, seconds) in self.by_query.items()]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows[:count]
+
+
+# The measurement of the current request or command, if any
+# Context variables follow asyncio tasks, and async_storage.run copies
+# them to the storage threads, so the statements of concurrent requests
+# are attributed to the right one
+CURRENT = contextvars.ContextVar("query_stats", default=None)
+
+
+# Storage query listener adding every statement to the current measurement
+def on_query(query, args, seconds):
+    stats = CURRENT.get()
+    if stats is not None:
+        stats.add_query(query, seconds)
+
+
+storage.add_query_listener(on_query)
+
+
+# Measure the statements run inside the with block
+# with accounting.measure() as stats: ...
+@contextlib.contextmanager
+def measure():
+    stats = QueryStats()
+    token = CURRENT.set(stats)
+    try:
+        yield stats
+    finally:
+        CURRENT.reset(token)
+
+
+# Add the time spent inside the with block to the serialisation time of
+# the current measurement
+@contextlib.contextmanager
+def serializing():
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = CURRENT.get()
+        if stats is not None:
+            stats.add_serialize(time.perf_counter() - start)
+
+
+# Totals of the measurements of one route
+class RouteStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.seconds = 0.0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, stats, seconds):
+        self.requests += 1
+        self.queries += stats.queries
+        self.seconds += seconds
+        self.db_seconds += stats.db_seconds
+        self.serialize_seconds += stats.serialize_seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "queries_per_request": self.queries / self.requests,
+            "mean_ms": self.seconds / self.requests * 1000,
+            "max_ms": self.max_seconds * 1000,
+            "db_ms_per_request": self.db_seconds / self.requests * 1000,
+            "serialize_ms_per_request": self.serialize_seconds / self.requests * 1000,
+        }
+
+
+# Default number of slow requests remembered
+SLOW_LOG_SIZE = 100
+
+# Default duration above which a request is slow, in seconds
+SLOW_THRESHOLD = 0.1
+
+
+# Per-route totals and a log of the most recent slow requests
+class RequestLog:
+
+    def __init__(self, slow_threshold=SLOW_THRESHOLD, slow_log_size=SLOW_LOG_SIZE):
+        self.slow_threshold = slow_threshold
+        self.routes = {}  # route -> RouteStats
+        self.slow = collections.deque(maxlen=slow_log_size)
+        self.lock = threading.Lock()
+
+    def add(self, method, route, path, status, stats, seconds):
+        with self.lock:
+            key = method + " " + route
+            if key not in self.routes:
+                self.routes[key] = RouteStats()
+            self.routes[key].add(stats, seconds)
+            if seconds >= self.slow_threshold:
+                self.slow.append({
+                    "time": time.time(),
+                    "method": method,
+                    "route": route,
+                    "path": path,
+                    "status": status,
+                    "ms": seconds * 1000,
+                    "queries": stats.queries,
+                    "db_ms": stats.db_seconds * 1000,
+                    "serialize_ms": stats.serialize_seconds * 1000,
+                    "statements": [{"query": query, "ms": seconds * 1000}
+                                   for query, seconds in stats.statements],
+                })
+
+    def route_stats(self):
+        with self.lock:
+            return {key: route.to_dict() for key, route in self.routes.items()}
+
+    # The slow requests, most recent first, at least threshold seconds long
+    def slow_requests(self, threshold=None):
+        threshold = self.slow_threshold if threshold is None else threshold
+        with self.lock:
+            return [entry for entry in reversed(self.slow)
+                    if entry["ms"] >= threshold * 1000]
+
+
+# Format a measurement as a Server-Timing header value
+def server_timing(stats, seconds):
+    return ('db;dur={:.3f};desc="{} queries", serialize;dur={:.3f}, total;dur={:.3f}'.format(
+        stats.db_seconds * 1000, stats.queries, stats.serialize_seconds * 1000, seconds * 1000))
@@ -1,82 +1,624 @@
+import asyncio
+import collections
+import csv
+import email.utils
+import fnmatch
 import fastapi
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import io
+import json
+import struct
+import threading
+import time
+import accounting
+import async_storage
+import cache
+import events
 import model
-from typing import Any
+import storage
+import views
+from pydantic import BaseModel
+from typing import Any, Optional, Union
+
+# JSON responses adding the time spent rendering them to the serialisation
+# time of the request
+class TimedJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        with accounting.serializing():
+            return super().render(content)
+
 
 # The FastAPI app
-app = fastapi.FastAPI()
+app = fastapi.FastAPI(default_response_class=TimedJSONResponse)
 
 
 @app.on_event("startup")
 async def startup_event():
     model.startup()
+    model.connect_events()
+    async_storage.startup()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    async_storage.shutdown()
     model.shutdown()
 
 
-# Extract the given attributes from the given objects
-# and return a list of dictionaries
-def extract(objects: list[Any], attrs: list[str]) -> list[dict[str, Any]]:
-    return [{attr: getattr(object, attr) for attr in attrs} for object in objects]
+# Per-route totals and the recent slow requests
+REQUEST_LOG = accounting.RequestLog()
+
+
+# Count the statements and the database and serialisation time of every
+# request, reported in the Server-Timing header
+# Streamed bodies are still being produced when the header is sent, so
+# they are only fully accounted in the per-route totals and the slow log
+@app.middleware("http")
+async def account_queries(request: fastapi.Request, call_next):
+    start = time.perf_counter()
+    with accounting.measure() as stats:
+        response = await call_next(request)
+    response.headers["Server-Timing"] = accounting.server_timing(
+        stats, time.perf_counter() - start)
+    # live streams last as long as the client stays connected
+    if response.headers.get("content-type", "").startswith("text/event-stream"):
+        return response
+    body = response.body_iterator
+
+    async def account_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            route = request.scope.get("route")
+            path = request.url.path
+            if request.url.query:
+                path += "?" + request.url.query
+            REQUEST_LOG.add(request.method, getattr(route, "path", "<unmatched>"), path,
+                            response.status_code, stats, time.perf_counter() - start)
+    response.body_iterator = account_body()
+    return response
+
+
+# Run a storage call on the storage thread pool
+# Responds with 504 if it does not finish within the timeout
+async def query(func, *args, timeout=async_storage.TIMEOUT, **kwargs):
+    try:
+        return await async_storage.run(func, *args, timeout=timeout, **kwargs)
+    except asyncio.TimeoutError:
+        raise fastapi.HTTPException(
+            status_code=504, detail="Database query timed out")
+
+
+# Raised by the conditional GET dependencies when the client already has
+# the current version of the response
+class NotModified(Exception):
+    def __init__(self, headers: dict[str, str]):
+        self.headers = headers
+
+
+@app.exception_handler(NotModified)
+async def not_modified_handler(request: fastapi.Request, exc: NotModified):
+    return Response(status_code=304, headers=exc.headers)
+
+
+# Set the ETag and Last-Modified headers from a storage write generation,
+# raising NotModified if If-None-Match names the same version
+# The generations are bumped by the writes received from the host, so
+# they are only trusted while connected to it
+def check_generation(request: fastapi.Request, response: fastapi.Response, generation: tuple):
+    if not events.CONNECTED.is_set():
+        return
+    epoch, number, modified = generation
+    headers = {
+        "ETag": 'W/"' + str(epoch) + "-" + str(number) + '"',
+        "Last-Modified": email.utils.formatdate(modified, usegmt=True),
+    }
+    tags = request.headers.get("if-none-match", "").split(",")
+    if headers["ETag"] in [tag.strip() for tag in tags]:
+        raise NotModified(headers)
+    response.headers.update(headers)
+
+
+# Dependency making an endpoint conditional on the writes to one entity type
+def conditional(type: str):
+    def dependency(request: fastapi.Request, response: fastapi.Response):
+        check_generation(request, response, storage.get_generation(type))
+    return dependency
+
+
+# Dependency making an endpoint conditional on the writes to one device
+# and its metrics
+def device_conditional(device_id: int, request: fastapi.Request, response: fastapi.Response):
+    check_generation(request, response,
+                     storage.get_device_generation(device_id))
+
+
+# The response fields of each row returned by the storage list queries
+GROUP_FIELDS = ["id", "name"]
+NODE_FIELDS = ["id", "name", "status", "birth_timestamp", "death_timestamp"]
+DEVICE_FIELDS = ["id", "name", "status", "birth_timestamp", "death_timestamp"]
+METRIC_FIELDS = ["id", "name", "type", "value", "timestamp"]
+
+
+# Map the rows of a storage query to a list of dictionaries
+def to_dicts(fields: list[str], rows: list[tuple]) -> list[dict[str, Any]]:
+    return [dict(zip(fields, row)) for row in rows]
+
+
+# Same as to_dicts, but responds with 404 if there are no rows
+def to_dicts_or_404(fields: list[str], rows: list[tuple], name: str) -> list[dict[str, Any]]:
+    if len(rows) == 0:
+        raise fastapi.HTTPException(status_code=404, detail=name + " not found")
+    return to_dicts(fields, rows)
+
+
+# Largest page size accepted by the collection endpoints
+MAX_PAGE_SIZE = 10000
+
+
+# Keyset pagination parameters of the collection endpoints
+# ?after_id=<id of the last row of the previous page>&limit=<page size>
+# Without a limit, the whole collection is returned
+class Page:
+
+    def __init__(self, request: fastapi.Request, response: fastapi.Response,
+                 after_id: Optional[int] = None,
+                 limit: Optional[int] = fastapi.Query(None, ge=1, le=MAX_PAGE_SIZE)):
+        self.request = request
+        self.response = response
+        self.after_id = after_id
+        self.limit = limit
+
+    # Map the rows to dictionaries, linking the next page if this one is full
+    def respond(self, fields: list[str], rows: list[tuple]) -> list[dict[str, Any]]:
+        if self.limit is not None and len(rows) == self.limit:
+            url = self.request.url.include_query_params(
+                after_id=rows[-1][0], limit=self.limit)
+            self.response.headers["Link"] = "<" + str(url) + '>; rel="next"'
+        return to_dicts(fields, rows)
+
+
+# Cache of the serialised group/node membership responses, invalidated by
+# topology writes
+TOPOLOGY_CACHE = cache.topology_cache()
+
+
+# Serve a list endpoint from the topology cache, calling fetch for the
+# rows on a miss
+# Writes are only seen while connected to the host, so the cache is
+# bypassed otherwise
+async def cached_list(page: Page, fields: list[str], fetch) -> Response:
+    use_cache = events.CONNECTED.is_set()
+    key = (storage.GENERATION_EPOCH, str(page.request.url))
+    entry = TOPOLOGY_CACHE.get(key) if use_cache else None
+    if entry is None:
+        version = TOPOLOGY_CACHE.version()
+        rows = page.respond(fields, await fetch())
+        headers = {}
+        if "link" in page.response.headers:
+            headers["Link"] = page.response.headers["link"]
+        with accounting.serializing():
+            entry = (json.dumps(rows).encode(), headers)
+        if use_cache:
+            TOPOLOGY_CACHE.put(key, *entry, version)
+    body, headers = entry
+    response = Response(body, media_type="application/json")
+    # keep the headers set by the dependencies, e.g. ETag
+    for name, value in page.response.headers.items():
+        if name != "content-length":
+            response.headers[name] = value
+    response.headers.update(headers)
+    return response
 
 
 # get the list of groups
-@app.get("/groups")
-async def get_groups() -> list[dict]:
-    return extract(model.get_groups(), ["id", "name"])
+@app.get("/groups", dependencies=[fastapi.Depends(conditional("group"))])
+async def get_groups(page: Page = fastapi.Depends()) -> list[dict]:
+    return page.respond(GROUP_FIELDS, await query(storage.list_groups, after_id=page.after_id, limit=page.limit))
 
 
 # get the list of edge nodes
-@app.get("/nodes")
-async def get_edge_nodes() -> list[dict]:
-    return extract(model.get_nodes(), ["id", "name", "status", "birth_timestamp", "death_timestamp"])
+@app.get("/nodes", dependencies=[fastapi.Depends(conditional("node"))])
+async def get_edge_nodes(page: Page = fastapi.Depends()) -> list[dict]:
+    return page.respond(NODE_FIELDS, await query(storage.list_nodes, after_id=page.after_id, limit=page.limit))
 
 
 # get the list of devices
-@app.get("/devices")
-async def get_devices() -> list[dict]:
-    return extract(model.get_devices(), ["id", "name", "status", "birth_timestamp", "death_timestamp"])
+@app.get("/devices", dependencies=[fastapi.Depends(conditional("device"))])
+async def get_devices(page: Page = fastapi.Depends()) -> list[dict]:
+    return page.respond(DEVICE_FIELDS, await query(storage.list_devices, after_id=page.after_id, limit=page.limit))
 
 
 # get group details by id
-@app.get("/groups/{group_id}")
+@app.get("/groups/{group_id}", dependencies=[fastapi.Depends(conditional("group"))])
 async def get_group_by_id(group_id: int) -> list[dict]:
-    return extract([model.Group(group_id)], ["id", "name"])
+    return to_dicts_or_404(GROUP_FIELDS, await query(storage.list_groups, group_id), "Group")
 
 
 # get edge node details by id
-@app.get("/nodes/{node_id}")
+@app.get("/nodes/{node_id}", dependencies=[fastapi.Depends(conditional("node"))])
 async def get_edge_node_by_id(node_id: int) -> list[dict]:
-    return extract([model.Node(node_id)], ["id", "name", "status", "birth_timestamp", "death_timestamp"])
+    return to_dicts_or_404(NODE_FIELDS, await query(storage.list_nodes, edge_node_id=node_id), "Node")
 
 
 # get device details by id
-@app.get("/devices/{device_id}")
+@app.get("/devices/{device_id}", dependencies=[fastapi.Depends(conditional("device"))])
 async def get_device_by_id(device_id: int) -> list[dict]:
-    return extract([model.Device(device_id)], ["id", "name", "status", "birth_timestamp", "death_timestamp"])
+    return to_dicts_or_404(DEVICE_FIELDS, await query(storage.list_devices, device_id=device_id), "Device")
 
 
 # get all devices for a given group
-@app.get("/groups/{group_id}/devices")
-async def get_devices_by_group(group_id: int) -> list[dict]:
-    return extract(model.Group(group_id).devices, ["id", "name", "status", "birth_timestamp", "death_timestamp"])
+@app.get("/groups/{group_id}/devices", dependencies=[fastapi.Depends(conditional("device"))])
+async def get_devices_by_group(group_id: int, page: Page = fastapi.Depends()):
+    return await cached_list(page, DEVICE_FIELDS, lambda: query(
+        storage.list_devices, group_id=group_id, after_id=page.after_id, limit=page.limit))
 
 
 # get all devices for a given edge node
-@app.get("/nodes/{node_id}/devices")
-async def get_devices_by_edge_node(node_id: int) -> list[dict]:
-    return extract(model.Node(node_id).devices, ["id", "name", "status", "birth_timestamp", "death_timestamp"])
+@app.get("/nodes/{node_id}/devices", dependencies=[fastapi.Depends(conditional("device"))])
+async def get_devices_by_edge_node(node_id: int, page: Page = fastapi.Depends()):
+    return await cached_list(page, DEVICE_FIELDS, lambda: query(
+        storage.list_devices, edge_node_id=node_id, after_id=page.after_id, limit=page.limit))
 
 
 # get all nodes for a given group
-@app.get("/groups/{group_id}/nodes")
-async def get_edge_nodes_by_group(group_id: int) -> list[dict]:
-    return extract(model.Group(group_id).nodes, ["id", "name", "status", "birth_timestamp", "death_timestamp"])
+@app.get("/groups/{group_id}/nodes", dependencies=[fastapi.Depends(conditional("node"))])
+async def get_edge_nodes_by_group(group_id: int, page: Page = fastapi.Depends()):
+    return await cached_list(page, NODE_FIELDS, lambda: query(
+        storage.list_nodes, group_id=group_id, after_id=page.after_id, limit=page.limit))
+
+
+# get all metrics for a given device, with their latest values
+@app.get("/devices/{device_id}/metrics", dependencies=[fastapi.Depends(device_conditional)])
+async def get_metrics_by_device(device_id: int, page: Page = fastapi.Depends()):
+    return page.respond(METRIC_FIELDS, await query(storage.list_metrics, device_id, after_id=page.after_id, limit=page.limit))
+
+
+# get the hit/miss/eviction counters of the topology response cache
+@app.get("/cache/stats")
+async def get_cache_stats() -> dict:
+    return TOPOLOGY_CACHE.stats()
+
+
+# get the request count, statements and time per route
+@app.get("/debug/routes")
+async def get_route_stats() -> dict:
+    return REQUEST_LOG.route_stats()
+
+
+# get the most recent slow requests with the statements they ran, e.g.
+# /debug/slow?threshold_ms=500
+# Only requests above accounting.SLOW_THRESHOLD are recorded, so a lower
+# threshold_ms does not return more of them
+@app.get("/debug/slow")
+async def get_slow_requests(threshold_ms: Optional[float] = None) -> list[dict]:
+    return REQUEST_LOG.slow_requests(None if threshold_ms is None else threshold_ms / 1000)
+
+
+# list the predefined views
+@app.get("/views")
+async def get_views() -> dict:
+    return {name: {"description": view.description, "columns": view.columns,
+                   "arguments": {argument: default for argument, _, default in view.arguments}}
+            for name, view in views.VIEWS.items()}
+
+
+# read a predefined view, e.g.
+# /views/offline
+# /views/stale?seconds=600
+# /views/top?metric=temperature&count=5
+@app.get("/views/{name}")
+async def get_view(name: str, request: fastapi.Request) -> list[dict]:
+    view = views.VIEWS.get(name)
+    if view is None:
+        raise fastapi.HTTPException(status_code=404, detail="View not found")
+    args = [request.query_params.get(argument, default)
+            for argument, _, default in view.arguments]
+    try:
+        rows = await query(view.read, *args)
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e))
+    return to_dicts(view.columns, rows)
+
+
+# aggregate a metric across the fleet, e.g.
+# /aggregate/temperature?func=avg&by=group&window=3600
+# /aggregate/power?func=count&value=true
+@app.get("/aggregate/{metric_name}")
+async def aggregate_metric(metric_name: str, func: str = "avg", by: str = "group",
+                           window: Optional[int] = None, value: Optional[str] = None) -> dict:
+    if value is not None:
+        # true/false/numbers are compared as such, anything else as a string
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+    try:
+        return await query(model.aggregate, metric_name, func, by, window, value)
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e))
+
+
+# Rows fetched per page when streaming a metric history, kept small so
+# that the first rows go out immediately
+STREAM_CHUNK_SIZE = 1000
+
+# Media types of the metric history formats
+HISTORY_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+# Format one page of (value, timestamp, rowid) rows
+def format_values(rows: list[tuple], format: str) -> str:
+    if format == "csv":
+        out = io.StringIO()
+        csv.writer(out).writerows((row[1], row[0]) for row in rows)
+        return out.getvalue()
+    return "".join(json.dumps({"timestamp": row[1], "value": row[0]}) + "\n" for row in rows)
+
+
+# Stream the history of a metric page by page
+async def stream_values(metric_id: int, start: Optional[int], end: Optional[int], format: str):
+    if format == "csv":
+        yield "timestamp,value\r\n"
+    after = None
+    while True:
+        rows = await async_storage.run(storage.get_values_page, metric_id, start, end, after, STREAM_CHUNK_SIZE)
+        if rows:
+            with accounting.serializing():
+                chunk = format_values(rows, format)
+            yield chunk
+        if len(rows) < STREAM_CHUNK_SIZE:
+            return
+        after = (rows[-1][1], rows[-1][2])
+
+
+# stream the history of a metric as NDJSON or CSV, e.g.
+# /metrics/12/values?start=1700000000&end=1700003600&format=csv
+@app.get("/metrics/{metric_id}/values")
+async def get_metric_values(metric_id: int, start: Optional[int] = None, end: Optional[int] = None,
+                            format: str = "ndjson"):
+    if format not in HISTORY_FORMATS:
+        raise fastapi.HTTPException(
+            status_code=400, detail="Invalid format: " + format)
+    try:
+        await query(storage.get_value_table, metric_id)
+    except IndexError:
+        raise fastapi.HTTPException(status_code=404, detail="Metric not found")
+    return StreamingResponse(
+        stream_values(metric_id, start, end, format), media_type=HISTORY_FORMATS[format])
+
+
+# Largest number of points a series can be downsampled to
+MAX_SERIES_POINTS = 10000
+
+
+# get the downsampled history of a metric for charts, e.g.
+# /metrics/12/series?start=1700000000&end=1700086400&points=500&method=lttb
+# format=json returns {"timestamps": [...], "values": [...]}
+# format=binary returns packed little-endian (int64 timestamp, float64 value)
+# records, loadable without parsing (e.g. numpy.frombuffer with "<i8,<f8")
+@app.get("/metrics/{metric_id}/series")
+async def get_metric_series(metric_id: int, start: Optional[int] = None, end: Optional[int] = None,
+                            points: int = fastapi.Query(
+                                model.SERIES_POINTS, ge=2, le=MAX_SERIES_POINTS),
+                            method: str = "bucket", format: str = "json"):
+    if format not in ("json", "binary"):
+        raise fastapi.HTTPException(
+            status_code=400, detail="Invalid format: " + format)
+    try:
+        series = await query(model.get_series, metric_id, start, end, points, method)
+    except IndexError:
+        raise fastapi.HTTPException(status_code=404, detail="Metric not found")
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e))
+    if format == "binary":
+        with accounting.serializing():
+            body = struct.pack("<" + "qd" * len(series),
+                               *(field for row in series for field in row))
+        return Response(body, media_type="application/octet-stream")
+    return {"timestamps": [row[0] for row in series], "values": [row[1] for row in series]}
+
+
+# Seconds between heartbeats on idle live streams
+HEARTBEAT_INTERVAL = 15
+
+# Distinct metrics buffered per live stream client before the oldest
+# pending update is dropped
+STREAM_BUFFER_SIZE = 1000
+
+
+# The pending metric updates of one live stream client
+# Updates are pushed from the write path and coalesced per metric, so a
+# slow client only receives the latest value of each metric
+class Watcher:
+
+    def __init__(self, target, maxsize=STREAM_BUFFER_SIZE):
+        self.loop = asyncio.get_running_loop()
+        self.maxsize = maxsize
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.ready = asyncio.Event()
+        self.wakeup_scheduled = False
+        self.dropped = 0
+        self.subscription = events.subscribe(target, self.put, inline=True)
+
+    # Called on the write path, must not block
+    def put(self, metric_id, value, timestamp):
+        with self.lock:
+            self.pending.pop(metric_id, None)
+            self.pending[metric_id] = (value, timestamp)
+            if len(self.pending) > self.maxsize:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            if self.wakeup_scheduled:
+                return
+            self.wakeup_scheduled = True
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    # Wait for updates, returns an empty list if there were none within timeout
+    async def get(self, timeout: float) -> list[dict[str, Any]]:
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        with self.lock:
+            self.ready.clear()
+            self.wakeup_scheduled = False
+            pending = list(self.pending.items())
+            self.pending.clear()
+        paths = {metric_id: events.METRIC_PATHS.get(metric_id)
+                 for metric_id, _ in pending}
+        # the paths not cached yet, e.g. after a rename, are queried off
+        # the event loop
+        missing = [metric_id for metric_id, path in paths.items() if path is None]
+        if missing:
+            paths.update(zip(missing, await query(events.get_metric_paths, missing)))
+        return [{"id": metric_id, "path": paths[metric_id][2],
+                 "value": value, "timestamp": timestamp}
+                for metric_id, (value, timestamp) in pending]
+
+    def close(self):
+        self.subscription.close()
+
+
+# Resolve the subscription target of the live stream endpoints
+async def stream_target(device_id: Optional[int], path: Optional[str]):
+    if device_id is not None:
+        if not await query(storage.list_devices, device_id=device_id):
+            raise fastapi.HTTPException(
+                status_code=404, detail="Device not found")
+        return ("device", device_id)
+    if not path:
+        raise fastapi.HTTPException(
+            status_code=400, detail="No path provided")
+    return path
+
+
+# Send the updates of the metrics of a target as server-sent events
+# The watcher is only created once the response is streamed, so that it
+# cannot leak if the client disconnects before
+async def stream_events(target):
+    watcher = Watcher(target)
+    try:
+        yield ": connected\n\n"
+        while True:
+            updates = await watcher.get(HEARTBEAT_INTERVAL)
+            if not updates:
+                yield ": heartbeat\n\n"
+                continue
+            yield "".join("data: " + json.dumps(update) + "\n\n" for update in updates)
+    finally:
+        watcher.close()
+
+
+# Send the updates of the metrics of a target over a websocket, one
+# message per batch
+async def stream_websocket(websocket: fastapi.WebSocket, target):
+    watcher = Watcher(target)
+    try:
+        while True:
+            updates = await watcher.get(HEARTBEAT_INTERVAL)
+            if updates:
+                await websocket.send_json({"updates": updates})
+            else:
+                await websocket.send_json({"heartbeat": int(time.time())})
+    except fastapi.WebSocketDisconnect:
+        pass
+    finally:
+        watcher.close()
+
+
+# stream the metric updates of a device as server-sent events
+@app.get("/stream/devices/{device_id}")
+async def stream_device(device_id: int):
+    target = await stream_target(device_id, None)
+    return StreamingResponse(stream_events(target), media_type="text/event-stream")
+
+
+# stream the updates of the metrics matching a glob as server-sent events,
+# e.g. /stream?path=group1/node0/* or /stream?path=*/temperature
+@app.get("/stream")
+async def stream_path(path: str):
+    target = await stream_target(None, path)
+    return StreamingResponse(stream_events(target), media_type="text/event-stream")
+
+
+# same as the above, over a websocket
+@app.websocket("/stream/devices/{device_id}")
+async def stream_device_websocket(websocket: fastapi.WebSocket, device_id: int):
+    await websocket.accept()
+    try:
+        target = await stream_target(device_id, None)
+    except fastapi.HTTPException as e:
+        await websocket.close(code=1008, reason=e.detail)
+        return
+    await stream_websocket(websocket, target)
+
+
+@app.websocket("/stream")
+async def stream_path_websocket(websocket: fastapi.WebSocket, path: str = ""):
+    await websocket.accept()
+    try:
+        target = await stream_target(None, path)
+    except fastapi.HTTPException as e:
+        await websocket.close(code=1008, reason=e.detail)
+        return
+    await stream_websocket(websocket, target)
+
+
+# Largest number of items accepted by /query/latest
+MAX_QUERY_ITEMS = 1000
+
+# Largest number of metrics returned by /query/latest
+MAX_QUERY_RESULTS = 10000
+
+
+# The body of /query/latest
+# metrics -> metric ids and/or group/node/device/metric paths, where each
+# part of a path may be a glob, e.g. "kitchen/*/thermostat*/temperature"
+class LatestQuery(BaseModel):
+    metrics: list[Union[int, str]]
+
+
+# get the latest value and timestamp of many metrics at once
+# Items that are invalid or match nothing are reported in "errors",
+# the other items are still answered
+# "truncated" is true if more than MAX_QUERY_RESULTS metrics matched
+@app.post("/query/latest")
+async def query_latest(body: LatestQuery) -> dict:
+    if len(body.metrics) > MAX_QUERY_ITEMS:
+        raise fastapi.HTTPException(
+            status_code=413, detail="At most " + str(MAX_QUERY_ITEMS) + " items can be queried at once")
+    errors = []
+    metric_ids, patterns = [], []
+    for item in body.metrics:
+        if isinstance(item, int):
+            metric_ids.append(item)
+            continue
+        parts = item.split("/")
+        if len(parts) != 4 or not all(parts):
+            errors.append(
+                {"item": item, "error": "Expected group/node/device/metric"})
+            continue
+        patterns.append(tuple(parts))
+    rows = await query(storage.latest_values, metric_ids, patterns, MAX_QUERY_RESULTS + 1)
+    truncated = len(rows) > MAX_QUERY_RESULTS
+    rows = rows[:MAX_QUERY_RESULTS]
 
+    # report the items that matched nothing, which cannot be told apart
+    # from the items that only matched the rows past the cut
+    if not truncated:
+        found_ids = {row[0] for row in rows}
+        for metric_id in metric_ids:
+            if metric_id not in found_ids:
+                errors.append({"item": metric_id, "error": "No such metric"})
+        for pattern in patterns:
+            if not any(all(fnmatch.fnmatchcase(name, part) for name, part in zip(row[1:5], pattern))
+                       for row in rows):
+                errors.append(
+                    {"item": "/".join(pattern), "error": "No matching metric"})
 
-# get all metrics for a given device
-@app.get("/devices/{device_id}/metrics")
-async def get_metrics_by_device(device_id: int):
-    return extract(model.Device(device_id).metrics, ["id", "name", "type", "value", "timestamp"])
+    results = [{"id": row[0], "path": "/".join(row[1:5]), "type": row[5],
+                "value": row[6], "timestamp": row[7]} for row in rows]
+    return {"results": results, "errors": errors, "truncated": truncated}
@@ -0,0 +1,72 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import threading
+import storage
+
+# Number of threads, each with its own read connection, serving storage calls
+POOL_SIZE = 8
+
+# Seconds a storage call may take before it is cancelled
+TIMEOUT = 10
+
+EXECUTOR: concurrent.futures.ThreadPoolExecutor = None
+
+
+# One storage call running on the pool
+# Cancelling it interrupts the query running on its read connection
+class Call:
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.connection = None
+        self.cancelled = False
+
+    def run(self):
+        with self.lock:
+            if self.cancelled:
+                raise asyncio.CancelledError()
+            self.connection = storage.reader()
+        try:
+            return self.func(*self.args, **self.kwargs)
+        finally:
+            with self.lock:
+                self.connection = None
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.connection is not None:
+                self.connection.interrupt()
+
+
+# Start the thread pool, each thread opens its own read connection
+def startup(pool_size=POOL_SIZE):
+    global EXECUTOR
+    EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+        pool_size, thread_name_prefix="storage", initializer=storage.open_reader)
+
+
+def shutdown():
+    EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
+
+# Run a storage call on the thread pool without blocking the event loop
+# Raises asyncio.TimeoutError if it takes longer than timeout seconds,
+# in which case, as when the awaiting task is cancelled, the running
+# query is interrupted
+async def run(func, *args, timeout=TIMEOUT, **kwargs):
+    call = Call(func, args, kwargs)
+    # run in a copy of the caller's context, so that the statements are
+    # accounted to the request that made the call
+    context = contextvars.copy_context()
+    future = asyncio.get_running_loop().run_in_executor(
+        EXECUTOR, context.run, call.run)
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        call.cancel()
+        raise
@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import string
+import time
+import tracemalloc
+import model
+import storage
+
+
+# Measure the memory and attribute access cost of the model objects
+# Cached attributes are pre-filled, so no database is needed
+def bench_objects(count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    objects = [model.Metric(i) for i in range(count)]
+    build_time = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    for obj in objects:
+        obj.cached = {"name": "temperature"}
+    start = time.perf_counter()
+    for obj in objects:
+        obj.name
+        obj.id
+    access_time = time.perf_counter() - start
+
+    return {
+        "objects": count,
+        "build_seconds": build_time,
+        "bytes_per_object": memory / count,
+        "access_ns": access_time / (2 * count) * 1e9,
+    }
+
+
+# Generate a random value of a metric type, as stored in the database
+def random_value(rng, value_type):
+    if value_type == "string":
+        return "".join(rng.choices(string.ascii_letters, k=10))
+    elif value_type == "int":
+        return rng.randint(0, 100)
+    elif value_type == "float":
+        return rng.uniform(0.0, 100.0)
+    else:
+        return rng.randint(0, 1)
+
+
+# Generate a database with a synthetic fleet, shaped like the one the
+# simulator creates from config.json
+# groups x nodes per group x devices per node, each metric having
+# history values spaced interval seconds apart and ending now
+def generate(path, groups, nodes, devices, history, interval=5, seed=0):
+    with open("config.json", "rb") as f:
+        config = json.load(f)
+    rng = random.Random(seed)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    storage.startup(path)
+    c = storage.CONNECTION.cursor()
+    zones = config["zones"]
+    device_types = config["client_device_types"]
+    metric_types = config["client_metric_types"]
+    now = int(time.time())
+    timestamps = [now - (history - 1 - i) * interval for i in range(history)]
+
+    metrics = []  # (metric_id, metric_type)
+    for g in range(groups):
+        group_name = zones[g % len(zones)] + \
+            ("" if g < len(zones) else str(g // len(zones)))
+        c.execute("INSERT INTO Groups (group_name) VALUES (?)", (group_name,))
+        group_id = c.lastrowid
+        for n in range(nodes):
+            c.execute("INSERT INTO EdgeNode (group_id, edge_node_name, edge_node_status, edge_node_birth_timestamp, edge_node_death_timestamp) VALUES (?, ?, 'ONLINE', ?, 0)",
+                      (group_id, "node" + str(n), timestamps[0]))
+            node_id = c.lastrowid
+            for d in range(devices):
+                device_type = rng.choice(list(device_types.keys()))
+                c.execute("INSERT INTO Device (edge_node_id, device_name, device_status, device_birth_timestamp, device_death_timestamp) VALUES (?, ?, 'ONLINE', ?, 0)",
+                          (node_id, device_type + str(d), timestamps[0]))
+                device_id = c.lastrowid
+                for metric_name in device_types[device_type]["metrics"]:
+                    c.execute("INSERT INTO Metric (device_id, metric_name, metric_type) VALUES (?, ?, ?)",
+                              (device_id, metric_name, metric_types[metric_name]))
+                    metrics.append((c.lastrowid, metric_types[metric_name]))
+
+    for metric_id, metric_type in metrics:
+        c.executemany("INSERT INTO Metric{} (metric_id, metric_value, metric_timestamp) VALUES (?, ?, ?)".format(metric_type.capitalize()),
+                      ((metric_id, random_value(rng, metric_type), timestamp) for timestamp in timestamps))
+    for table_name in storage.VALUE_TABLES:
+        c.execute("INSERT OR REPLACE INTO MetricLatest (metric_id, metric_value, metric_timestamp) " +
+                  "SELECT metric_id, metric_value, MAX(metric_timestamp) FROM {} GROUP BY metric_id".format(table_name))
+    storage.CONNECTION.commit()
+    return {"groups": groups, "nodes": groups * nodes, "devices": groups * nodes * devices,
+            "metrics": len(metrics), "values": len(metrics) * history}
+
+
+# The endpoints driven by the API benchmark
+# {group_id}, {node_id}, {device_id} and {metric_id} are replaced by
+# random ids of the benchmark database
+ENDPOINTS = {
+    "groups": "/groups",
+    "nodes": "/nodes",
+    "devices": "/devices",
+    "devices_page": "/devices?limit=50",
+    "group": "/groups/{group_id}",
+    "node": "/nodes/{node_id}",
+    "device": "/devices/{device_id}",
+    "group_nodes": "/groups/{group_id}/nodes",
+    "group_devices": "/groups/{group_id}/devices",
+    "node_devices": "/nodes/{node_id}/devices",
+    "device_metrics": "/devices/{device_id}/metrics",
+    "metric_values": "/metrics/{metric_id}/values",
+    "metric_series": "/metrics/{metric_id}/series?points=200",
+    "aggregate": "/aggregate/temperature?func=avg&by=group",
+    "query_latest": "/query/latest",
+    "view_counts": "/views/counts",
+    "view_top": "/views/top?metric=temperature&count=10",
+}
+
+# Number of metric ids in the body of a query_latest request
+QUERY_LATEST_IDS = 100
+
+# The endpoints driven with POST, as the function building a random JSON
+# body from the rng and the ids of the benchmark database
+BODIES = {
+    "query_latest": lambda rng, ids: {
+        "metrics": rng.sample(ids["metric_id"], min(QUERY_LATEST_IDS, len(ids["metric_id"]))) +
+        ["*/node0/*/temperature"]},
+}
+
+
+# Parse a mix like "devices=5,device_metrics=10" into endpoint weights
+# Endpoints that are not named get no requests, an empty mix drives all
+# of them equally
+def parse_mix(mix):
+    if not mix:
+        return {name: 1 for name in ENDPOINTS}
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ENDPOINTS:
+            raise ValueError("Unknown endpoint: " + name)
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+# Drive the API in-process through an ASGI client
+# requests -> total number of requests
+# concurrency -> number of requests in flight
+# Returns the throughput and latency percentiles per endpoint
+async def bench_api(requests, concurrency, mix, seed=0):
+    import httpx
+    import api
+    import async_storage
+    import events
+
+    # started like api.startup_event, but without connecting to the events
+    # of a host that may be running against another database
+    model.startup()
+    async_storage.startup()
+    # nothing writes to the benchmark database, so no write can be missed
+    # and the conditional GETs and the response cache can be trusted
+    events.CONNECTED.set()
+
+    ids = {
+        "group_id": storage.get_all_groups(),
+        "node_id": storage.get_all_nodes(),
+        "device_id": storage.get_all_devices(),
+        "metric_id": [row[0] for row in storage.execute_query("SELECT metric_id FROM Metric WHERE metric_type != 'string'")],
+    }
+    rng = random.Random(seed)
+    names = list(mix.keys())
+    weights = list(mix.values())
+    plan = []
+    for name in rng.choices(names, weights, k=requests):
+        url = ENDPOINTS[name]
+        for key, values in ids.items():
+            if "{" + key + "}" in url:
+                url = url.replace("{" + key + "}", str(rng.choice(values)))
+        body = BODIES[name](rng, ids) if name in BODIES else None
+        plan.append((name, url, body))
+
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    queue = iter(plan)
+
+    async def worker(client):
+        for name, url, body in queue:
+            start = time.perf_counter()
+            if body is None:
+                response = await client.get(url)
+            else:
+                response = await client.post(url, json=body)
+            latencies[name].append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                errors[name] += 1
+
+    transport = httpx.ASGITransport(app=api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    await api.shutdown_event()
+
+    result = {}
+    for name in names:
+        values = sorted(latencies[name])
+        if not values:
+            continue
+        result[name] = {
+            "requests": len(values),
+            "errors": errors[name],
+            "throughput": len(values) / elapsed,
+            "p50_ms": percentile(values, 0.50),
+            "p95_ms": percentile(values, 0.95),
+            "p99_ms": percentile(values, 0.99),
+        }
+    return {"requests": requests, "concurrency": concurrency, "seconds": elapsed,
+            "throughput": requests / elapsed, "endpoints": result}
+
+
+# Print the result of the API benchmark, with the change against a
+# previous baseline if given
+def print_api_result(result, baseline=None):
+    print("{:<16} {:>8} {:>7} {:>10} {:>9} {:>9} {:>9}".format(
+        "endpoint", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for name, stats in result["endpoints"].items():
+        line = "{:<16} {requests:>8} {errors:>7} {throughput:>10.1f} {p50_ms:>9.2f} {p95_ms:>9.2f} {p99_ms:>9.2f}".format(
+            name, **stats)
+        if baseline and name in baseline["endpoints"]:
+            old = baseline["endpoints"][name]
+            line += "  (p95 {:+.1f}%, req/s {:+.1f}%)".format(
+                (stats["p95_ms"] / old["p95_ms"] - 1) * 100,
+                (stats["throughput"] / old["throughput"] - 1) * 100)
+        print(line)
+    print("total: {requests} requests in {seconds:.2f}s, {throughput:.1f} req/s".format(
+        **result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sparkplug benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    objects = commands.add_parser(
+        "objects", help="model object memory and attribute access cost")
+    objects.add_argument("--count", type=int, default=100000)
+
+    generate_parser = commands.add_parser(
+        "generate", help="generate a database with a synthetic fleet")
+    generate_parser.add_argument("--db", default="bench.db")
+    generate_parser.add_argument("--groups", type=int, default=5)
+    generate_parser.add_argument("--nodes", type=int, default=20,
+                                 help="nodes per group")
+    generate_parser.add_argument("--devices", type=int, default=10,
+                                 help="devices per node")
+    generate_parser.add_argument("--history", type=int, default=100,
+                                 help="values per metric")
+    generate_parser.add_argument("--interval", type=int, default=5,
+                                 help="seconds between values")
+    generate_parser.add_argument("--seed", type=int, default=0)
+
+    api_parser = commands.add_parser(
+        "api", help="drive the REST API against a generated database")
+    api_parser.add_argument("--db", default="bench.db")
+    api_parser.add_argument("--requests", type=int, default=2000)
+    api_parser.add_argument("--concurrency", type=int, default=16)
+    api_parser.add_argument("--mix", default="",
+                            help="endpoint weights, e.g. devices=5,device_metrics=10 (default: all equally)")
+    api_parser.add_argument("--seed", type=int, default=0)
+    api_parser.add_argument("--output", help="write the result as JSON")
+    api_parser.add_argument("--compare", help="a previous JSON result")
+
+    args = parser.parse_args()
+
+    if args.command == "objects":
+        result = bench_objects(args.count)
+        print("{objects} objects: built in {build_seconds:.3f}s, "
+              "{bytes_per_object:.0f} bytes/object, "
+              "{access_ns:.0f} ns/attribute access".format(**result))
+    elif args.command == "generate":
+        start = time.perf_counter()
+        result = generate(args.db, args.groups, args.nodes, args.devices,
+                          args.history, args.interval, args.seed)
+        print("Generated {groups} groups, {nodes} nodes, {devices} devices, "
+              "{metrics} metrics and {values} values".format(**result) +
+              " in {:.1f}s".format(time.perf_counter() - start))
+    elif args.command == "api":
+        if not os.path.exists(args.db):
+            parser.error("No such database: " + args.db +
+                         ", create it with 'generate'")
+        storage.startup(args.db)
+        result = asyncio.run(bench_api(args.requests, args.concurrency,
+                                       parse_mix(args.mix), args.seed))
+        result["db"] = args.db
+        result["mix"] = args.mix
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+        print_api_result(result, baseline)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import collections
+import threading
+import storage
+
+# Default size limit of a ResponseCache, in bytes
+MAX_BYTES = 16 * 1024 * 1024
+
+
+# An LRU cache of serialised responses, bounded by their total size
+# Entries do not expire, they are dropped by invalidate() when the data
+# they were built from changes
+class ResponseCache:
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  # key -> (body, headers)
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # Get the cached (body, headers) of key, or None
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    # The current version of the cache, changed by every invalidation
+    # Take it before building a response and pass it to put, so that a
+    # response built from data invalidated in the meantime is not cached
+    def version(self):
+        return self.invalidations
+
+    def put(self, key, body, headers, version):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if version != self.invalidations:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[key] = (body, headers)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[0])
+                self.evictions += 1
+
+    # Drop every entry
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+# Storage writes that change the topology: inserts, renames, births,
+# deaths and status changes of groups, nodes and devices
+def is_topology_write(type, id, attr, value):
+    return type in ("group", "node", "device")
+
+
+# Create a cache invalidated by every topology write
+def topology_cache(max_bytes=MAX_BYTES):
+    cache = ResponseCache(max_bytes)
+
+    def on_write(type, id, attr, value):
+        if is_topology_write(type, id, attr, value):
+            cache.invalidate()
+    storage.add_write_listener(on_write)
+    return cache
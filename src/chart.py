@@ -0,0 +1,75 @@
+import math
+import time
+
+# Charts drawn in the terminal with braille characters
+#
+# Every character holds 2 x 4 dots, so a chart of w x h characters has
+# 2 * w columns, each showing the range of the values of one time bucket,
+# and 4 * h levels.
+
+# The braille character without any dot
+BRAILLE_BLANK = 0x2800
+
+# The bit of each dot of a braille character, as DOTS[row][column] with
+# the rows from the top
+DOTS = ((0x01, 0x08), (0x02, 0x10), (0x04, 0x20), (0x40, 0x80))
+
+# Characters taken by the value labels left of a chart
+LABEL_WIDTH = 10
+
+
+# Draw columns of (low, high) value ranges, None for the columns without
+# values, as height lines of braille characters scaled to [bottom, top]
+# Consecutive columns are joined, so that the chart reads as a line
+def braille(columns, height, bottom, top) -> list[str]:
+    grid = [[0] * ((len(columns) + 1) // 2) for _ in range(height)]
+    levels = height * 4
+    scale = (levels - 1) / (top - bottom) if top > bottom else 0
+    previous = None
+    for x, column in enumerate(columns):
+        if column is None:
+            previous = None
+            continue
+        low, high = (round((value - bottom) * scale) for value in column)
+        current = (low, high)
+        if previous is not None:
+            low = min(low, previous[1] + 1)
+            high = max(high, previous[0] - 1)
+        previous = current
+        for level in range(low, high + 1):
+            row = levels - 1 - level
+            grid[row // 4][x // 2] |= DOTS[row % 4][x % 2]
+    return ["".join(chr(BRAILLE_BLANK + cell) for cell in line) for line in grid]
+
+
+def format_label(value):
+    return "{:>{}.4g}".format(value, LABEL_WIDTH)[-LABEL_WIDTH:]
+
+
+def format_time(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+# Draw a chart of columns of (low, high) value ranges spanning the times
+# from start to end, with the value range on the left and the time range
+# below, as lines of text
+def render(columns, height, start, end) -> list[str]:
+    values = [value for column in columns if column is not None for value in column]
+    if not values:
+        bottom, top = 0, 1
+    else:
+        bottom, top = min(values), max(values)
+    if bottom == top:
+        # a flat line is drawn in the middle
+        bottom, top = bottom - 1, top + 1
+    lines = braille(columns, height, bottom, top)
+    labels = [format_label(top)] + [" " * LABEL_WIDTH] * \
+        (height - 2) + [format_label(bottom)]
+    if height == 1:
+        labels = [format_label(top)]
+    lines = [label + " " + line for label, line in zip(labels, lines)]
+    width = math.ceil(len(columns) / 2)
+    first, last = format_time(start), format_time(end)
+    lines.append(" " * (LABEL_WIDTH + 1) + first +
+                 last.rjust(max(width - len(first), len(last) + 1)))
+    return lines
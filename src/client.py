@@ -1,4 +1,9 @@
 import paho.mqtt.client as mqtt
+import argparse
+import asyncio
+import concurrent.futures
+import multiprocessing
+import queue
 import time
 import random
 import json
@@ -111,7 +116,12 @@ class EdgeNode:
     # id: edge node id
     # server: MQTT server address
     # port: MQTT server port
-    def __init__(self, group, id, server, port):
+    # start: whether to connect and start a network thread now, otherwise
+    #        the caller drives the client, see NodeDriver
+    # names: whether DDATA messages include the metric names and datatypes
+    #        like the birth certificates (the legacy format), instead of
+    #        only the aliases
+    def __init__(self, group, id, server, port, start=True, names=False):
         self.group = group
         self.id = id
         self.client = mqtt.Client()
@@ -121,7 +131,9 @@ class EdgeNode:
         self.client.on_message = self.handle_message
         self.server = server
         self.port = port
+        self.names = names
         self.seq = 0
+        self.bytes_published = 0  # bytes of the DDATA payloads
         self.aliasCounter = 2  # bdSeq is 0, Node Control/Rebirth should not have an alias
 
         # register base metrics for the node
@@ -132,33 +144,50 @@ class EdgeNode:
         self.devices = []
 
         self.init_done = False
-        self.connect()
+        if start:
+            self.connect()
 
     # Called when a message is received
     def handle_message(self, client, userdata, msg):
         print("[" + self.id + "] RECV " + msg.topic + " " + str(msg.payload))
-
-    # Called to establish a connection to the MQTT server
-    def connect(self):
-        self.client.subscribe("spBv1.0/" + self.group + "/NCMD/" + self.id, 1)
+        if msg.topic == "spBv1.0/" + self.group + "/NCMD/" + self.id:
+            command = payload.Payload()
+            command.ParseFromString(msg.payload)
+            for metric in command.metrics:
+                # the host missed the births, so it cannot resolve aliases
+                if metric.name == "Node Control/Rebirth" and metric.boolean_value:
+                    self.birth()
+
+    # Called to set the death certificate before connecting
+    def prepare_connect(self):
         self.client.will_set("spBv1.0/" + self.group +
                              "/NDEATH/" +
                              self.id, generate_payload(
                                  0, self.metrics, self.mapping), 1, False)
 
+    # Called to establish a connection to the MQTT server
+    def connect(self):
+        self.prepare_connect()
         self.client.connect(self.server, self.port, KEEPALIVE)
         self.client.loop_start()
 
     # Called when the edge node is disconnected from the MQTT server
     def on_disconnect(self, client, userdata, rc):
-        print("Disconnected with result code " + str(rc))
+        self.init_done = False
+        print("[" + self.id + "] Disconnected with result code " + str(rc))
 
     # Called when the edge node is connected to the MQTT server
     def on_connect(self, client, userdata, flags, rc):
+        # subscriptions made before connecting are not sent
+        client.subscribe("spBv1.0/" + self.group + "/NCMD/" + self.id, 1)
+        self.birth()
+
+    # Called to publish the birth certificates of the node and its devices
+    def birth(self):
         # publish birth certificate
-        client.publish("spBv1.0/" + self.group + "/NBIRTH/" +
-                       self.id, generate_payload(self.seq,
-                                                 self.metrics, self.mapping, True), 0, False)
+        self.client.publish("spBv1.0/" + self.group + "/NBIRTH/" +
+                            self.id, generate_payload(self.seq,
+                                                      self.metrics, self.mapping, True), 0, False)
         self.seq += 1
         self.metrics["bdSeq"] += 1
 
@@ -168,18 +197,23 @@ class EdgeNode:
 
         self.init_done = True
 
+    # Called to add a device without publishing its birth certificate,
+    # which is published once connected
+    def add_device(self, device):
+        if device not in self.devices:
+            self.devices.append(device)
+            # map metrics to aliases
+            for name in device.metrics.keys():
+                device.mapping[name] = self.aliasCounter
+                self.aliasCounter += 1
+
     # Called to register a device
     def register_device(self, device):
         # get metrics from device
         device_metrics = device.get_metrics()
 
         # add device to list of devices
-        if device not in self.devices:
-            self.devices.append(device)
-            # map metrics to aliases
-            for name in device_metrics.keys():
-                device.mapping[name] = self.aliasCounter
-                self.aliasCounter += 1
+        self.add_device(device)
 
         # generate birth metrics, which includes name, alias, and datatype
         # subsequent DDATA messages will only include the alias and value
@@ -195,10 +229,17 @@ class EdgeNode:
         self.seq += 1
 
     # Called to publish metrics for a device
+    # The metrics are only identified by the aliases of the device birth
+    # certificate, unless the node publishes names
+    # Returns the paho MQTTMessageInfo of the message
     def publish(self, device, metrics):
-        self.client.publish("spBv1.0/" + self.group + "/DDATA/" + self.id + "/" + device.name,
-                            generate_payload(self.seq, metrics, device.mapping, True), 0, False)
+        data = generate_payload(
+            self.seq, metrics, device.mapping, self.names)
+        info = self.client.publish("spBv1.0/" + self.group + "/DDATA/" + self.id + "/" + device.name,
+                                   data, 0, False)
         self.seq += 1
+        self.bytes_published += len(data)
+        return info
 
     # Called to publish metrics for all devices
     def publish_all(self):
@@ -206,59 +247,289 @@ class EdgeNode:
             self.publish(device, device.get_metrics())
 
 
+# Create the i-th edge node of the config with its devices
+# The devices are added without being registered, they are registered
+# once the node is connected
+def create_node(config, i, start=True, names=False):
+    # the same node gets the same zone, server and devices in every run
+    # and in every worker process
+    rng = random.Random(i)
+    # pick a random MQTT server and zone
+    mqtt_server = rng.choice(config["mqtt"])
+    zone = rng.choice(config["zones"])
+    node = EdgeNode(zone, "node" + str(i),
+                    mqtt_server["host"], mqtt_server["port"], start, names)
+    device_types = list(config["client_device_types"].keys())
+    for j in range(config["client_devices_per_node"]):
+        # pick a random device type
+        device = rng.choice(device_types)
+        metrics = config["client_device_types"][device]["metrics"]
+        metric_types = {
+            metric: config["client_metric_types"][metric] for metric in metrics}
+        node.add_device(Device(device + str(j), metric_types))
+    return node
+
+
+# Connections opened at the same time by a simulator worker
+CONNECT_CONCURRENCY = 100
+
+# Seconds between the publishing rounds of a simulator worker
+PUBLISH_TICK = 0.1
+
+# Seconds of messages a worker catches up on after falling behind, the
+# older ones are counted as missed
+MAX_BACKLOG_SECONDS = 1
+
+# Seconds between the keepalive checks of the clients
+MISC_INTERVAL = 1
+
+# Seconds before a lost connection is opened again
+RECONNECT_DELAY = 5
+
+# Seconds between the rate reports
+REPORT_INTERVAL = 5
+
+
+# Runs the network loop of the paho client of a node on an asyncio event
+# loop instead of a network thread, so that one process can drive
+# thousands of nodes
+class NodeDriver:
+
+    def __init__(self, loop, node):
+        self.loop = loop
+        self.node = node
+        self.client = node.client
+        self.connecting = False
+        self.last_attempt = 0
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+        node.prepare_connect()
+        self.client.connect_async(node.server, node.port, KEEPALIVE)
+
+    # Open the connection, the blocking part in a thread of the executor,
+    # so that up to CONNECT_CONCURRENCY connections are opened at a time
+    # The CONNACK is then received by the event loop, which calls
+    # on_connect to publish the birth certificates
+    async def connect(self):
+        self.connecting = True
+        self.last_attempt = time.monotonic()
+        try:
+            await self.loop.run_in_executor(None, self.client.reconnect)
+        except OSError as e:
+            print("[" + self.node.id + "] Unable to connect: " + str(e))
+            return
+        finally:
+            self.connecting = False
+        self.loop.add_reader(self.client.socket(), self.client.loop_read)
+        if self.client.want_write():
+            self.loop.add_writer(self.client.socket(), self.client.loop_write)
+
+    # The paho socket callbacks may run in the executor while connecting
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.remove, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(
+            self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_writer, sock)
+
+    def remove(self, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+
+    # Send the keepalive pings, and reconnect if the connection was lost
+    def misc(self):
+        if self.connecting:
+            return
+        if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+            if time.monotonic() - self.last_attempt >= RECONNECT_DELAY:
+                self.loop.create_task(self.connect())
+
+
+# Publishes the metrics of the devices of some nodes at a target rate,
+# driving all of them from one asyncio event loop
+# rate -> DDATA messages per second, one per device, round robin
+# jitter -> fraction by which the interval between publishing rounds is
+#           randomly shortened or lengthened
+class SimulatorWorker:
+
+    def __init__(self, nodes, rate, jitter):
+        self.nodes = nodes
+        self.rate = rate
+        self.jitter = jitter
+        self.sent = 0
+        self.failed = 0  # rejected by the client, e.g. disconnected
+        self.missed = 0  # not sent in time, or the node was not connected
+
+    def connected(self):
+        return sum(1 for node in self.nodes if node.init_done)
+
+    async def publish(self):
+        devices = [(node, device)
+                   for node in self.nodes for device in node.devices]
+        if not devices:
+            return
+        index = 0
+        scheduled = 0
+        start = time.monotonic()
+        while True:
+            await asyncio.sleep(PUBLISH_TICK * random.uniform(1 - self.jitter, 1 + self.jitter))
+            due = int((time.monotonic() - start) * self.rate) - scheduled
+            backlog = int(self.rate * MAX_BACKLOG_SECONDS)
+            if due > backlog:
+                self.missed += due - backlog
+                scheduled += due - backlog
+                due = backlog
+            for _ in range(due):
+                node, device = devices[index]
+                index = (index + 1) % len(devices)
+                scheduled += 1
+                if not node.init_done:
+                    self.missed += 1
+                    continue
+                if node.publish(device, device.get_metrics()).rc == mqtt.MQTT_ERR_SUCCESS:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+
+    async def misc(self, drivers):
+        while True:
+            await asyncio.sleep(MISC_INTERVAL)
+            for driver in drivers:
+                driver.misc()
+
+    # Send the totals to the parent process every REPORT_INTERVAL
+    async def report(self, index, reports):
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            reports.put((index, self.connected(), len(self.nodes), self.sent, self.failed,
+                         self.missed, sum(node.bytes_published for node in self.nodes)))
+
+    async def run(self, index, reports):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(CONNECT_CONCURRENCY))
+        drivers = [NodeDriver(loop, node) for node in self.nodes]
+        for driver in drivers:
+            loop.create_task(driver.connect())
+        await asyncio.gather(self.publish(), self.misc(drivers),
+                             self.report(index, reports))
+
+
+# Open files a worker asks for when the hard limit cannot be used as is,
+# e.g. when it is unlimited, which macOS refuses as a soft limit
+FILE_LIMIT = 65536
+
+
+# Allow a worker as many open sockets as the system does
+def raise_file_limit():
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == hard:
+        return
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        limit = FILE_LIMIT if hard == resource.RLIM_INFINITY else min(hard, FILE_LIMIT)
+        if soft != resource.RLIM_INFINITY and soft < limit:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+            except (ValueError, OSError):
+                pass
+
+
+# Entry point of a simulator worker process, which drives the nodes
+# index, index + workers, index + 2 * workers, ...
+def run_worker(config, index, workers, rate, jitter, names, reports):
+    raise_file_limit()
+    nodes = [create_node(config, i, False, names)
+             for i in range(index, config["client_node_count"], workers)]
+    worker = SimulatorWorker(nodes, rate, jitter)
+    try:
+        asyncio.run(worker.run(index, reports))
+    except KeyboardInterrupt:
+        pass
+
+
+# Print the achieved rate reported by the workers against the requested
+# one every REPORT_INTERVAL seconds
+def report(reports, workers, rate):
+    totals = {}  # worker -> (connected, nodes, sent, failed, missed, bytes)
+    last_sent, last_time = 0, time.monotonic()
+    while True:
+        deadline = time.monotonic() + REPORT_INTERVAL
+        while time.monotonic() < deadline:
+            try:
+                index, *counts = reports.get(
+                    timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            totals[index] = counts
+        if not totals:
+            continue
+        connected, nodes, sent, failed, missed, size = (sum(column) for column in zip(*totals.values()))
+        now = time.monotonic()
+        print("[" + datetime.datetime.now().strftime("%H:%M:%S") + "] " +
+              "{}/{} nodes connected, {:.0f} msg/s published of {:.0f} requested, {} failed, {} missed, {:.1f} bytes/msg".format(
+                  connected, nodes, (sent - last_sent) / (now - last_time), rate, failed, missed,
+                  size / max(sent + failed, 1)) +
+              ("" if len(totals) == workers else " ({}/{} workers reporting)".format(len(totals), workers)))
+        last_sent, last_time = sent, now
+
+
 def main():
     print("Loading config..")
     # load config
     config = json.load(open("config.json"))
 
-    zones = config["zones"]
-    nodes = []
-
-    # get number of nodes and devices per node
-    node_count = config["client_node_count"]
-    device_count = config["client_devices_per_node"]
-    device_types = list(config["client_device_types"].keys())
-
-    print("Creating nodes..")
-    # create nodes
-    for i in range(node_count):
-        print("[Node " + str(i) + "] Creating node..")
-        # pick a random MQTT server and zone
-        mqtt_server = random.choice(config["mqtt"])
-        zone = random.choice(zones)
-        # create node
-        e = EdgeNode(zone, "node" + str(i),
-                     mqtt_server["host"], mqtt_server["port"])
-        nodes.append(e)
-
-        print("[Node " + str(i) + "] Waiting for node to connect..")
-        # wait for node to connect
-        while not e.init_done:
-            time.sleep(0.1)
-
-        print("[Node " + str(i) + "] Registering devices..")
-        # register devices
-        for j in range(device_count):
-            # pick a random device type
-            device = random.choice(device_types)
-            metrics = config["client_device_types"][device]["metrics"]
-            metric_types = {
-                metric: config["client_metric_types"][metric] for metric in metrics}
-            # create device
-            device = Device(device + str(j), metric_types)
-            # register device
-            e.register_device(device)
-
-    print("Starting publish metrics..")
-    # publish metrics
-    while True:
-        print("[" + datetime.datetime.now().strftime("%H:%M:%S") +
-              "] Publishing metrics..")
-        # publish metrics for all devices
-        for node in nodes:
-            node.publish_all()
-        # wait for interval
-        time.sleep(config["client_publish_interval_seconds"])
+    parser = argparse.ArgumentParser(
+        description="Simulate Sparkplug B edge nodes")
+    parser.add_argument("--nodes", type=int, default=config["client_node_count"],
+                        help="number of edge nodes")
+    parser.add_argument("--devices", type=int, default=config["client_devices_per_node"],
+                        help="number of devices per edge node")
+    parser.add_argument("--rate", type=float,
+                        help="DDATA messages per second, by default one per device every " +
+                        "client_publish_interval_seconds")
+    parser.add_argument("--jitter", type=float, default=0.1,
+                        help="fraction by which the publishing intervals vary randomly")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("--names", action="store_true",
+                        help="include the metric names and datatypes in DDATA messages (legacy format) " +
+                        "instead of only the aliases")
+    args = parser.parse_args()
+    if args.nodes <= 0 or args.devices < 0 or args.workers <= 0 or not 0 <= args.jitter < 1:
+        parser.error("invalid number of nodes, devices, workers or jitter")
+    config["client_node_count"] = args.nodes
+    config["client_devices_per_node"] = args.devices
+    rate = args.rate
+    if rate is None:
+        rate = args.nodes * args.devices / \
+            config["client_publish_interval_seconds"]
+    workers = min(args.workers, args.nodes)
+
+    print("Starting " + str(workers) + " workers for " + str(args.nodes) + " nodes with " +
+          str(args.devices) + " devices each, publishing " + str(rate) + " messages per second..")
+    reports = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_worker, args=(config, index, workers, rate / workers, args.jitter, args.names, reports),
+                                         daemon=True)
+                 for index in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        report(reports, workers, rate)
+    except KeyboardInterrupt:
+        pass
+    for process in processes:
+        process.terminate()
 
 
 if __name__ == "__main__":
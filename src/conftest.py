@@ -0,0 +1,10 @@
+import pytest
+import storage
+
+
+# The tests share one database, as storage is only started once per process
+@pytest.fixture(scope="session", autouse=True)
+def database(tmp_path_factory):
+    storage.startup(str(tmp_path_factory.mktemp("db") / "test.db"))
+    yield
+    storage.shutdown()
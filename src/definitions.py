@@ -0,0 +1,204 @@
+import collections.abc
+import re
+import threading
+import time
+import events
+import model
+import planner
+import storage
+
+# Variables of the CLI
+#
+# @name in an expression refers to a variable, either assigned (the value
+# of an expression evaluated once) or defined (an expression evaluated
+# when used). Defined expressions are planned and compiled once, and their
+# results are memoized until one of the metrics, topology or other
+# definitions they read changes, or until their optional TTL runs out.
+# Iterators, e.g. the generators of Metric.iter_values, are used up by
+# reading them, so they are evaluated again on every use instead.
+
+# Matches the @name references of an expression
+REFERENCE = re.compile(r'@([a-zA-Z][a-zA-Z_0-9]*)')
+
+# The name the variables are looked up with from compiled expressions
+LOOKUP_NAME = "__variable__"
+
+# Matches the lookups the references are compiled to
+LOOKUP = re.compile(LOOKUP_NAME + r"\('([a-zA-Z][a-zA-Z_0-9]*)'\)")
+
+
+# Key of the reads of a definition, see model.track_reads
+def definition_key(name):
+    return ("definition", name)
+
+
+# Replace the @name references of an expression by variable lookups
+def compile_references(expr):
+    return REFERENCE.sub(lambda match: LOOKUP_NAME + "(" + repr(match.group(1)) + ")", expr)
+
+
+# An expression assigned to a variable, evaluated when used
+# ttl -> if given, the result is memoized for at most ttl seconds
+class Definition:
+
+    def __init__(self, name, source, ttl=None):
+        self.name = name
+        self.source = source
+        self.ttl = ttl
+        self.plan = None
+        self.plan_reads = {}
+        self.result = None
+        self.reads = None  # the keys read by the memoized result, if any
+        self.pending_reads = None  # the keys read so far while evaluating
+        self.epoch = None
+        self.evaluated_at = 0
+        # bumped by every invalidation, so that a result computed from
+        # invalidated data is not memoized
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Whether the memoized result can be used
+    # Writes are only seen while connected to the host, so without a TTL
+    # results are only memoized while connected, and with one they are
+    # used for up to ttl seconds while disconnected
+    def is_fresh(self):
+        if self.reads is None:
+            return False
+        if self.ttl is not None:
+            return time.monotonic() - self.evaluated_at < self.ttl
+        return model.events_connected() and self.epoch == storage.GENERATION_EPOCH
+
+    # Whether the memoized result or the evaluation in progress read key
+    def depends_on(self, key):
+        return any(key in reads for reads in (self.reads, self.pending_reads, self.plan_reads)
+                   if reads is not None)
+
+    # Forget the memoized result, and the plan if its lookups are stale
+    def invalidate(self, plan=False):
+        self.version += 1
+        self.reads = None
+        if plan:
+            self.plan = None
+
+    # Evaluate the expression, or return the memoized result
+    # lock -> the lock the invalidations are done with
+    def evaluate(self, namespace, lock):
+        if self.is_fresh():
+            self.hits += 1
+            return self.result
+        self.misses += 1
+        version = self.version
+        epoch = storage.GENERATION_EPOCH
+        with model.track_reads() as reads:
+            # the reads are recorded before the data is read, so a write
+            # of read data always invalidates the evaluation in progress
+            self.pending_reads = reads
+            try:
+                plan = self.plan
+                if plan is None or not model.events_connected():
+                    plan = planner.plan(
+                        compile_references(self.source), namespace)
+                    plan_reads = dict(reads)
+                else:
+                    plan_reads = self.plan_reads
+                result = plan.run()
+            finally:
+                self.pending_reads = None
+        reads.update(plan_reads)
+        with lock:
+            if version == self.version:
+                self.plan, self.plan_reads = plan, plan_reads
+                if isinstance(result, collections.abc.Iterator):
+                    return result
+                self.result, self.reads = result, reads
+                self.epoch = epoch
+                self.evaluated_at = time.monotonic()
+        return result
+
+
+# The defined variables of a namespace, kept up to date by the writes
+class Definitions:
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.entries = {}  # name -> Definition
+        self.lock = threading.Lock()
+        namespace[LOOKUP_NAME] = self.lookup
+        storage.add_write_listener(self.on_write)
+
+    # Stop following the writes, once the definitions are no longer used
+    def close(self):
+        storage.remove_write_listener(self.on_write)
+
+    def define(self, name, source, ttl=None):
+        self.namespace.pop(name, None)
+        with self.lock:
+            self.entries[name] = Definition(name, source, ttl)
+            self.invalidate_dependents(name)
+
+    # Assign the value of an expression to a variable
+    def assign(self, name, expr):
+        value = self.evaluate(expr)
+        with self.lock:
+            self.entries.pop(name, None)
+            self.invalidate_dependents(name)
+        self.namespace[name] = value
+
+    # The value of a variable, called for the @name references
+    def lookup(self, name):
+        model.record_read(definition_key(name))
+        definition = self.entries.get(name)
+        if definition is not None:
+            return definition.evaluate(self.namespace, self.lock)
+        if name not in self.namespace:
+            raise Exception("Identifier not defined: " + name)
+        return self.namespace[name]
+
+    def plan(self, expr) -> planner.Plan:
+        return planner.plan(compile_references(expr), self.namespace)
+
+    def evaluate(self, expr):
+        return self.plan(expr).run()
+
+    # Describe how an expression would be evaluated, see planner.Plan
+    def explain(self, expr) -> list[str]:
+        return [LOOKUP.sub(lambda match: "@" + match.group(1), line)
+                for line in self.plan(expr).explain()]
+
+    # Invalidate the definitions that read the given keys, and the ones
+    # reading those, and so on
+    # Must be called with the lock held
+    def invalidate(self, keys, plan=False):
+        pending = list(keys)
+        invalidated = {}
+        while pending:
+            key = pending.pop()
+            for definition in self.entries.values():
+                if definition.name not in invalidated and definition.depends_on(key):
+                    definition.invalidate(plan)
+                    invalidated[definition.name] = None
+                    pending.append(definition_key(definition.name))
+
+    def invalidate_dependents(self, name):
+        self.invalidate([definition_key(name)], plan=True)
+
+    # Storage write listener invalidating the stale results
+    def on_write(self, type, id, attr, value):
+        if not self.entries:
+            return
+        with self.lock:
+            if type == "metric" and attr == "value":
+                # the metric paths are cached, so this rarely queries
+                metric_name = events.get_metric_path(id)[2].rsplit("/", 1)[1]
+                self.invalidate([model.metric_key(id),
+                                 model.metric_name_key(metric_name)])
+            else:
+                # the lookups of the plans may no longer find the same
+                self.invalidate([model.TOPOLOGY_KEY], plan=True)
+
+    # Describe the definitions as (name, source, ttl, hits, misses, fresh)
+    def stats(self):
+        with self.lock:
+            return [(definition.name, definition.source, definition.ttl, definition.hits,
+                     definition.misses, definition.is_fresh()) for definition in self.entries.values()]
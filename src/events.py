@@ -0,0 +1,311 @@
+import collections
+import fnmatch
+import json
+import os
+import re
+import threading
+import time
+import traceback
+from multiprocessing.connection import Listener, Client
+import storage
+
+# Events queued for a subscriber before the oldest ones are dropped
+QUEUE_SIZE = 1000
+
+# Writes queued for a remote process before the oldest ones are dropped
+REMOTE_QUEUE_SIZE = 100000
+
+# Seconds to wait before reconnecting to the event server
+RECONNECT_INTERVAL = 5
+
+
+# A subscriber with its own bounded queue of events
+# callback -> called with the queued events, one at a time
+# maxsize -> number of queued events before the oldest one is dropped
+# coalesce -> if True, only the latest event for each key is kept,
+#             so a slow subscriber only sees the latest values
+# inline -> if True, the callback is called directly from the write path
+#           instead of a dedicated thread, so it must never block
+class Subscription:
+
+    def __init__(self, callback, maxsize=QUEUE_SIZE, coalesce=False, inline=False):
+        self.callback = callback
+        self.maxsize = maxsize
+        self.coalesce = coalesce
+        self.inline = inline
+        self.queue = collections.OrderedDict() if coalesce else collections.deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+        self.unregister = None
+        if not inline:
+            threading.Thread(target=self.run, daemon=True).start()
+
+    # Queue an event, key identifies what coalesced events replace
+    def put(self, key, event):
+        if self.inline:
+            self.deliver(event)
+            return
+        with self.condition:
+            if self.coalesce:
+                self.queue.pop(key, None)
+                self.queue[key] = event
+                if len(self.queue) > self.maxsize:
+                    self.queue.popitem(last=False)
+                    self.dropped += 1
+            else:
+                if len(self.queue) >= self.maxsize:
+                    self.queue.popleft()
+                    self.dropped += 1
+                self.queue.append(event)
+            self.condition.notify()
+
+    def deliver(self, event):
+        try:
+            self.callback(*event)
+        except Exception:
+            traceback.print_exc()
+
+    # Deliver the queued events until the subscription is closed
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                if self.coalesce:
+                    event = self.queue.popitem(last=False)[1]
+                else:
+                    event = self.queue.popleft()
+            self.deliver(event)
+
+    # Stop receiving events
+    def close(self):
+        if self.unregister:
+            self.unregister()
+            self.unregister = None
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+SUBSCRIPTIONS_LOCK = threading.Lock()
+BY_METRIC = {}  # metric_id -> list of subscriptions
+BY_DEVICE = {}  # device_id -> list of subscriptions
+# tuple of (compiled glob pattern, subscription), replaced rather than
+# changed so that the writes can match against it outside the lock
+BY_PATH = ()
+
+# metric_id -> (device_id, device path, metric path), filled on demand
+METRIC_PATHS = {}
+
+# metric_id -> (BY_PATH, the subscriptions of BY_PATH matching the metric)
+PATH_MATCHES = {}
+
+
+def add_subscription(registry, key, subscription):
+    with SUBSCRIPTIONS_LOCK:
+        registry.setdefault(key, []).append(subscription)
+
+    def unregister():
+        with SUBSCRIPTIONS_LOCK:
+            registry[key].remove(subscription)
+            if not registry[key]:
+                del registry[key]
+    subscription.unregister = unregister
+
+
+# Subscribe to the value writes of the metrics matching the target
+# target -> ("metric", metric_id), ("device", device_id) or a glob
+#           matched against "group/node/device" and "group/node/device/metric"
+# callback -> called as callback(metric_id, value, timestamp)
+# Returns the Subscription, call close() on it to unsubscribe
+def subscribe(target, callback, maxsize=QUEUE_SIZE, coalesce=False, inline=False):
+    subscription = Subscription(callback, maxsize, coalesce, inline)
+    if isinstance(target, str):
+        entry = (re.compile(fnmatch.translate(target)), subscription)
+        global BY_PATH
+        with SUBSCRIPTIONS_LOCK:
+            BY_PATH += (entry,)
+
+        def unregister():
+            global BY_PATH
+            with SUBSCRIPTIONS_LOCK:
+                BY_PATH = tuple(item for item in BY_PATH if item is not entry)
+        subscription.unregister = unregister
+    elif target[0] == "metric":
+        add_subscription(BY_METRIC, target[1], subscription)
+    elif target[0] == "device":
+        add_subscription(BY_DEVICE, target[1], subscription)
+    else:
+        subscription.close()
+        raise ValueError("Invalid subscription target: " + str(target))
+    return subscription
+
+
+def get_metric_path(metric_id):
+    if metric_id not in METRIC_PATHS:
+        device_id, path = storage.get_metric_path(metric_id)
+        METRIC_PATHS[metric_id] = (device_id, path.rsplit("/", 1)[0], path)
+    return METRIC_PATHS[metric_id]
+
+
+# get_metric_path of many metrics at once, as a list
+def get_metric_paths(metric_ids):
+    return [get_metric_path(metric_id) for metric_id in metric_ids]
+
+
+# The subscriptions of paths, a BY_PATH tuple, matching a metric
+# The matches are cached until the path subscriptions or the names change
+def path_matches(metric_id, paths):
+    cached = PATH_MATCHES.get(metric_id)
+    if cached is not None and cached[0] is paths:
+        return cached[1]
+    _, device_path, metric_path = get_metric_path(metric_id)
+    matches = [subscription for pattern, subscription in paths
+               if pattern.match(metric_path) or pattern.match(device_path)]
+    PATH_MATCHES[metric_id] = (paths, matches)
+    return matches
+
+
+# Storage write listener delivering metric values to the subscribers
+def on_write(type, id, attr, value):
+    if attr == "name":
+        # paths are cached by name
+        METRIC_PATHS.clear()
+        PATH_MATCHES.clear()
+        return
+    if type != "metric" or attr != "value":
+        return
+    event = (id, value[0], value[1])
+    with SUBSCRIPTIONS_LOCK:
+        subscriptions = list(BY_METRIC.get(id, ()))
+        devices = bool(BY_DEVICE)
+        paths = BY_PATH
+    # the path of the metric may have to be queried, so it is looked up
+    # and matched outside the lock
+    if devices:
+        device_id = get_metric_path(id)[0]
+        with SUBSCRIPTIONS_LOCK:
+            subscriptions += BY_DEVICE.get(device_id, ())
+    if paths:
+        subscriptions += path_matches(id, paths)
+    for subscription in subscriptions:
+        subscription.put(id, event)
+
+
+storage.add_write_listener(on_write)
+
+
+# Load the event server details from the config file
+def load_config():
+    with open("config.json", "rb") as f:
+        config = json.load(f)["events"]
+    return config["address"], config["authkey"].encode()
+
+
+# Forwards every storage write to the processes connected over the local
+# socket, so their write listeners see the writes done in this process
+class EventServer:
+
+    def __init__(self, address, authkey):
+        # a stale socket file is left behind if the previous server died
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
+        self.listener = Listener(address, authkey=authkey)
+        self.clients = []
+        self.lock = threading.Lock()
+        storage.add_write_listener(self.on_write)
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                return
+            except Exception:
+                # failed handshake
+                continue
+            subscription = Subscription(
+                lambda *event, connection=connection: self.send(connection, event),
+                REMOTE_QUEUE_SIZE)
+            with self.lock:
+                self.clients.append((connection, subscription))
+
+    def send(self, connection, event):
+        try:
+            connection.send(event)
+        except (OSError, ValueError):
+            self.disconnect(connection)
+
+    def disconnect(self, connection):
+        with self.lock:
+            for client in self.clients:
+                if client[0] is connection:
+                    self.clients.remove(client)
+                    client[1].close()
+                    break
+        connection.close()
+
+    def on_write(self, type, id, attr, value):
+        with self.lock:
+            clients = list(self.clients)
+        for connection, subscription in clients:
+            if subscription.dropped:
+                # the client missed writes, make it reconnect so that it
+                # knows its state may be stale
+                self.disconnect(connection)
+                continue
+            subscription.put(None, (type, id, attr, value))
+
+    def close(self):
+        storage.remove_write_listener(self.on_write)
+        self.listener.close()
+        for connection, _ in list(self.clients):
+            self.disconnect(connection)
+
+
+# Start serving the writes done in this process to other processes
+def serve():
+    return EventServer(*load_config())
+
+
+# Set while this process receives the writes of the host
+CONNECTED = threading.Event()
+
+
+# Replay the writes done in the serving process to the write listeners
+# of this process, reconnecting whenever the connection is lost
+# Writes may be missed while disconnected, so the storage generations
+# are reset on every (re)connection
+def receive(address, authkey):
+    while True:
+        try:
+            connection = Client(address, authkey=authkey)
+        except Exception:
+            time.sleep(RECONNECT_INTERVAL)
+            continue
+        storage.reset_generations()
+        CONNECTED.set()
+        try:
+            while True:
+                # notify_write reports and skips failing listeners
+                storage.notify_write(*connection.recv())
+        except (EOFError, OSError):
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            # writes may be missed until the next connection
+            CONNECTED.clear()
+            storage.reset_generations()
+            connection.close()
+        time.sleep(RECONNECT_INTERVAL)
+
+
+# Connect to the event server of the host in the background
+def connect():
+    threading.Thread(target=receive, args=load_config(),
+                     daemon=True).start()
@@ -49,6 +49,22 @@ def generate_metric(seq, metrics, mapping, birth=False, timestamp=int(time.time(
     return payload1.SerializeToString()
 
 
+# Get the value of a metric from whichever value field is set, so that
+# metrics without a datatype (i.e. DDATA metrics) can be decoded
+def get_metric_value(metric):
+    field = metric.WhichOneof("value")
+    if field is None:
+        raise Exception("No value in metric")
+    return getattr(metric, field)
+
+
+# Seconds before the rebirth of an edge node is requested again
+REBIRTH_INTERVAL = 10
+
+# Seconds between the DDATA decoding reports
+STATS_INTERVAL = 60
+
+
 # Convert a Sparkplug metric type to a string
 # and return the value
 def get_metric_type_string(metric):
@@ -87,6 +103,15 @@ class SparkplugHost:
 
         self.edgeNodeSeq = {}  # maps the sequence number to each edge node
         self.edgeNodeAlive = {}  # maps the alive status to each edge node
+        # maps the metric aliases of each edge node to the model metrics,
+        # from the birth certificates of its devices
+        self.edgeNodeAliases = {}
+        # maps the metric names of each device to the model metrics
+        self.deviceMetrics = {}
+        self.rebirthRequested = {}  # maps the time of the last rebirth request to each edge node
+        # DDATA messages, bytes and seconds spent decoding them, for the
+        # messages with aliases only and the ones with metric names
+        self.ddataStats = {"aliases": [0, 0, 0.0], "names": [0, 0, 0.0]}
         # register handlers for all the actions in all of the zones
         print("[" + id + "]" + " Registering handlers..")
         event_types = ["NBIRTH", "DBIRTH",
@@ -128,8 +153,23 @@ class SparkplugHost:
                             payload=generate_metric(0, {"Node Control/Rebirth": True}, None, True),)
         self.edgeNodeAlive[group_name + node_name] = True
 
+    # Send a rebirth command, unless one was sent recently
+    def request_rebirth(self, group_name, node_name):
+        now = time.monotonic()
+        if now - self.rebirthRequested.get(group_name + node_name, -REBIRTH_INTERVAL) >= REBIRTH_INTERVAL:
+            self.rebirthRequested[group_name + node_name] = now
+            self.send_rebirth(group_name, node_name)
+
+    # Print the size and decoding time of the DDATA messages received
+    def print_stats(self):
+        for mode, (count, size, seconds) in self.ddataStats.items():
+            if count:
+                print("[" + self.id + "] DDATA with " + mode + ": " + str(count) + " messages, " +
+                      "{:.1f} bytes/message, {:.1f} us/message to decode".format(size / count, seconds / count * 1e6))
+
     # Extract an incoming message and call the appropriate handler
     def handle_action(self, client, userdata, msg):
+        start = time.perf_counter()
         group_name, node_name, device_name, action, payload = self.extract_msg(
             msg)
         if action == "NBIRTH":
@@ -142,7 +182,8 @@ class SparkplugHost:
             else:
                 self.handle_ndata(group_name, node_name, payload)
         elif action == "DDATA":
-            self.handle_ddata(group_name, node_name, device_name, payload)
+            self.handle_ddata(group_name, node_name,
+                              device_name, payload, len(msg.payload), start)
         elif action == "NDEATH":
             self.handle_ndeath(group_name, node_name, payload)
         elif action == "DDEATH":
@@ -154,6 +195,8 @@ class SparkplugHost:
         # set the sequence number for this node
         self.edgeNodeSeq[group_name + node_name] = payload.seq
         self.edgeNodeAlive[group_name + node_name] = True
+        # the aliases are assigned again by the births of the devices
+        self.edgeNodeAliases[group_name + node_name] = {}
         # create the node in the model
         model.create_group(group_name)
         node = model.create_node(group_name, node_name)
@@ -175,12 +218,18 @@ class SparkplugHost:
         # register the device metrics
         if len(payload.metrics) == 0:
             raise Exception("No metrics in device birth certificate")
+        aliases = self.edgeNodeAliases.setdefault(group_name + node_name, {})
+        names = self.deviceMetrics[(group_name, node_name, device_name)] = {}
         for metric in payload.metrics:
             metric_type_str, value = get_metric_type_string(metric)
             # create the metric in the model
-            metric = model.create_metric(group_name, node_name,
-                                         device_name, metric.name, metric_type_str)
-            metric.value = (value, payload.timestamp)
+            model_metric = model.create_metric(group_name, node_name,
+                                               device_name, metric.name, metric_type_str)
+            model_metric.value = (value, payload.timestamp)
+            # subsequent DDATA messages may only include the alias
+            if metric.HasField("alias"):
+                aliases[metric.alias] = model_metric
+            names[metric.name] = model_metric
 
     # Handle a node data message
     def handle_ndata(self, group_name, node_name, payload):
@@ -188,22 +237,58 @@ class SparkplugHost:
         self.edgeNodeSeq[group_name + node_name] += 1
         # currently ignored
 
+    # Get the metrics of a device by name, from its birth certificate or
+    # from the model if it was born before the host started
+    def get_device_metrics(self, group_name, node_name, device_name):
+        key = (group_name, node_name, device_name)
+        if key not in self.deviceMetrics:
+            device = model.get_device(
+                group_name, node_name, device_name, model.MATCH_EXACT)[0]
+            self.deviceMetrics[key] = {
+                metric.name: metric for metric in device.metrics}
+        return self.deviceMetrics[key]
+
     # Handle a device data message
-    def handle_ddata(self, group_name, node_name, device_name, payload):
+    # Metrics are matched by alias, using the aliases of the device birth
+    # certificate, or by name if they have one (the legacy format)
+    # size and start are the size of the message and when it was received,
+    # for the decoding statistics
+    def handle_ddata(self, group_name, node_name, device_name, payload, size=0, start=None):
         # print("DDATA: " + group_name + "/" + node_name + "/" + device_name)
-        # update the device metrics
+        aliases = self.edgeNodeAliases.get(group_name + node_name, {})
+        names = None
+        mode = "aliases"
+        values = []
         for metric in payload.metrics:
-            for metric_i in model.get_device(group_name, node_name, device_name)[0].metrics:
-                if metric_i.name == metric.name:
-                    _, value = get_metric_type_string(metric)
-                    metric_i.value = (value, payload.timestamp)
+            if metric.HasField("name"):
+                mode = "names"
+                if names is None:
+                    names = self.get_device_metrics(
+                        group_name, node_name, device_name)
+                target = names.get(metric.name)
+            else:
+                target = aliases.get(metric.alias)
+                if target is None:
+                    # the births were missed, e.g. the host started later
+                    self.request_rebirth(group_name, node_name)
+                    return
+            if target is not None:
+                values.append((target, get_metric_value(metric)))
+        if start is not None:
+            stats = self.ddataStats[mode]
+            stats[0] += 1
+            stats[1] += size
+            stats[2] += time.perf_counter() - start
+        # update the device metrics
+        for target, value in values:
+            target.value = (value, payload.timestamp)
 
     # Handle a node death message
     def handle_ndeath(self, group_name, node_name, payload):
         # print("NDEATH: " + node_name)
         # set the node status
         self.edgeNodeAlive[group_name + node_name] = False
-        node = model.get_node(group_name, node_name)[0]
+        node = model.get_node(group_name, node_name, model.MATCH_EXACT)[0]
         node.status = "OFFLINE"
         node.death_timestamp = payload.timestamp
 
@@ -211,7 +296,8 @@ class SparkplugHost:
     def handle_ddeath(self, group_name, node_name, device_name, payload):
         # print("DDEATH: " + node_name + "/" + device_name)
         # set the device status
-        device = model.get_device(group_name, node_name, device_name)[0]
+        device = model.get_device(
+            group_name, node_name, device_name, model.MATCH_EXACT)[0]
         device.status = "OFFLINE"
         device.death_timestamp = payload.timestamp
 
@@ -227,6 +313,8 @@ def main():
     config = load_config()
     print("Setting up model..")
     model.startup()
+    print("Serving events..")
+    model.serve_events()
     print("Spawning hosts..")
     hosts = []
     for index, id in enumerate(config["ids"]):
@@ -236,8 +324,13 @@ def main():
         print("Starting processing loop..")
         for host in hosts:
             host.connect()
+        last_stats = time.monotonic()
         while True:
             time.sleep(1)
+            if time.monotonic() - last_stats >= STATS_INTERVAL:
+                last_stats = time.monotonic()
+                for host in hosts:
+                    host.print_stats()
     except KeyboardInterrupt:
         model.shutdown()
         print("Shutting down..")
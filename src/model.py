@@ -1,7 +1,11 @@
 import storage
-from typing import Any
+import events
+import contextlib
+import contextvars
+import itertools
 import math
 import statistics
+import views
 
 # An object that can be queried from the storage backend
 #
@@ -14,53 +18,144 @@ import statistics
 # def set(device_type, device_id, attribute_name, attribute_value)
 
 
-class Queryable(object):
-    # name -> type of the object
-    # id -> id of the object
-    # attributes -> dict of attribute:can_be_cached
-    # settable -> list of attributes that can be set
-    def __init__(self, name: str, id: int, attributes: dict, settable: list[str] = []):
-        self.__dict__["attributes"] = attributes.keys()
-        self.__dict__["can_be_cached"] = attributes
-        self.__dict__["cached"] = {}
-        self.__dict__["type_name"] = name
-        self.__dict__["id"] = id
-        self.__dict__["settable"] = settable
-        self.__dict__["special_types"] = {"group": Group, "node": Node,
-                                          "device": Device, "metric": Metric}
-
-    # Dynamically get attributes from the storage backend
-    def __getattr__(self, attribute):
-        # Check if the attribute exists
-        if attribute not in self.attributes:
-            raise AttributeError(
-                self.type_name + " has no attribute " + attribute)
+# Default number of points returned by get_series
+SERIES_POINTS = 500
+
+
+# Keys of the data read from the storage backend, see track_reads
+# Reads of the values of one metric
+def metric_key(metric_id):
+    return ("metric", metric_id)
+
+
+# Reads of the values of all metrics with a given name
+def metric_name_key(metric_name):
+    return ("metric_name", metric_name)
+
+
+# Reads of anything else: names, statuses, and who belongs to whom
+TOPOLOGY_KEY = ("topology",)
+
+# The keys read by the current evaluation, if they are being tracked
+READS = contextvars.ContextVar("reads", default=None)
+
+
+# Record that the current evaluation reads the data identified by key
+# Called before reading it, so that a write racing with the read is
+# never missed by whoever tracks the reads
+def record_read(key):
+    reads = READS.get()
+    if reads is not None:
+        reads[key] = None
+
+
+# Track the keys of the data read from the storage backend inside the
+# with block, e.g. to know when a result computed from them is stale
+# with track_reads() as reads: ...
+# reads is a dict used as an ordered set of keys
+@contextlib.contextmanager
+def track_reads():
+    reads = {}
+    token = READS.set(reads)
+    try:
+        yield reads
+    finally:
+        READS.reset(token)
+
+
+# Conversions applied to the raw ids returned by the storage backend,
+# shared by all Queryable classes. An attribute named after a type
+# (e.g. "group") is converted to an object of that type, and its plural
+# (e.g. "groups") to a list of them. Filled in once the classes exist.
+SPECIAL_TYPES = {}
+
+
+# A descriptor for one gettable/settable attribute of a Queryable
+# Generated from the schema of the class, see Queryable.__init_subclass__
+class Attribute(object):
+    __slots__ = ("name", "can_be_cached", "settable", "type_name", "many",
+                 "hits", "misses")
+
+    def __init__(self, name: str, can_be_cached: bool, settable: bool):
+        self.name = name
+        self.can_be_cached = can_be_cached
+        self.settable = settable
+        # The special type this attribute converts to, if any
+        self.type_name = None
+        self.many = False
+        # Reads of a cacheable attribute answered from and missing the
+        # caches of the objects, see cache_stats
+        self.hits = 0
+        self.misses = 0
+        if name in ("group", "node", "device", "metric"):
+            self.type_name = name
+        elif name in ("groups", "nodes", "devices", "metrics"):
+            self.type_name = name[:-1]
+            self.many = True
+
+    # Get the attribute from the storage backend
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
         # Check if the attribute is cached
-        if attribute in self.cached:
-            return self.cached[attribute]
-        # Get the attribute from the storage backend
-        value = storage.get(
-            self.type_name.lower(), self.id, attribute)
+        cached = obj.cached
+        if cached is not None and self.name in cached:
+            self.hits += 1
+            return cached[self.name]
+        if obj.storage_type == "metric" and self.name in ("value", "timestamp", "values"):
+            record_read(metric_key(obj.id))
+        else:
+            record_read(TOPOLOGY_KEY)
+        value = storage.get(obj.storage_type, obj.id, self.name)
         # Convert the value to the correct type if required
-        if attribute in self.special_types:
-            value = self.special_types[attribute](value)
-        elif attribute.endswith("s") and attribute[:-1] in self.special_types:
-            value = [self.special_types[attribute[:-1]](
-                item_id) for item_id in value]
-
+        if self.type_name is not None:
+            cls = SPECIAL_TYPES[self.type_name]
+            if self.many:
+                value = [cls(item_id) for item_id in value]
+            else:
+                value = cls(value)
         # Cache the value if required
-        if self.can_be_cached[attribute]:
-            self.cached[attribute] = value
-
+        if self.can_be_cached:
+            self.misses += 1
+            if cached is None:
+                obj.cached = cached = {}
+            cached[self.name] = value
         return value
 
-    # Dynamically set attributes in the storage backend
-    def __setattr__(self, __name: str, __value: Any) -> None:
-        # Check if the attribute declared as settable
-        if __name in self.settable:
-            storage.set(self.type_name.lower(), self.id, __name, __value)
-        else:
-            super().__setattr__(__name, __value)
+    # Set the attribute in the storage backend
+    def __set__(self, obj, value):
+        if not self.settable:
+            raise AttributeError(
+                obj.type_name + " attribute " + self.name + " is not settable")
+        storage.set(obj.storage_type, obj.id, self.name, value)
+        if obj.cached is not None and self.name in obj.cached:
+            obj.cached[self.name] = value
+
+
+class Queryable(object):
+    __slots__ = ("id", "cached")
+
+    # The attributes of the objects, declared once per class as
+    # attribute -> (can_be_cached, settable)
+    schema = {}
+
+    # Generate the attribute descriptors from the schema of the subclass
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.type_name = cls.__name__
+        cls.storage_type = cls.__name__.lower()
+        for name, (can_be_cached, settable) in cls.schema.items():
+            setattr(cls, name, Attribute(name, can_be_cached, settable))
+
+    # id -> id of the object
+    def __init__(self, id: int):
+        self.id = id
+        self.cached = None
+
+    # Only called for attributes that are not in the schema
+    def __getattr__(self, attribute):
+        raise AttributeError(
+            self.type_name + " has no attribute " + attribute)
 
     # Convert the object to a string
     def __str__(self):
@@ -101,10 +196,26 @@ class NamedMetric(object):
 # Gettable fields: name, type, value, timestamp, values
 # Settable fields: value
 class Metric(Queryable):
-    def __init__(self, id):
-        super().__init__("Metric", id, {
-            "name": True, "type": True, "value": False, "timestamp": False, "values": False},
-            ["value"])
+    __slots__ = ()
+    schema = {
+        "name": (True, False),
+        "type": (True, False),
+        "value": (False, True),
+        "timestamp": (False, False),
+        "values": (False, False),
+    }
+
+    # Lazily iterate over the (value, timestamp) history of the metric,
+    # optionally bounded by start and end timestamps (inclusive)
+    # Only one chunk of rows is held in memory at a time
+    def iter_values(self, start=None, end=None, chunk=storage.CHUNK_SIZE):
+        record_read(metric_key(self.id))
+        return storage.iter_values(self.id, start, end, chunk)
+
+    # Downsample the history of the metric to at most points
+    # (timestamp, value) rows, see get_series
+    def series(self, start=None, end=None, points=SERIES_POINTS, method="bucket"):
+        return get_series(self.id, start, end, points, method)
 
 
 # A device that can be queried by name
@@ -123,19 +234,23 @@ class NamedDevice(object):
 
 
 # A device that provides some fields to query
-# Gettable fields: name, group, node, status, metrics, birth_timestamp, death_timestamp
-# Settable fields: status
+# Gettable fields: name, group, node, status, metrics, birth_timestamp, death_timestamp, metric
+# Settable fields: status, death_timestamp, birth_timestamp
 class Device(Queryable):
-    def __init__(self, id):
-        super().__init__("Device", id, {
-            "name": True, "group": True, "node": True, "status": False, "metrics": True,
-            "birth_timestamp": False, "death_timestamp": False, "metric": False},
-            ["status", "death_timestamp", "birth_timestamp"])
-
-    def __getattr__(self, attribute):
-        if attribute == "metric":
-            return NamedMetric(self)
-        return super().__getattr__(attribute)
+    __slots__ = ()
+    schema = {
+        "name": (True, False),
+        "group": (True, False),
+        "node": (True, False),
+        "status": (False, True),
+        "metrics": (True, False),
+        "birth_timestamp": (False, True),
+        "death_timestamp": (False, True),
+    }
+
+    @property
+    def metric(self):
+        return NamedMetric(self)
 
 
 # A node that can be queried by name
@@ -153,56 +268,169 @@ class NamedNode(object):
 
 
 # A node that provides some fields to query
-# Gettable fields: name, group, status, devices, birth_timestamp, death_timestamp
-# Settable fields: status
+# Gettable fields: name, group, status, devices, birth_timestamp, death_timestamp, device
+# Settable fields: status, death_timestamp, birth_timestamp
 class Node(Queryable):
-    def __init__(self, id):
-        super().__init__("Node", id, {
-            "name": True, "group": True, "status": False, "devices": False,
-            "birth_timestamp": False, "death_timestamp": False, "device": False},
-            ["status", "death_timestamp", "birth_timestamp"])
+    __slots__ = ()
+    schema = {
+        "name": (True, False),
+        "group": (True, False),
+        "status": (False, True),
+        "devices": (False, False),
+        "birth_timestamp": (False, True),
+        "death_timestamp": (False, True),
+    }
 
-    def __getattr__(self, attribute):
-        if attribute == "device":
-            return NamedDevice(self)
-        return super().__getattr__(attribute)
+    @property
+    def device(self):
+        return NamedDevice(self)
 
 
 # A group that provides some fields to query
 # Gettable fields: name, nodes, devices, node
-# Settable fields: None
+# Settable fields: name
 class Group(Queryable):
-    def __init__(self, id):
-        super().__init__("Group", id, {
-            "name": True, "nodes": False, "devices": False, "node": False},
-            ["name"])
-
-    def __getattr__(self, attribute):
-        if attribute == "node":
-            return NamedNode(self)
-        return super().__getattr__(attribute)
+    __slots__ = ()
+    schema = {
+        "name": (True, True),
+        "nodes": (False, False),
+        "devices": (False, False),
+    }
+
+    @property
+    def node(self):
+        return NamedNode(self)
+
+
+SPECIAL_TYPES.update(
+    {"group": Group, "node": Node, "device": Device, "metric": Metric})
+
+
+# The hits and misses of the cached attributes of the objects, as
+# {"Device.name": (hits, misses)}
+def cache_stats():
+    return {cls.type_name + "." + name: (cls.__dict__[name].hits, cls.__dict__[name].misses)
+            for cls in SPECIAL_TYPES.values()
+            for name, (can_be_cached, _) in cls.schema.items() if can_be_cached}
+
+
+# Pick at most points rows of a time series with the
+# largest-triangle-three-buckets algorithm, which keeps the visual shape
+# of the series (peaks included) much better than averaging
+# rows -> iterable of (value, timestamp) in timestamp order
+# total -> the number of rows
+# Only two buckets of rows are held in memory at a time
+# Returns a list of (timestamp, value)
+def lttb(rows, total, points):
+    rows = iter(rows)
+    if total <= points:
+        return [(timestamp, value) for value, timestamp in rows]
+    if points < 3:
+        # only the first and, for two points, the last rows are kept
+        selected = [(timestamp, value) for value, timestamp in itertools.islice(rows, 1)]
+        last = None
+        for last in rows:
+            pass
+        if points == 2 and last is not None:
+            selected.append((last[1], last[0]))
+        return selected[:points]
+    # the first and last rows are always kept, the others are split
+    # into points - 2 buckets, bucket k ending at row
+    # k * (total - 2) // (points - 2) of them
+
+    def bucket(k):
+        size = k * (total - 2) // (points - 2) - \
+            (k - 1) * (total - 2) // (points - 2)
+        return [(timestamp, value) for value, timestamp in itertools.islice(rows, size)]
+
+    value, timestamp = next(rows)
+    selected = [(timestamp, value)]
+    current = bucket(1)
+    for k in range(1, points - 1):
+        if k < points - 2:
+            following = bucket(k + 1)
+        else:
+            value, timestamp = next(rows)
+            following = [(timestamp, value)]
+        # the point of this bucket forming the largest triangle with the
+        # previously selected point and the average of the next bucket
+        ax, ay = selected[-1]
+        cx = sum(p[0] for p in following) / len(following)
+        cy = sum(p[1] for p in following) / len(following)
+        selected.append(max(current, key=lambda p: abs(
+            (ax - cx) * (p[1] - ay) - (ax - p[0]) * (cy - ay))))
+        current = following
+    selected.append(current[0])
+    return selected
+
+
+# Downsampling methods supported by get_series
+SERIES_METHODS = ("bucket", "lttb")
+
+
+# Downsample the history of a metric to at most points (timestamp, value) rows
+# start, end -> optional inclusive timestamp bounds
+# method -> "bucket" averages equal time buckets in SQL,
+#           "lttb" streams the rows through the lttb function
+def get_series(metric_id, start=None, end=None, points=SERIES_POINTS, method="bucket"):
+    if method not in SERIES_METHODS:
+        raise ValueError("Invalid downsampling method: " + method)
+    if storage.get_value_table(metric_id) == "MetricString":
+        raise ValueError("Cannot downsample a string metric")
+    record_read(metric_key(metric_id))
+    if method == "bucket":
+        return storage.get_series(metric_id, start, end, points)
+    total = storage.count_values(metric_id, start, end)
+    return lttb(storage.iter_values(metric_id, start, end), total, points)
+
+
+# The (first, last) timestamps of the history of a metric, (None, None)
+# if it has no values
+def get_time_range(metric_id):
+    record_read(metric_key(metric_id))
+    return storage.get_time_range(metric_id)
+
+
+# Summarise the history of a metric in buckets of step seconds, as
+# (bucket, count, sum, min, max) rows, see storage.get_buckets
+def get_buckets(metric_id, start, end, step):
+    if storage.get_value_table(metric_id) == "MetricString":
+        raise ValueError("Cannot summarise a string metric")
+    record_read(metric_key(metric_id))
+    return storage.get_buckets(metric_id, start, end, step)
+
+
+# Name matching modes for the get_* functions
+# Without a mode, an exact match is tried first and a substring
+# search is done only if that finds nothing
+MATCH_EXACT = storage.MATCH_EXACT
+MATCH_PREFIX = storage.MATCH_PREFIX
+MATCH_SUBSTRING = storage.MATCH_SUBSTRING
 
 
 # Return a list of groups matching the given naming pattern
-def get_group(name) -> list[Group]:
-    groups = storage.get_group_by_name(name)
+def get_group(name, match=None) -> list[Group]:
+    record_read(TOPOLOGY_KEY)
+    groups = storage.get_group_by_name(name, match)
     if len(groups) == 0:
         raise ValueError("No such group found!")
     return [Group(group_id) for group_id in groups]
 
 
 # Return a list of nodes matching the given naming pattern
-def get_node(group_name, node_name) -> list[Node]:
-    nodes = storage.get_node_by_name(group_name, node_name)
+def get_node(group_name, node_name, match=None) -> list[Node]:
+    record_read(TOPOLOGY_KEY)
+    nodes = storage.get_node_by_name(group_name, node_name, match)
     if len(nodes) == 0:
         raise ValueError("No such node found!")
     return [Node(node_id) for node_id in nodes]
 
 
 # Return a list of devices matching the given naming pattern
-def get_device(group_name, node_name, device_name) -> list[Device]:
+def get_device(group_name, node_name, device_name, match=None) -> list[Device]:
+    record_read(TOPOLOGY_KEY)
     devices = storage.get_device_by_name(
-        group_name, node_name, device_name)
+        group_name, node_name, device_name, match)
     if len(devices) == 0:
         full_name = ""
         full_name += (group_name + "/") if group_name else ""
@@ -215,56 +443,71 @@ def get_device(group_name, node_name, device_name) -> list[Device]:
 
 # Return a list of all groups
 def get_groups() -> list[Group]:
+    record_read(TOPOLOGY_KEY)
     return [Group(group_id) for group_id in storage.get_all_groups()]
 
 
 # Return a list of all nodes
 def get_nodes() -> list[Node]:
+    record_read(TOPOLOGY_KEY)
     return [Node(node_id) for node_id in storage.get_all_nodes()]
 
 
 # Return a list of all devices
 def get_devices() -> list[Device]:
+    record_read(TOPOLOGY_KEY)
     return [Device(device_id) for device_id in storage.get_all_devices()]
 
 
-# Return a specific group, node, or device
-# If multiple matches are found, return a list of them
-def get(name):
+# Return the groups, nodes and devices matching name using the given
+# matching mode
+def find(name, match):
     value = []
     # If the name contains a slash, it is a group/node/device name
     if name.find("/") != -1:
         names = name.split("/")
         # If the name contains 3 slashes, it is a device name
         if len(names) == 3:
-            value = get_device(names[0], names[1], names[2])
+            try:
+                value = get_device(names[0], names[1], names[2], match)
+            except:
+                pass
         # If the name contains 2 slashes, it is a node/device name
         elif len(names) == 2:
             try:
-                value = get_device("", names[0], names[1])
+                value = get_device("", names[0], names[1], match)
             except:
                 pass
             try:
-                value += get_node(names[0], names[1])
+                value += get_node(names[0], names[1], match)
             except:
                 pass
     # If the name contains no slashes, it can be anything
     # So we try to find a group, node, or device with that name
     else:
-        values = []
         try:
-            values += get_device("", "", name)
+            value += get_device("", "", name, match)
         except:
             pass
         try:
-            values += get_node("", name)
+            value += get_node("", name, match)
         except:
             pass
         try:
-            values += get_group(name)
+            value += get_group(name, match)
         except:
             pass
-        value = values
+    return value
+
+
+# Return a specific group, node, or device
+# Exact name matches are preferred, a substring search is only done if
+# nothing matches exactly
+# If multiple matches are found, return a list of them
+def get(name):
+    value = find(name, MATCH_EXACT)
+    if len(value) == 0:
+        value = find(name, MATCH_SUBSTRING)
     if len(value) == 1:
         return value[0]
     elif len(value) > 1:
@@ -273,6 +516,76 @@ def get(name):
         raise ValueError("No such name: " + name)
 
 
+# Aggregate a metric across the fleet with a single query
+# func -> avg, min, max, sum or count
+# by -> group, node or device_type
+# window -> if given, aggregate every value of the last window seconds,
+#           otherwise only the latest value of each metric
+# value -> if given, only aggregate values equal to it
+# For example, aggregate("temperature", "avg", "group", 3600) or
+# aggregate("power", "count", "group", value=True)
+# Returns a dict of key -> result
+def aggregate(metric_name, func="avg", by="group", window=None, value=None) -> dict:
+    record_read(metric_name_key(metric_name))
+    record_read(TOPOLOGY_KEY)
+    return dict(storage.aggregate(metric_name, func, by, window, value))
+
+
+# Default number of rows fetched per page by the summary iterators
+PAGE_SIZE = 500
+
+# Default number of groups fetched per page by iter_topology
+TOPOLOGY_PAGE_GROUPS = 10
+
+
+# Iterate over the pages of a keyset paginated storage list query, so that
+# large fleets can be shown as they are read
+def iter_pages(func, page_size=PAGE_SIZE):
+    after_id = None
+    while True:
+        rows = func(after_id=after_id, limit=page_size)
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        after_id = rows[-1][0]
+
+
+# Iterate over pages of (id, name, node count, device count) group rows
+def group_summaries(page_size=PAGE_SIZE):
+    return iter_pages(storage.list_group_summaries, page_size)
+
+
+# Iterate over pages of (id, name, group, device count, status) node rows
+def node_summaries(page_size=PAGE_SIZE):
+    return iter_pages(storage.list_node_summaries, page_size)
+
+
+# Iterate over pages of (id, name, group, node, status) device rows
+def device_summaries(page_size=PAGE_SIZE):
+    return iter_pages(storage.list_device_summaries, page_size)
+
+
+# Iterate over the hierarchy of every group, a few groups per query
+# Yields the rows of one group at a time, see storage.list_topology
+def iter_topology(page_groups=TOPOLOGY_PAGE_GROUPS):
+    after_id = None
+    while True:
+        rows = storage.list_topology(after_id, page_groups)
+        if not rows:
+            return
+        for _, group_rows in itertools.groupby(rows, lambda row: row[0]):
+            yield list(group_rows)
+        after_id = rows[-1][0]
+
+
+# Get the latest value of every metric of the given devices with one query
+# Returns (metric_id, group, node, device, metric, type, value, timestamp,
+# device_id, device_status) rows
+def latest_values(devices):
+    return storage.latest_values(device_ids=[device.id for device in devices])
+
+
 # Create a new group, returns the new group
 def create_group(name):
     group_id = storage.insert_group(name)
@@ -309,6 +622,41 @@ def shutdown():
     storage.shutdown()
 
 
+# Subscribe to the values written to a metric, to the metrics of a device,
+# or to the metrics matching a glob path such as "group1/node0/*"
+# callback -> called as callback(metric, value, timestamp)
+# maxsize -> number of undelivered events kept before the oldest are dropped
+# coalesce -> if True, a slow subscriber only gets the latest value of each metric
+# inline -> if True, the callback runs on the write path and must never block
+# Returns the subscription, call close() on it to unsubscribe
+def subscribe(target, callback, maxsize=events.QUEUE_SIZE, coalesce=False, inline=False):
+    if isinstance(target, Metric):
+        target = ("metric", target.id)
+    elif isinstance(target, Device):
+        target = ("device", target.id)
+    elif not isinstance(target, str):
+        raise ValueError("Can only subscribe to a metric, a device or a path")
+    return events.subscribe(target, lambda metric_id, value, timestamp: callback(
+        Metric(metric_id), value, timestamp), maxsize, coalesce, inline)
+
+
+# Publish the writes done in this process to other processes
+def serve_events():
+    return events.serve()
+
+
+# Receive the writes done by the host process, so that subscriptions
+# in this process see them
+def connect_events():
+    events.connect()
+
+
+# Whether the writes of the host process are being received, i.e. whether
+# subscriptions in this process see every write
+def events_connected():
+    return events.CONNECTED.is_set()
+
+
 # The dictionary of functions that can be called from the 'expr'
 # in the CLI
 RUNTIME_DICT = {
@@ -321,6 +669,12 @@ RUNTIME_DICT = {
     "get_groups": get_groups,
     "get_nodes": get_nodes,
     "get_devices": get_devices,
+    "subscribe": subscribe,
+    "aggregate": aggregate,
+    "offline_devices": views.offline_devices,
+    "stale_metrics": views.stale_metrics,
+    "top_values": views.top_values,
+    "device_counts": views.device_counts,
     "Node": Node,
     "Group": Group,
     "Device": Device,
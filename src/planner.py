@@ -0,0 +1,308 @@
+import ast
+import statistics
+import model
+import storage
+
+# Planner for the expressions evaluated by the CLI
+#
+# Aggregates over metric histories and over a metric of every device are
+# rewritten into single SQL aggregates instead of loading every value into
+# Python. The shapes recognised are, with M any expression evaluating to a
+# Metric and AGG one of min, max, sum, len and statistics.mean:
+#
+#   min(M.values), max(M.values), len(M.values)
+#   AGG(v for v, t in M.values), AGG(x[0] for x in M.values)
+#   AGG(d.metric.X.value for d in get_devices())
+#
+# and the same with list comprehensions, or with the timestamps instead of
+# the values. M is evaluated while planning, so it cannot use the names
+# bound by the expression itself (comprehension and lambda variables,
+# walrus targets). Everything else is evaluated as is.
+
+
+# The aggregates that can be pushed down, as the storage aggregate function
+# they map to
+AGGREGATES = {"min": "min", "max": "max",
+              "sum": "sum", "len": "count", "mean": "avg"}
+
+
+# Raise the error the Python aggregate raises for an empty sequence
+def empty_error(name):
+    if name == "mean":
+        raise statistics.StatisticsError(
+            "mean requires at least one data point")
+    raise ValueError(name + "() arg is an empty sequence")
+
+
+# Raised when a subexpression to evaluate while planning uses a name bound
+# by the expression itself, which only has a value while it runs
+class BoundName(Exception):
+    pass
+
+
+# The names bound by assignment targets
+def target_names(targets):
+    return {node.id for target in targets for node in ast.walk(target)
+            if isinstance(node, ast.Name)}
+
+
+# One aggregate call rewritten into a SQL query
+# keys -> the keys of the data the query reads, see model.track_reads
+class Pushdown:
+
+    def __init__(self, source, name, query, args, keys, rows=False):
+        self.source = source
+        self.name = name
+        self.query = query
+        self.args = args
+        self.keys = keys
+        self.rows = rows
+
+    # Run the query, with the result and errors the Python aggregate
+    # would have
+    def run(self):
+        for key in self.keys:
+            model.record_read(key)
+        result = storage.execute_query(self.query, self.args)
+        if self.rows:
+            if not result:
+                empty_error(self.name)
+            return tuple(result[0])
+        count, value = result[0]
+        if count == 0:
+            if self.name in ("sum", "len"):
+                return 0
+            empty_error(self.name)
+        return count if self.name == "len" else value
+
+
+# An expression with the aggregate calls that could be pushed down
+# replaced by calls to their Pushdown
+class Plan:
+
+    def __init__(self, expr, namespace):
+        self.expr = expr
+        self.namespace = namespace
+        self.pushdowns = []
+        self.fallbacks = []  # (source, reason) of the aggregates left to eval
+        self.code = None
+
+    # Describe how the expression is evaluated, one line per aggregate
+    def explain(self) -> list[str]:
+        lines = []
+        for pushdown in self.pushdowns:
+            lines.append("pushdown: " + pushdown.source)
+            lines.append("    SQL: " + pushdown.query +
+                         " " + str(list(pushdown.args)))
+        for source, reason in self.fallbacks:
+            lines.append("eval: " + source + " (" + reason + ")")
+        if not lines:
+            lines.append("eval: no aggregate to push down")
+        return lines
+
+    def run(self):
+        if self.code is None:
+            return eval(self.expr, self.namespace)
+        namespace = dict(self.namespace)
+        for index, pushdown in enumerate(self.pushdowns):
+            namespace["__pushdown_" + str(index)] = pushdown.run
+        return eval(self.code, namespace)
+
+
+# Rewrites the aggregate calls of an expression, see plan()
+class Rewriter(ast.NodeTransformer):
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.bound = []  # the sets of names bound by the enclosing scopes
+
+    def is_bound(self, name):
+        return any(name in names for names in self.bound)
+
+    # Visit a node with names bound while it is visited
+    def visit_scope(self, node, names):
+        self.bound.append(names)
+        try:
+            return self.generic_visit(node)
+        finally:
+            self.bound.pop()
+
+    # Walrus targets may be bound anywhere in the expression
+    def visit_Expression(self, node):
+        return self.visit_scope(node, target_names(
+            [item.target for item in ast.walk(node) if isinstance(item, ast.NamedExpr)]))
+
+    def visit_GeneratorExp(self, node):
+        return self.visit_scope(node, target_names(
+            [generator.target for generator in node.generators]))
+
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp
+
+    def visit_Lambda(self, node):
+        args = node.args
+        arguments = args.posonlyargs + args.args + args.kwonlyargs + \
+            [arg for arg in (args.vararg, args.kwarg) if arg is not None]
+        return self.visit_scope(node, {arg.arg for arg in arguments})
+
+    def visit_Call(self, node):
+        name = self.aggregate_name(node)
+        if name is None:
+            return self.generic_visit(node)
+        source = ast.get_source_segment(self.plan.expr, node) or name
+        try:
+            pushdown = self.match(node, name, source)
+        except BoundName as e:
+            pushdown, reason = None, str(e)
+        except Exception as e:
+            # the metric could not be found, or is not a metric
+            pushdown = None
+            reason = str(e.__class__.__name__) + ": " + str(e)
+        else:
+            reason = "not a supported shape"
+        if isinstance(pushdown, str):
+            pushdown, reason = None, pushdown
+        if pushdown is None:
+            self.plan.fallbacks.append((source, reason))
+            return self.generic_visit(node)
+        call = ast.Call(func=ast.Name(id="__pushdown_" + str(len(self.plan.pushdowns)), ctx=ast.Load()),
+                        args=[], keywords=[])
+        self.plan.pushdowns.append(pushdown)
+        return ast.copy_location(call, node)
+
+    # The name of the aggregate called by node, if it is one that can be
+    # pushed down and it is not shadowed by a variable
+    def aggregate_name(self, node):
+        if len(node.args) != 1 or node.keywords:
+            return None
+        func = node.func
+        if isinstance(func, ast.Name) and func.id in ("min", "max", "sum", "len"):
+            if func.id not in self.plan.namespace and not self.is_bound(func.id):
+                return func.id
+        elif isinstance(func, ast.Attribute) and func.attr == "mean" and isinstance(func.value, ast.Name):
+            if self.plan.namespace.get(func.value.id) is statistics and not self.is_bound(func.value.id):
+                return "mean"
+        return None
+
+    # Evaluate a subexpression that does not depend on the rest
+    # Raises BoundName if it uses a name bound by the expression
+    def evaluate(self, node):
+        for item in ast.walk(node):
+            if isinstance(item, ast.Name) and self.is_bound(item.id):
+                raise BoundName("uses " + item.id +
+                                ", which is bound by the expression")
+        return eval(compile(ast.Expression(body=node), "<expr>", "eval"), self.plan.namespace)
+
+    # Match the argument of an aggregate call against the supported shapes
+    # Returns a Pushdown, None or the reason why it cannot be pushed down
+    def match(self, node, name, source):
+        arg = node.args[0]
+        func = AGGREGATES[name]
+        # min/max/len(M.values)
+        if self.is_values(arg):
+            if name not in ("min", "max", "len"):
+                return "the values are (value, timestamp) tuples"
+            metric = self.metric(arg.value)
+            query, args = storage.history_aggregate_query(
+                metric.id, func, rows=name != "len")
+            return Pushdown(source, name, query, args, [model.metric_key(metric.id)], rows=name != "len")
+        if not isinstance(arg, (ast.GeneratorExp, ast.ListComp)):
+            return None
+        if name == "len" and isinstance(arg, ast.GeneratorExp):
+            return None
+        if len(arg.generators) != 1:
+            return None
+        generator = arg.generators[0]
+        if generator.ifs or generator.is_async:
+            return None
+        # AGG(v for v, t in M.values)
+        if self.is_values(generator.iter):
+            column = self.history_column(generator.target, arg.elt)
+            if column is None:
+                return None
+            metric = self.metric(generator.iter.value)
+            if column == "metric_value" and name in ("sum", "mean") and metric.type == "string":
+                return "string values"
+            query, args = storage.history_aggregate_query(
+                metric.id, func, column)
+            return Pushdown(source, name, query, args, [model.metric_key(metric.id)])
+        # AGG(d.metric.X.value for d in get_devices())
+        if self.is_get_devices(generator.iter):
+            match = self.device_metric(generator.target, arg.elt)
+            if match is None:
+                return None
+            metric_name, column = match
+            model.record_read(model.TOPOLOGY_KEY)
+            devices, with_metric, metrics, latest, types, type = storage.metric_name_summary(
+                metric_name)
+            if not (devices == with_metric == metrics == latest):
+                return "not every device has one " + metric_name + " metric with a value"
+            if column == "metric_value":
+                if types > 1:
+                    return "mixed metric types"
+                if name in ("sum", "mean") and type == "string":
+                    return "string values"
+            query, args = storage.latest_aggregate_query(
+                metric_name, func, column)
+            return Pushdown(source, name, query, args, [model.metric_name_key(metric_name), model.TOPOLOGY_KEY])
+        return None
+
+    def is_values(self, node):
+        return isinstance(node, ast.Attribute) and node.attr == "values"
+
+    def is_get_devices(self, node):
+        return (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.args and not node.keywords
+                and self.plan.namespace.get(node.func.id) is model.get_devices and not self.is_bound(node.func.id))
+
+    def metric(self, node):
+        metric = self.evaluate(node)
+        if not isinstance(metric, model.Metric):
+            raise TypeError("not a metric")
+        return metric
+
+    # The value table column selected by elt for the (value, timestamp)
+    # tuples bound to target, if any
+    def history_column(self, target, elt):
+        if isinstance(target, ast.Tuple) and len(target.elts) == 2 and isinstance(elt, ast.Name):
+            names = [item.id if isinstance(item, ast.Name) else None
+                     for item in target.elts]
+            if elt.id == names[0] and names[1] != elt.id:
+                return "metric_value"
+            if elt.id == names[1] and names[0] != elt.id:
+                return "metric_timestamp"
+        if isinstance(target, ast.Name) and isinstance(elt, ast.Subscript):
+            if isinstance(elt.value, ast.Name) and elt.value.id == target.id and isinstance(elt.slice, ast.Constant):
+                if elt.slice.value in (0, 1) and not isinstance(elt.slice.value, bool):
+                    return storage.VALUE_COLUMNS[elt.slice.value]
+        return None
+
+    # The (metric name, column) selected by elt for the device bound to
+    # target, i.e. d.metric.X.value or d.metric.X.timestamp, if any
+    def device_metric(self, target, elt):
+        if not isinstance(target, ast.Name) or not isinstance(elt, ast.Attribute):
+            return None
+        if elt.attr not in ("value", "timestamp"):
+            return None
+        metric = elt.value
+        if not isinstance(metric, ast.Attribute) or not isinstance(metric.value, ast.Attribute):
+            return None
+        named = metric.value
+        if named.attr != "metric" or not isinstance(named.value, ast.Name) or named.value.id != target.id:
+            return None
+        return metric.attr, "metric_value" if elt.attr == "value" else "metric_timestamp"
+
+
+# Plan the evaluation of an expression against namespace
+# The metrics the aggregates are over are looked up while planning, the
+# SQL aggregates only run with the plan
+def plan(expr, namespace) -> Plan:
+    result = Plan(expr, namespace)
+    try:
+        tree = ast.parse(expr, mode="eval")
+    except SyntaxError:
+        # let eval report it
+        return result
+    tree = Rewriter(result).visit(tree)
+    if result.pushdowns:
+        result.code = compile(ast.fix_missing_locations(
+            tree), "<expr>", "eval")
+    return result
@@ -1,13 +1,30 @@
+import argparse
+import cProfile
 import cmd
+import csv
+import itertools
+import json
+import os
+import pstats
+import sys
 import time
+import accounting
+import chart
+import definitions
 import model
-import re
-from rich import print, pretty
-from rich.console import Console
-from rich.table import Table
-from rich.tree import Tree
-from rich.text import Text
-from rich.live import Live
+import threading
+import views
+import types
+try:
+    from rich import print, pretty
+    from rich.console import Console
+    from rich.table import Table
+    from rich.tree import Tree
+    from rich.text import Text
+    from rich.live import Live
+except ImportError:
+    # only the interactive REPL needs rich, the batch mode runs without it
+    Console = None
 
 
 # Convert a unix time difference to a string
@@ -31,6 +48,257 @@ def create_table(cols, header_style=None, show_header=True):
     return table
 
 
+# Format a metric value for display
+def format_value(type, value):
+    if value is None:
+        return "-"
+    if type == "string":
+        return "'" + value + "'"
+    elif type == "boolean":
+        return str(bool(value)).lower()
+    elif type == "float":
+        return "{:.2f}".format(value)
+    return str(value)
+
+
+# Split a [[group/]node/]device name into (group, node, device)
+def parse_device_name(name):
+    parts = name.split("/")
+    if len(parts) == 3:
+        return parts[0], parts[1], parts[2]
+    elif len(parts) == 2:
+        return None, parts[0], parts[1]
+    return None, None, parts[0]
+
+
+# Default number of times per second the watch view is updated
+WATCH_RATE = 10
+
+# Seconds between polls of the latest values while the writes of the host
+# are pushed to the watch view
+WATCH_POLL_INTERVAL = 1
+
+
+# The state of the devices shown by the watch and get device commands
+# The devices and their metrics are resolved once. The latest values are
+# pushed by subscriptions while the writes of the host are received, and
+# polled for all watched devices with a single query otherwise. Only the
+# cells that changed are formatted again, and the table is only rebuilt
+# when one of them did.
+class DeviceWatch:
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.info = {}  # device_id -> (name, group, node)
+        self.statuses = {}  # device_id -> status
+        self.metric_ids = {}  # device_id -> list of metric ids
+        self.metric_info = {}  # metric_id -> (name, type)
+        self.latest = {}  # metric_id -> (value, timestamp)
+        self.cells = {}  # metric_id -> [value text, updated text]
+        self.pushed = {}  # metric_id -> (value, timestamp), from the subscriptions
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.changed = True
+        self.poll()
+        for device in devices:
+            # devices without metrics are not returned by the poll
+            if device.id not in self.info:
+                self.info[device.id] = (
+                    device.name, device.group.name, device.node.name)
+                self.statuses[device.id] = device.status
+                self.metric_ids[device.id] = []
+
+    # Receive the values written to the watched devices as they arrive
+    def subscribe(self):
+        for device in self.devices:
+            self.subscriptions.append(model.subscribe(
+                device, self.on_value, inline=True))
+
+    # Called from the write path, so only records the value
+    def on_value(self, metric, value, timestamp):
+        with self.lock:
+            self.pushed[metric.id] = (value, timestamp)
+
+    # Read the latest values and statuses of all devices with one query
+    def poll(self):
+        for row in model.latest_values(self.devices):
+            metric_id, group, node, device, name, type, value, timestamp, device_id, status = row
+            if device_id not in self.info:
+                self.info[device_id] = (device, group, node)
+                self.metric_ids[device_id] = []
+            if metric_id not in self.metric_info:
+                self.metric_info[metric_id] = (name, type)
+                self.metric_ids[device_id].append(metric_id)
+            if self.statuses.get(device_id) != status:
+                self.statuses[device_id] = status
+                self.changed = True
+            self.set_value(metric_id, value, timestamp)
+
+    def set_value(self, metric_id, value, timestamp):
+        old = self.latest.get(metric_id)
+        if old is not None:
+            if old == (value, timestamp):
+                return
+            # a pushed value may be older than the one polled meanwhile
+            if old[1] is not None and timestamp is not None and timestamp < old[1]:
+                return
+        self.latest[metric_id] = (value, timestamp)
+        self.cells[metric_id] = [format_value(self.metric_info[metric_id][1], value),
+                                 self.format_age(timestamp)]
+        self.changed = True
+
+    def format_age(self, timestamp):
+        return "-" if timestamp is None else unix_time_diff_to_string(timestamp)
+
+    # Update the "Updated" cells, which change as time passes
+    def refresh_ages(self):
+        for metric_id, (_, timestamp) in self.latest.items():
+            age = self.format_age(timestamp)
+            if self.cells[metric_id][1] != age:
+                self.cells[metric_id][1] = age
+                self.changed = True
+
+    # Apply the pushed values, polling the database if asked to
+    def update(self, poll):
+        with self.lock:
+            pushed, self.pushed = self.pushed, {}
+        for metric_id, (value, timestamp) in pushed.items():
+            if metric_id in self.metric_info:
+                self.set_value(metric_id, value, timestamp)
+        if poll:
+            self.poll()
+            self.refresh_ages()
+
+    # Build the table from the formatted cells
+    def render(self):
+        self.changed = False
+        table = create_table(["ID", "Name", "Group", "Node", "Status",
+                              "Metric", "Value", "Updated"], "bold magenta")
+        for device in self.devices:
+            name, group, node = self.info[device.id]
+            row = [str(device.id), name, group, node,
+                   str(self.statuses[device.id])]
+            metric_ids = self.metric_ids[device.id]
+            if not metric_ids:
+                table.add_row(*row, "", "", "")
+            for metric_id in metric_ids:
+                table.add_row(*row, self.metric_info[metric_id][0],
+                              *self.cells[metric_id])
+                # only the first row of a device shows its details
+                row = [""] * 5
+            table.add_section()
+        return table
+
+    def close(self):
+        for subscription in self.subscriptions:
+            subscription.close()
+        self.subscriptions = []
+
+
+# Rows of text of a plot
+PLOT_HEIGHT = 10
+
+# Characters of a plot in batch mode, where the terminal width is unknown
+PLOT_WIDTH = 100
+
+# Suffixes of the plot windows, as seconds
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+# Parse a duration such as 90, 90s, 15m, 6h, 7d or 2w into seconds
+def parse_duration(text):
+    unit = DURATION_UNITS.get(text[-1:])
+    try:
+        seconds = float(text[:-1]) * unit if unit else float(text)
+    except ValueError:
+        raise ValueError("Invalid window: " + text)
+    if not seconds > 0:
+        raise ValueError("Invalid window: " + text)
+    return seconds
+
+
+# The history of a metric summarised in one bucket per column of a plot
+# The buckets are read with one aggregate query, so only as many rows as
+# there are columns are fetched however long the history is. A live plot
+# only reads the buckets from the last one on again, and drops the ones
+# that slid out of the window.
+# end -> the end of the plotted window, None to follow the current time
+class MetricPlot:
+
+    def __init__(self, metric, window, columns, end=None):
+        self.metric = metric
+        self.window = window
+        self.columns = columns
+        self.step = window / columns
+        self.end = end
+        self.buckets = {}  # bucket -> (count, sum, min, max)
+        self.first = None  # the first bucket shown
+        self.changed = False
+        self.subscription = None
+        self.written = threading.Event()
+        self.update()
+
+    # Follow the writes to the metric, see wait_for_write
+    def subscribe(self):
+        self.subscription = model.subscribe(
+            self.metric, lambda metric, value, timestamp: self.written.set(), inline=True)
+
+    # Whether the metric was written since the last call
+    def was_written(self):
+        if self.written.is_set():
+            self.written.clear()
+            return True
+        return False
+
+    def last_bucket(self):
+        return int((time.time() if self.end is None else self.end) / self.step)
+
+    # Whether the window slid to another bucket since the last update
+    def slid(self):
+        return self.last_bucket() - self.columns + 1 != self.first
+
+    # Read the buckets from the last one read on, and drop the ones that
+    # are no longer in the window
+    def update(self):
+        last = self.last_bucket()
+        first = last - self.columns + 1
+        if first != self.first:
+            self.first = first
+            self.buckets = {bucket: row for bucket, row in self.buckets.items() if bucket >= first}
+            self.changed = True
+        start = max(max(self.buckets, default=first), first)
+        for bucket, *row in model.get_buckets(self.metric.id, start * self.step, (last + 1) * self.step, self.step):
+            if first <= bucket <= last and self.buckets.get(bucket) != tuple(row):
+                self.buckets[bucket] = tuple(row)
+                self.changed = True
+
+    # The (timestamp, count, mean, min, max) rows of the buckets
+    def rows(self):
+        return [(bucket * self.step, count, total / count, low, high)
+                for bucket, (count, total, low, high) in sorted(self.buckets.items())]
+
+    def render(self, height) -> list[str]:
+        self.changed = False
+        columns = []
+        for bucket in range(self.first, self.first + self.columns):
+            row = self.buckets.get(bucket)
+            columns.append(None if row is None else (row[2], row[3]))
+        return chart.render(columns, height, self.first * self.step,
+                            (self.first + self.columns) * self.step)
+
+    def close(self):
+        if self.subscription is not None:
+            self.subscription.close()
+            self.subscription = None
+
+
+# Statements shown by timeit and profile, the ones taking the most time
+TOP_STATEMENTS = 5
+
+# Python functions shown by profile, the ones taking the most time
+TOP_FUNCTIONS = 15
+
+
 # Base class for the REPL
 class SparkplugREPL(cmd.Cmd):
 
@@ -38,6 +306,7 @@ class SparkplugREPL(cmd.Cmd):
         cmd.Cmd.__init__(self)
         self.prompt = "=> "
         self.console = Console()
+        self.definitions = definitions.Definitions(model.RUNTIME_DICT)
         pretty.install()
 
     # Exit the REPL
@@ -54,6 +323,34 @@ exit
         self.console.print("Try [b]'help " + command +
                            "'[/b] for more information.")
 
+    # Show the exception raised by an expression
+    def show_exception(self, e, command):
+        print(str(e.__class__.__name__) + ":", e)
+        self.show_error("Error in expression", command)
+
+    # Show the result of an expression
+    def show_result(self, result):
+        # Stream lazy results (e.g. metric.iter_values()) row by row
+        # instead of collecting them first
+        if isinstance(result, types.GeneratorType):
+            for item in result:
+                self.console.print(item)
+        else:
+            self.console.print(result)
+
+    # Show lines of plain text
+    def show_lines(self, lines):
+        for line in lines:
+            self.console.print(line, markup=False, highlight=False)
+
+    # Show a table of rows
+    def show_table(self, title, cols, rows):
+        table = create_table(cols, "bold magenta")
+        table.title = title
+        for row in rows:
+            table.add_row(*[Text(str(cell)) for cell in row])
+        self.console.print(table)
+
     # Print a formatted help text for a command
 
     def print_help_text(self, text):
@@ -82,76 +379,74 @@ exit
     def help_expr(self):
         self.print_help_text(self.do_expr.__doc__)
 
+    def help_explain(self):
+        self.print_help_text(self.do_explain.__doc__)
+
     def help_assign(self):
         self.print_help_text(self.do_assign.__doc__)
 
-    # List all groups in the system
-    def list_groups(self):
-        groups = model.get_groups()
+    def help_view(self):
+        self.print_help_text(self.do_view.__doc__)
+
+    def help_plot(self):
+        self.print_help_text(self.do_plot.__doc__)
+
+    def help_timeit(self):
+        self.print_help_text(self.do_timeit.__doc__)
+
+    def help_profile(self):
+        self.print_help_text(self.do_profile.__doc__)
+
+    # Print the pages of a summary iterator as tables, each page as soon
+    # as it is read, so that large fleets appear incrementally
+    def print_pages(self, cols, pages):
+        for rows in pages:
+            table = create_table(cols, "bold magenta")
+            for row in rows:
+                table.add_row(*[str(cell) for cell in row])
+            self.console.print(table)
+
+    # List the defined variables
+    def list_definitions(self):
         table = create_table(
-            ["ID", "Name", "Edge nodes", "Devices"], "bold magenta")
-        for group in groups:
-            nodes = len(group.nodes)
-            devices = len(group.devices)
-            table.add_row(str(group.id), group.name, str(nodes), str(devices))
+            ["Name", "Expression", "TTL", "Reused", "Evaluated", "Cached"], "bold magenta")
+        for name, source, ttl, hits, misses, fresh in self.definitions.stats():
+            table.add_row(name, Text(source), "-" if ttl is None else str(ttl),
+                          str(hits), str(misses), "yes" if fresh else "no")
         self.console.print(table)
 
+    # List all groups in the system
+    def list_groups(self):
+        self.print_pages(["ID", "Name", "Edge nodes", "Devices"],
+                         model.group_summaries())
+
     # List all nodes in the system
     def list_nodes(self):
-        nodes = model.get_nodes()
-        table = create_table(
-            ["ID", "Name", "Group", "Devices", "Status"], "bold magenta")
-        for node in nodes:
-            group = node.group.name
-            devices = len(node.devices)
-            table.add_row(str(node.id), node.name,
-                          group, str(devices), node.status)
-        self.console.print(table)
+        self.print_pages(["ID", "Name", "Group", "Devices", "Status"],
+                         model.node_summaries())
 
     # List all devices in the system
     def list_all_devices(self):
-        devices = model.get_devices()
-        table = create_table(
-            ["ID", "Name", "Group", "Node", "Status"], "bold magenta")
-        for device in devices:
-            node = device.node.name
-            group = device.group.name
-            table.add_row(str(device.id), device.name,
-                          str(group), str(node), device.status)
-        self.console.print(table)
+        self.print_pages(["ID", "Name", "Group", "Node", "Status"],
+                         model.device_summaries())
 
     # Generate a detailed overview of a device
+    # The devices are hydrated with one query, see DeviceWatch
     def generate_device_details(self, device):
-        parts = device[0].split("/")
-        group, node, device = None, None, None
-        if len(parts) == 3:
-            group, node, device = parts
-        elif len(parts) == 2:
-            node, device = parts
-        else:
-            device = parts[0]
-        devices = model.get_device(group, node, device)
+        devices = model.get_device(*parse_device_name(device[0]))
+        details = DeviceWatch(devices)
         table = create_table(["ID", "Name", "Group", "Node", "Status",
                              "Metrics (Name, Value, Last Updated)"], "bold magenta")
         for device in devices:
-            node = device.node.name
-            group = device.group.name
-            metrics = device.metrics
+            name, group, node = details.info[device.id]
             metrics_table = create_table(
                 ["Name", "Value", "Updated"], show_header=False)
-            for metric in metrics:
-                value = metric.value
-                if metric.type == "string":
-                    value = "'" + value + "'"
-                elif metric.type == "boolean":
-                    value = str(value).lower()
-                elif metric.type == "float":
-                    value = "{:.2f}".format(value)
-                metrics_table.add_row(metric.name, str(metric.value),
-                                      unix_time_diff_to_string(metric.timestamp))
+            for metric_id in details.metric_ids[device.id]:
+                metrics_table.add_row(details.metric_info[metric_id][0],
+                                      *details.cells[metric_id])
                 metrics_table.add_section()
-            table.add_row(str(device.id), device.name,
-                          str(group), str(node), device.status, metrics_table)
+            table.add_row(str(device.id), name, group, node,
+                          str(details.statuses[device.id]), metrics_table)
             table.add_section()
         return table
 
@@ -163,25 +458,31 @@ exit
             self.list_all_devices()
 
     # List the system topology
+    # Each group is printed as soon as its rows are read
     def list_all(self):
-        groups = model.get_groups()
-        for group in groups:
+        for rows in model.iter_topology():
             branch_group = Tree(
-                Text(group.name, style="bold blue"), guide_style="bold blue")
-            nodes = group.nodes
-            for node in nodes:
-                branch_node = branch_group.add(
-                    Text(node.name, style="bold green"), guide_style="bold green")
-                devices = node.devices
-                for device in devices:
+                Text(rows[0][1], style="bold blue"), guide_style="bold blue")
+            branch_node, branch_device = None, None
+            node_id, device_id = None, None
+            for _, _, row_node_id, node_name, row_device_id, device_name, metric_id, metric_name, metric_type, value, timestamp in rows:
+                if row_node_id is None:
+                    continue
+                if row_node_id != node_id:
+                    node_id = row_node_id
+                    branch_node = branch_group.add(
+                        Text(node_name, style="bold green"), guide_style="bold green")
+                if row_device_id is None:
+                    continue
+                if row_device_id != device_id:
+                    device_id = row_device_id
                     branch_device = branch_node.add(
-                        Text(device.name, style="bold white") + " (id=" + str(device.id) + ")", guide_style="bold white")
-                    metrics = device.metrics
-                    for metric in metrics:
-                        metric_label = Text(metric.name + " (type=" + metric.type + (", value=" + str(
-                            metric.value) + ", timestamp=" + str(metric.timestamp) + ")"))
-                        branch_device.add(
-                            metric_label, guide_style="tree.line")
+                        Text(device_name, style="bold white") + " (id=" + str(device_id) + ")", guide_style="bold white")
+                if metric_id is None:
+                    continue
+                metric_label = Text(metric_name + " (type=" + metric_type + (", value=" + str(
+                    value) + ", timestamp=" + str(timestamp) + ")"))
+                branch_device.add(metric_label, guide_style="tree.line")
             self.console.print(branch_group)
 
     # Geet information about a specific group, node or device
@@ -210,37 +511,185 @@ If there are multiple matches for a name, all of them will be listed.
         else:
             self.list_all()
 
-    # Watch a specific device for live changes
+    # Watch devices for live changes
     def do_watch(self, line):
         """
-Watch a specific device for live changes.
-watch <device_name>
-If multiple devices match the name, all of them will be watched.
+Watch devices for live changes.
+watch <device_name> [<device_name> ...] [--rate <updates per second>]
+If multiple devices match a name, all of them will be watched.
+The view is updated up to 10 times per second by default.
 Press Ctrl+C to exit the live view.
         """
-        if line == "":
+        parts = line.split()
+        rate = WATCH_RATE
+        if "--rate" in parts:
+            index = parts.index("--rate")
+            try:
+                rate = float(parts[index + 1])
+                if rate <= 0:
+                    raise ValueError()
+            except (IndexError, ValueError):
+                self.show_error("Invalid rate", "watch")
+                return
+            del parts[index:index + 2]
+        if len(parts) == 0:
             self.show_error("No device name provided", "watch")
             return
-        with Live(self.generate_device_details([line]), refresh_per_second=1) as live:
+        try:
+            devices = []
+            for name in parts:
+                devices += model.get_device(*parse_device_name(name))
+        except ValueError as e:
+            self.show_error(str(e), "watch")
+            return
+        watch = DeviceWatch(devices)
+        watch.subscribe()
+        last_poll = time.monotonic()
+        with Live(watch.render(), console=self.console, auto_refresh=False) as live:
             while True:
                 try:
-                    time.sleep(1)
-                    live.update(self.generate_device_details([line]))
+                    time.sleep(1 / rate)
+                    # pushed values are only complete while connected
+                    # to the host, otherwise poll on every update
+                    now = time.monotonic()
+                    poll = not model.events_connected() or now - last_poll >= WATCH_POLL_INTERVAL
+                    if poll:
+                        last_poll = now
+                    watch.update(poll)
+                    if watch.changed:
+                        live.update(watch.render(), refresh=True)
                 except KeyboardInterrupt:
                     break
+        watch.close()
 
+    # Show a predefined view
+    def do_view(self, line):
+        """
+Show a predefined view of the fleet.
+view [<view_name> [<argument> ...]]
+The views are kept up to date as the values arrive, so they are shown
+without reading the whole fleet again:
+    view offline                    devices that are not online
+    view stale [seconds]            metrics without a value for 300 seconds
+                                    or the given number, oldest first
+    view top [metric] [count]       the 10 or count metrics of a name with
+                                    the highest values, temperature by default
+    view counts                     devices and online devices per group
+Use 'view' alone to list the views. They can also be read in expressions,
+with offline_devices(), stale_metrics(seconds), top_values(metric, count)
+and device_counts().
+        """
+        parts = line.split()
+        if len(parts) == 0:
+            self.show_table("Views", ["Name", "Description", "Columns"],
+                            [[name, view.description, ", ".join(view.columns)] for name, view in views.VIEWS.items()])
+            return
+        view = views.VIEWS.get(parts[0])
+        if view is None:
+            self.show_error("Unknown view " + parts[0], "view")
+            return
+        try:
+            rows = view.read(*parts[1:])
+        except ValueError as e:
+            self.show_error(str(e), "view")
+            return
+        self.show_table(None, view.columns, rows)
+
+    # The number of characters a plot can be wide
+    def plot_width(self):
+        return max(self.console.width - chart.LABEL_WIDTH - 1, 10)
+
+    # Show a plot, updating it as the metric is written if live
+    def show_plot(self, plot, title, height, live):
+        lines = plot.render(height)
+        if not live:
+            self.console.print(title, style="bold magenta")
+            self.show_lines(lines)
+            return
+        plot.subscribe()
+        last_poll = time.monotonic()
+
+        def renderable(lines):
+            return Text(title + "\n", style="bold magenta") + Text("\n".join(lines))
+        with Live(renderable(lines), console=self.console, auto_refresh=False) as view:
+            while True:
+                try:
+                    time.sleep(1 / WATCH_RATE)
+                    # writes are only seen while connected to the host,
+                    # otherwise poll every interval
+                    now = time.monotonic()
+                    if (plot.was_written() or plot.slid() or not model.events_connected()
+                            and now - last_poll >= WATCH_POLL_INTERVAL):
+                        last_poll = now
+                        plot.update()
+                    if plot.changed:
+                        view.update(renderable(plot.render(height)), refresh=True)
+                except KeyboardInterrupt:
+                    break
+        plot.close()
+
+    # Plot the history of a metric
+    def do_plot(self, line):
+        """
+Plot the history of a metric.
+plot [--live] [--height <rows>] <device_name> <metric_name> [window]
+The window is the time span to plot up to now, in seconds or with a
+unit such as 30m, 6h, 7d or 2w. Without it, the whole history is
+plotted. The history is summarised in the database into one bucket per
+column of the chart, so plotting months of values only reads as many
+rows as the terminal is wide. Each column shows the lowest and highest
+values of its bucket, so short spikes are not averaged away.
+With --live, the plot follows the current time and is updated as
+values arrive. Press Ctrl+C to exit the live view.
+For example,
+    plot group1/node0/device1 temperature 6h
+        """
+        parts = line.split()
+        live = "--live" in parts
+        if live:
+            parts.remove("--live")
+        height = PLOT_HEIGHT
+        if "--height" in parts:
+            index = parts.index("--height")
+            try:
+                height = int(parts[index + 1])
+                if height <= 0:
+                    raise ValueError()
+            except (IndexError, ValueError):
+                self.show_error("Invalid height", "plot")
+                return
+            del parts[index:index + 2]
+        if len(parts) < 2 or len(parts) > 3:
+            self.show_error("A device and a metric are required", "plot")
+            return
+        try:
+            devices = model.get_device(*parse_device_name(parts[0]))
+            if len(devices) != 1:
+                raise ValueError(str(len(devices)) + " devices match " + parts[0])
+            metric = getattr(devices[0].metric, parts[1])
+            columns = self.plot_width() * 2
+            end = None
+            if len(parts) == 3:
+                window = parse_duration(parts[2])
+            else:
+                first, last = model.get_time_range(metric.id)
+                if first is None:
+                    raise ValueError("No values for " + parts[1])
+                # the whole history, up to now if live
+                end = None if live else last + 1
+                window = max((time.time() if live else last + 1) - first, columns)
+            plot = MetricPlot(metric, window, columns, end)
+        except (ValueError, AttributeError) as e:
+            self.show_error(str(e), "plot")
+            return
+        title = parts[0] + " " + parts[1]
+        self.show_plot(plot, title, height, live)
+
+    # Evaluate an expression, pushing its aggregates down to the database
+    # where possible (see planner.py) and using the memoized values of the
+    # defined variables (see definitions.py)
     def eval_expr(self, expr):
-        # extract all @[a-zA-Z][a-zA-Z_0-9]* parts and replace
-        # them with the corresponding value from runtime_dict
-        # e.g. @a + @b will be replaced with 1 + 2
-        # if runtime_dict = {"a": 1, "b": 2}
-        values = re.findall(r'@[a-zA-Z][a-zA-Z_0-9]*', expr)
-        for value in values:
-            ident = value[1:]
-            if ident not in model.RUNTIME_DICT:
-                raise Exception("Identifier not defined: " + ident)
-            expr = expr.replace(value, str(model.RUNTIME_DICT[ident]))
-        return eval(expr, model.RUNTIME_DICT)
+        return self.definitions.evaluate(expr)
 
     # Evaluate an expression
     def do_expr(self, line):
@@ -255,16 +704,157 @@ To retrieve a specific device/node/group, use get("group1/node0/device1").
 You can apply any transformation to the list of devices, nodes or groups.
 For example,
     expr max(get("group1/node0/device1").metric.temperature.values)
+To stream a long history without loading it at once, use iter_values(),
+optionally bounded by start and end timestamps.
+For example,
+    expr get("group1/node0/device1").metric.temperature.iter_values(start=1700000000)
         """
         if line == "":
             self.show_error("No expression provided", "expr")
             return
         try:
-            e = self.eval_expr(line)
-            self.console.print(e)
+            self.show_result(self.eval_expr(line))
+        except Exception as e:
+            self.show_exception(e, "expr")
+
+    # Show how an expression would be evaluated
+    def do_explain(self, line):
+        """
+Show how an expression would be evaluated.
+explain <expression>
+Aggregates over metric histories, such as max(metric.values) or
+sum(v for v, t in metric.values), and over a metric of every device,
+such as max([d.metric.temperature.value for d in get_devices()]),
+are run as single SQL queries. Anything else is evaluated in Python.
+The SQL of every aggregate that is pushed down is shown, along with
+why the others are not.
+        """
+        if line == "":
+            self.show_error("No expression provided", "explain")
+            return
+        try:
+            lines = self.definitions.explain(line)
+        except Exception as e:
+            self.show_exception(e, "explain")
+            return
+        self.show_lines(lines)
+
+    # Evaluate an expression runs times and show where the time went:
+    # the statements it ran, the cache hits and, if profiler is given,
+    # the Python functions
+    # Lazy results are consumed, so that the queries they run are counted
+    def measure_expr(self, expr, runs, profiler=None):
+        caches = model.cache_stats()
+        variables = {stat[0]: stat[3:5] for stat in self.definitions.stats()}
+        times = []
+        with accounting.measure() as stats:
+            for _ in range(runs):
+                start = time.perf_counter()
+                if profiler is not None:
+                    profiler.enable()
+                try:
+                    result = self.eval_expr(expr)
+                    if isinstance(result, types.GeneratorType):
+                        for _ in result:
+                            pass
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+                times.append(time.perf_counter() - start)
+        mean = sum(times) / runs
+        db = stats.db_seconds / runs
+        self.show_table("Timing", ["Runs", "Best (ms)", "Mean (ms)", "SQL statements", "Database (ms)", "Python (ms)"],
+                        [[runs, "%.3f" % (min(times) * 1000), "%.3f" % (mean * 1000), "%g" % (stats.queries / runs),
+                          "%.3f" % (db * 1000), "%.3f" % ((mean - db) * 1000)]])
+        self.show_table("Top statements", ["Statement", "Runs", "Total (ms)"],
+                        [[" ".join(query.split()), count, "%.3f" % (seconds * 1000)]
+                         for query, count, seconds in stats.top_queries(TOP_STATEMENTS)])
+        rows = []
+        for name, (hits, misses) in model.cache_stats().items():
+            hits, misses = hits - caches[name][0], misses - caches[name][1]
+            if hits or misses:
+                rows.append([name, hits, misses])
+        for name, _, _, hits, misses, _ in self.definitions.stats():
+            hits, misses = (hits, misses) if name not in variables else (
+                hits - variables[name][0], misses - variables[name][1])
+            if hits or misses:
+                rows.append(["@" + name, hits, misses])
+        self.show_table("Caches", ["Cache", "Hits", "Misses", "Hit rate"],
+                        [row + ["%.1f%%" % (row[1] * 100 / (row[1] + row[2]))] for row in rows])
+        if profiler is not None:
+            functions = sorted(pstats.Stats(profiler).stats.items(),
+                               key=lambda item: item[1][2], reverse=True)
+            self.show_table("Top functions", ["Function", "Calls", "Own (ms)", "Total (ms)"],
+                            [[self.format_function(*function), calls, "%.3f" % (own * 1000), "%.3f" % (total * 1000)]
+                             for function, (_, calls, own, total, _) in functions[:TOP_FUNCTIONS]])
+
+    # Name a function of a profile, given as cProfile does
+    def format_function(self, file, line, name):
+        if file == "~":
+            # built-in
+            return name
+        return os.path.basename(file) + ":" + str(line) + "(" + name + ")"
+
+    # Parse the [-n <runs>] <expression> arguments of timeit and profile
+    # Returns None after showing the error if they are invalid
+    def parse_measure_args(self, line, command):
+        runs = 1
+        parts = line.split(" ")
+        if parts[0] == "-n":
+            try:
+                runs = int(parts[1])
+                if runs <= 0:
+                    raise ValueError()
+            except (IndexError, ValueError):
+                self.show_error("Invalid number of runs", command)
+                return None
+            parts = parts[2:]
+        expr = " ".join(parts).strip()
+        if expr == "":
+            self.show_error("No expression provided", command)
+            return None
+        return expr, runs
+
+    # Time an expression
+    def do_timeit(self, line):
+        """
+Time an expression.
+timeit [-n <runs>] <expression>
+The expression is evaluated like expr, runs times (once by default), and
+the time it took is shown along with the number of SQL statements it
+ran, the time spent in the database and the statements that took the
+most time. Lazy results such as iter_values() are consumed.
+The hits and misses of the caches of the devices, metrics and other
+objects, and of the defined variables it used, are shown as well. Run it
+more than once to see how much faster the cached evaluations are.
+For example,
+    timeit -n 10 max(d.metric.temperature.value for d in get_devices())
+        """
+        args = self.parse_measure_args(line, "timeit")
+        if args is None:
+            return
+        try:
+            self.measure_expr(*args)
         except Exception as e:
-            print(str(e.__class__.__name__) + ":", e)
-            self.show_error("Error in expression", "expr")
+            self.show_exception(e, "timeit")
+
+    # Profile an expression
+    def do_profile(self, line):
+        """
+Profile an expression.
+profile [-n <runs>] <expression>
+Shows the same as timeit, followed by the Python functions the
+evaluation spent the most time in, excluding the functions they call.
+Profiling slows the evaluation down, so the times shown are higher than
+the ones of timeit.
+        """
+        args = self.parse_measure_args(line, "profile")
+        if args is None:
+            return
+        try:
+            self.measure_expr(*args, profiler=cProfile.Profile())
+        except Exception as e:
+            self.show_exception(e, "profile")
 
     def do_assign(self, line):
         """
@@ -280,40 +870,238 @@ Expression will be evaluated following the same rules as expr.
             self.show_error("No expression provided", "assign")
             return
         try:
-            model.RUNTIME_DICT[parts[0]] = self.eval_expr(
-                " ".join(parts[1:]))
+            self.definitions.assign(parts[0], " ".join(parts[1:]))
         except Exception as e:
-            print(str(e.__class__.__name__) + ":", e)
-            self.show_error("Error in expression", "assign")
+            self.show_exception(e, "assign")
 
     def do_define(self, line):
         """
 Assign an expression to a variable.
-define <variable_name> <expression>
+define [--ttl <seconds>] <variable_name> <expression>
 Expression will not be evaluated until the variable is used.
 Use @ to access the variable.
 For example,
-    define temp get("group1/node0/device1").metric.temperature.values
-    expr max(@temp)
+    define temp get("group1/node0/device1").metric.temperature
+    expr max(@temp.values)
+The expression is compiled once and its value is reused until the
+metrics, devices or variables it read change. With --ttl, the value is
+also evaluated again once it is older than the given number of seconds.
+Iterators such as iter_values() are evaluated again on every use.
+Aggregates over the values of a metric are only computed in the database
+when the metric, not its values, is the variable, as above.
+Use 'define' alone to list the variables and how often their values
+were reused.
         """
+        parts = line.split(" ")
+        ttl = None
+        if parts[0] == "--ttl":
+            try:
+                ttl = float(parts[1])
+                if ttl <= 0:
+                    raise ValueError()
+            except (IndexError, ValueError):
+                self.show_error("Invalid TTL", "define")
+                return
+            parts = parts[2:]
         if line == "":
-            self.show_error("No expression provided", "define")
+            self.list_definitions()
             return
-        parts = line.split(" ")
         if len(parts) < 2:
             self.show_error("No expression provided", "define")
             return
-        model.RUNTIME_DICT[parts[0]] = " ".join(parts[1:])
+        self.definitions.define(parts[0], " ".join(parts[1:]), ttl)
+
+
+# Output formats of the batch mode
+BATCH_FORMATS = ("csv", "ndjson")
+
+
+# Runs commands without Rich for scripts and pipelines
+# Results are written to out as CSV or NDJSON, one row at a time as they
+# are produced, so large results are never held in memory
+# Errors are written to stderr
+class BatchREPL(SparkplugREPL):
+
+    def __init__(self, format="csv", out=sys.stdout):
+        cmd.Cmd.__init__(self, stdout=out)
+        self.format = format
+        self.out = out
+        self.writer = csv.writer(out, lineterminator="\n")
+        self.definitions = definitions.Definitions(model.RUNTIME_DICT)
+        self.failed = False
+
+    # Write one row, columns names the fields for NDJSON objects
+    def write_row(self, row, columns=None):
+        if self.format == "csv":
+            self.writer.writerow(row)
+        elif columns is not None:
+            self.out.write(json.dumps(dict(zip(columns, row)), default=str) + "\n")
+        else:
+            self.out.write(json.dumps(row, default=str) + "\n")
+
+    # Write the rows of a table, preceded by a CSV header
+    def write_rows(self, columns, rows):
+        if self.format == "csv":
+            self.writer.writerow(columns)
+        for row in rows:
+            self.write_row(row, columns)
+
+    def show_error(self, message, command):
+        if isinstance(sys.exc_info()[1], BrokenPipeError):
+            # nobody reads the output any more, stop
+            raise
+        self.failed = True
+        sys.stderr.write("Error: " + message + " (in '" + command + "')\n")
+
+    def show_exception(self, e, command):
+        self.show_error(str(e.__class__.__name__) + ": " + str(e), command)
+
+    # Write the result of an expression, one row per item if it is a
+    # list, set or iterator
+    def show_result(self, result):
+        if isinstance(result, (list, set, frozenset, types.GeneratorType, map, filter, zip)):
+            for item in result:
+                self.write_result_row(item)
+        else:
+            self.write_result_row(result)
+
+    def write_result_row(self, item):
+        if isinstance(item, dict):
+            if self.format == "csv":
+                self.writer.writerow(list(item.values()))
+            else:
+                self.out.write(json.dumps(item, default=str) + "\n")
+        elif isinstance(item, (list, tuple)):
+            self.write_row(list(item))
+        elif isinstance(item, model.Queryable):
+            self.write_row([str(item)])
+        else:
+            self.write_row([item])
+
+    def show_lines(self, lines):
+        for line in lines:
+            self.out.write(line + "\n")
+
+    def print_help_text(self, text):
+        self.out.write(text.strip() + "\n")
+
+    def print_pages(self, cols, pages):
+        self.write_rows(cols, (row for rows in pages for row in rows))
+
+    def show_table(self, title, cols, rows):
+        self.write_rows(cols, rows)
+
+    def plot_width(self):
+        return PLOT_WIDTH
+
+    # Write the buckets of the plot instead of drawing it
+    def show_plot(self, plot, title, height, live):
+        if live:
+            self.show_error("live plots are not available in batch mode", "plot")
+            return
+        self.write_rows(["timestamp", "count", "mean", "min", "max"], plot.rows())
+
+    def list_all(self):
+        self.write_rows(["group", "node", "device", "metric", "type", "value", "timestamp"],
+                        (row[1:2] + row[3:4] + row[5:6] + row[7:] for rows in model.iter_topology() for row in rows))
+
+    def list_devices(self, device):
+        if len(device) == 0:
+            self.list_all_devices()
+            return
+        devices = model.get_device(*parse_device_name(device[0]))
+        details = DeviceWatch(devices)
+
+        def rows():
+            for device in devices:
+                name, group, node = details.info[device.id]
+                for metric_id in details.metric_ids[device.id]:
+                    metric_name, metric_type = details.metric_info[metric_id]
+                    value, timestamp = details.latest[metric_id]
+                    yield [device.id, name, group, node, details.statuses[device.id],
+                           metric_name, metric_type, value, timestamp]
+        self.write_rows(["id", "name", "group", "node", "status", "metric", "type", "value", "timestamp"],
+                        rows())
+
+    def list_definitions(self):
+        self.write_rows(["name", "expression", "ttl", "reused", "evaluated", "cached"],
+                        self.definitions.stats())
+
+    def do_watch(self, line):
+        self.show_error("watch is not available in batch mode", "watch")
+
+    # Blank lines do nothing, instead of repeating the last command
+    def emptyline(self):
+        pass
+
+    def default(self, line):
+        self.show_error("Unknown command: " + line.split(" ")[0], "help")
+
+
+# Run commands in batch mode
+# Lines that are empty or start with # are skipped, 'exit' stops
+# Returns the exit status: 1 if a command failed, 0 otherwise
+def run_batch(commands, format="csv"):
+    repl = BatchREPL(format)
+    try:
+        for line in commands:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            try:
+                repl.onecmd(line)
+            except KeyboardInterrupt:
+                # exit
+                break
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # the reader went away, e.g. piped to head, so silence the final
+        # flush at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 0
+    finally:
+        repl.definitions.close()
+    return 1 if repl.failed else 0
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Sparkplug CLI")
+    parser.add_argument("-c", "--command", action="append",
+                        help="run a command and exit, can be given more than once")
+    parser.add_argument("-f", "--file",
+                        help="run the commands of a script, one per line, and exit ('-' reads stdin)")
+    parser.add_argument("--format", choices=BATCH_FORMATS, default="csv",
+                        help="output format of -c and -f (default: csv)")
+    args = parser.parse_args()
+    if not (args.command or args.file) and Console is None:
+        parser.error("the interactive REPL needs rich, "
+                     "install it or run commands with -c or -f")
+
     model.startup()
+    if args.command or args.file:
+        commands = list(args.command or [])
+        try:
+            if args.file == "-":
+                status = run_batch(itertools.chain(commands, sys.stdin), args.format)
+            elif args.file:
+                with open(args.file) as f:
+                    status = run_batch(itertools.chain(commands, f), args.format)
+            else:
+                status = run_batch(commands, args.format)
+        finally:
+            model.shutdown()
+        sys.exit(status)
+
+    model.connect_events()
     while True:
+        repl = SparkplugREPL()
         try:
-            SparkplugREPL().cmdloop()
+            repl.cmdloop()
         except KeyboardInterrupt:
             model.shutdown()
             break
+        finally:
+            repl.definitions.close()
 
 
 if __name__ == "__main__":
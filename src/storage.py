@@ -16,15 +16,132 @@ MetricFloat(metric_id refr, metric_value, timestamp)
 MetricBool(metric_id refr, metric_value, timestamp)
 """
 
-from threading import Lock
+from threading import Lock, local
 import sqlite3
 import json
+import time
+import traceback
 
 CONNECTION: sqlite3.Connection = None
 WRITELOCK: Lock = Lock()
+DB_URL: str = None
+
+# Per thread read connections, see open_reader
+READERS = local()
 
 SETUP_DONE = False
 
+# The tables storing the metric values, one for each metric type
+VALUE_TABLES = ["MetricString", "MetricInt", "MetricFloat", "MetricBoolean"]
+
+# Default number of rows fetched per page by iter_values
+CHUNK_SIZE = 10000
+
+# Functions called as listener(type, id, attr, value) after every write,
+# while the write lock is still held, so they must not write themselves.
+# Inserts are reported with attr "insert" and the name as the value.
+WRITE_LISTENERS = []
+
+
+# Register a function to be called after every write
+def add_write_listener(listener):
+    WRITE_LISTENERS.append(listener)
+
+
+def remove_write_listener(listener):
+    WRITE_LISTENERS.remove(listener)
+
+
+# Report a write to all listeners
+# Also called by the events module for writes done in other processes
+# The write is already committed, so a failing listener is only reported
+# and must neither fail the write nor keep the other listeners from
+# seeing it
+def notify_write(type, id, attr, value):
+    for listener in WRITE_LISTENERS:
+        try:
+            listener(type, id, attr, value)
+        except Exception:
+            traceback.print_exc()
+
+
+# Functions called as listener(query, args, seconds) after every statement
+# run by execute_query or get_values_page, from the thread that ran it
+QUERY_LISTENERS = []
+
+
+# Register a function to be called after every statement
+def add_query_listener(listener):
+    QUERY_LISTENERS.append(listener)
+
+
+def remove_query_listener(listener):
+    QUERY_LISTENERS.remove(listener)
+
+
+# Report a statement and the time it took to all query listeners
+def notify_query(query, args, seconds):
+    for listener in QUERY_LISTENERS:
+        listener(query, args, seconds)
+
+
+# Write generations, bumped by every write so that readers can tell
+# whether anything changed without querying the database
+# entity type -> [generation, time of the last write]
+GENERATIONS = {type: [0, time.time()]
+               for type in ("group", "node", "device", "metric")}
+# device_id -> [generation, time of the last write], bumped by writes to
+# the device and to its metrics
+DEVICE_GENERATIONS = {}
+# Changes whenever writes may have been missed (e.g. after a restart or
+# losing the connection to the host), invalidating all generations
+GENERATION_EPOCH = int(time.time() * 1000)
+
+# metric_id -> device_id of the metrics seen by bump_generations
+METRIC_DEVICES = {}
+
+
+# Write listener bumping the generations
+def bump_generations(type, id, attr, value):
+    now = time.time()
+    generation = GENERATIONS[type]
+    generation[0] += 1
+    generation[1] = now
+    device_id = None
+    if type == "device":
+        device_id = id
+    elif type == "metric":
+        if id not in METRIC_DEVICES:
+            METRIC_DEVICES[id] = execute_query(
+                "SELECT device_id FROM Metric WHERE metric_id = ?", (id,))[0][0]
+        device_id = METRIC_DEVICES[id]
+    if device_id is not None:
+        generation = DEVICE_GENERATIONS.setdefault(device_id, [0, now])
+        generation[0] += 1
+        generation[1] = now
+
+
+add_write_listener(bump_generations)
+
+
+# Invalidate all generations
+def reset_generations():
+    global GENERATION_EPOCH
+    GENERATION_EPOCH += 1
+
+
+# Get the (epoch, generation, time of the last write) of an entity type
+def get_generation(type):
+    generation, modified = GENERATIONS[type]
+    return GENERATION_EPOCH, generation, modified
+
+
+# Get the (epoch, generation, time of the last write) of a device
+def get_device_generation(device_id):
+    generation, modified = DEVICE_GENERATIONS.get(
+        device_id, (0, GENERATIONS["device"][1]))
+    return GENERATION_EPOCH, generation, modified
+
 
 # Decorator to serialize access to the database
 def serialized(func):
@@ -35,14 +152,20 @@ def serialized(func):
 
 
 # Connect to the database and create the tables if they don't exist
-def startup():
+# url -> the database to use instead of the one in config.json
+def startup(url=None):
     global SETUP_DONE
     if SETUP_DONE:
         return
-    config = json.loads(open("config.json", "rb").read())
-    global CONNECTION
-    CONNECTION = sqlite3.connect(config["db"]["url"], check_same_thread=False)
+    if url is None:
+        config = json.loads(open("config.json", "rb").read())
+        url = config["db"]["url"]
+    global CONNECTION, DB_URL
+    DB_URL = url
+    CONNECTION = sqlite3.connect(DB_URL, check_same_thread=False)
     c = CONNECTION.cursor()
+    # WAL lets the read connections run while the host is writing
+    c.execute("PRAGMA journal_mode=WAL")
     c.execute("CREATE TABLE IF NOT EXISTS Groups (group_id INTEGER PRIMARY KEY AUTOINCREMENT, group_name TEXT NOT NULL, UNIQUE(group_name) ON CONFLICT IGNORE)")
     c.execute("CREATE TABLE IF NOT EXISTS EdgeNode (edge_node_id INTEGER PRIMARY KEY AUTOINCREMENT, group_id INTEGER REFERENCES Groups, edge_node_name TEXT, edge_node_status TEXT, edge_node_birth_timestamp INTEGER, edge_node_death_timestamp INTEGER)")
     c.execute("CREATE TABLE IF NOT EXISTS Device (device_id INTEGER PRIMARY KEY AUTOINCREMENT, edge_node_id INTEGER RERFERENCES EdgeNode, device_name TEXT, device_status TEXT, device_birth_timestamp INTEGER, device_death_timestamp INTEGER)")
@@ -51,6 +174,27 @@ def startup():
     c.execute("CREATE TABLE IF NOT EXISTS MetricInt (metric_id INTEGER REFERENCES Metric, metric_value INTEGER NOT NULL, metric_timestamp INTEGER)")
     c.execute("CREATE TABLE IF NOT EXISTS MetricFloat (metric_id INTEGER RERFERENCES Metric, metric_value REAL NOT NULL, metric_timestamp INTEGER)")
     c.execute("CREATE TABLE IF NOT EXISTS MetricBoolean (metric_id INTEGER REFERENCES Metric, metric_value INTEGER NOT NULL, metric_timestamp INTEGER)")
+    # (metric_id, metric_timestamp) drives both the latest value lookups and
+    # the keyset pagination in iter_values
+    for table_name in VALUE_TABLES:
+        c.execute("CREATE INDEX IF NOT EXISTS {0}_id_timestamp ON {0} (metric_id, metric_timestamp)".format(
+            table_name))
+    # The latest value of every metric, maintained on each write so that
+    # current values can be read and aggregated without scanning the history
+    latest_exists = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'MetricLatest'").fetchall()
+    c.execute("CREATE TABLE IF NOT EXISTS MetricLatest (metric_id INTEGER PRIMARY KEY REFERENCES Metric, metric_value NOT NULL, metric_timestamp INTEGER)")
+    if not latest_exists:
+        for table_name in VALUE_TABLES:
+            c.execute("INSERT OR REPLACE INTO MetricLatest (metric_id, metric_value, metric_timestamp) " +
+                      "SELECT metric_id, metric_value, MAX(metric_timestamp) FROM {} GROUP BY metric_id".format(table_name))
+        CONNECTION.commit()
+    c.execute("CREATE INDEX IF NOT EXISTS Metric_name ON Metric (metric_name)")
+    c.execute("CREATE INDEX IF NOT EXISTS Metric_device ON Metric (device_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS Device_node ON Device (edge_node_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS EdgeNode_group ON EdgeNode (group_id)")
+    for index in (GROUP_INDEX, NODE_INDEX, DEVICE_INDEX):
+        index.refresh()
     SETUP_DONE = True
 
 
@@ -60,23 +204,71 @@ def shutdown():
     CONNECTION.close()
 
 
+# Open a read connection for the current thread
+# Reads done by this thread will use it instead of the shared connection,
+# so that they can run concurrently with reads from other threads
+def open_reader():
+    READERS.connection = sqlite3.connect(DB_URL)
+    return READERS.connection
+
+
+# Close the read connection of the current thread, if any
+def close_reader():
+    connection = getattr(READERS, "connection", None)
+    if connection is not None:
+        connection.close()
+        READERS.connection = None
+
+
+# Get the connection reads of the current thread should use
+def reader():
+    return getattr(READERS, "connection", None) or CONNECTION
+
+
 # Execute a query on the database
 def execute_query(query, args=()):
-    c = CONNECTION.cursor()
+    write = query.startswith("INSERT") or query.startswith(
+        "UPDATE") or query.startswith("DELETE")
+    connection = CONNECTION if write else reader()
+    c = connection.cursor()
     # print("QUERY: " + query + " ARGS: " + str(args))
+    start = time.perf_counter()
     ret = c.execute(query, args).fetchall()
     # these calls are serialized, so we can commit here
-    if query.startswith("INSERT") or query.startswith("UPDATE") or query.startswith("DELETE"):
+    if write:
         CONNECTION.commit()
+    if QUERY_LISTENERS:
+        notify_query(query, args, time.perf_counter() - start)
     return ret
 
 
+# Run write statements as one transaction with a single commit, as
+# (query, args) pairs
+# Must be called with the write lock held
+def execute_writes(statements):
+    c = CONNECTION.cursor()
+    try:
+        for query, args in statements:
+            start = time.perf_counter()
+            c.execute(query, args)
+            if QUERY_LISTENERS:
+                notify_query(query, args, time.perf_counter() - start)
+    except BaseException:
+        CONNECTION.rollback()
+        raise
+    CONNECTION.commit()
+
+
 # Insert a group into the database
 @serialized
 def insert_group(group_name):
     execute_query(
         "INSERT OR IGNORE INTO Groups (group_name) VALUES (?) RETURNING group_id", (group_name,))
-    return execute_query("SELECT group_id FROM Groups WHERE group_name = ?", (group_name,))[0][0]
+    group_id = execute_query(
+        "SELECT group_id FROM Groups WHERE group_name = ?", (group_name,))[0][0]
+    GROUP_INDEX.add(group_id, group_name)
+    notify_write("group", group_id, "insert", group_name)
+    return group_id
 
 
 # Insert an edge node into the database
@@ -84,7 +276,11 @@ def insert_group(group_name):
 def insert_node(group_name, edge_node_name, status, birth_timestamp, death_timestamp):
     execute_query("INSERT OR IGNORE INTO EdgeNode (group_id, edge_node_name, edge_node_status, edge_node_birth_timestamp, edge_node_death_timestamp) VALUES ((SELECT group_id FROM Groups WHERE group_name = ?), ?, ?, ?, ?) RETURNING edge_node_id",
                   (group_name, edge_node_name, status, birth_timestamp, death_timestamp))
-    return execute_query("SELECT edge_node_id FROM EdgeNode WHERE edge_node_name = ? AND group_id = (SELECT group_id FROM Groups WHERE group_name = ?)", (edge_node_name, group_name))[0][0]
+    edge_node_id, group_id = execute_query(
+        "SELECT edge_node_id, group_id FROM EdgeNode WHERE edge_node_name = ? AND group_id = (SELECT group_id FROM Groups WHERE group_name = ?)", (edge_node_name, group_name))[0]
+    NODE_INDEX.add(edge_node_id, edge_node_name, group_id)
+    notify_write("node", edge_node_id, "insert", edge_node_name)
+    return edge_node_id
 
 
 # Insert a device into the database
@@ -92,7 +288,11 @@ def insert_node(group_name, edge_node_name, status, birth_timestamp, death_times
 def insert_device(group_name, edge_node_name, device_name, status, birth_timestamp, death_timestamp):
     execute_query("INSERT OR IGNORE INTO Device (edge_node_id, device_name, device_status, device_birth_timestamp, device_death_timestamp) VALUES ((SELECT edge_node_id FROM EdgeNode WHERE edge_node_name = ? AND group_id = (SELECT group_id FROM Groups WHERE group_name = ?)), ?, ?, ?, ?) RETURNING device_id",
                   (edge_node_name, group_name, device_name, status, birth_timestamp, death_timestamp))
-    return execute_query("SELECT device_id FROM Device WHERE device_name = ? AND edge_node_id = (SELECT edge_node_id FROM EdgeNode WHERE edge_node_name = ? AND group_id = (SELECT group_id FROM Groups WHERE group_name = ?))", (device_name, edge_node_name, group_name))[0][0]
+    device_id, edge_node_id = execute_query(
+        "SELECT device_id, edge_node_id FROM Device WHERE device_name = ? AND edge_node_id = (SELECT edge_node_id FROM EdgeNode WHERE edge_node_name = ? AND group_id = (SELECT group_id FROM Groups WHERE group_name = ?))", (device_name, edge_node_name, group_name))[0]
+    DEVICE_INDEX.add(device_id, device_name, edge_node_id)
+    notify_write("device", device_id, "insert", device_name)
+    return device_id
 
 
 # Insert a metric into the database
@@ -100,7 +300,9 @@ def insert_device(group_name, edge_node_name, device_name, status, birth_timesta
 def insert_metric(group_name, edge_node_name, device_name, metric_name, metric_type):
     execute_query("INSERT OR IGNORE INTO Metric (device_id, metric_name, metric_type) VALUES ((SELECT device_id FROM Device WHERE device_name = ? AND edge_node_id = (SELECT edge_node_id FROM EdgeNode WHERE edge_node_name = ? AND group_id = (SELECT group_id FROM Groups WHERE group_name = ?))), ?, ?) RETURNING metric_id",
                   (device_name, edge_node_name, group_name, metric_name, metric_type))
-    return execute_query("SELECT metric_id FROM Metric WHERE metric_name = ? AND device_id = (SELECT device_id FROM Device WHERE device_name = ? AND edge_node_id = (SELECT edge_node_id FROM EdgeNode WHERE edge_node_name = ? AND group_id = (SELECT group_id FROM Groups WHERE group_name = ?)))", (metric_name, device_name, edge_node_name, group_name))[0][0]
+    metric_id = execute_query("SELECT metric_id FROM Metric WHERE metric_name = ? AND device_id = (SELECT device_id FROM Device WHERE device_name = ? AND edge_node_id = (SELECT edge_node_id FROM EdgeNode WHERE edge_node_name = ? AND group_id = (SELECT group_id FROM Groups WHERE group_name = ?)))", (metric_name, device_name, edge_node_name, group_name))[0][0]
+    notify_write("metric", metric_id, "insert", metric_name)
+    return metric_id
 
 
 # In a list of tuples where each tuple has a single element, return a list of the first elements
@@ -123,32 +325,528 @@ def get_all_devices():
     return flatten_tuple_list(execute_query("SELECT device_id FROM Device"))
 
 
+# Name matching modes for the get_*_by_name lookups
+MATCH_EXACT = "exact"
+MATCH_PREFIX = "prefix"
+MATCH_SUBSTRING = "substring"
+
+
+# In-memory index of the names on one level of the hierarchy
+# (groups, edge nodes or devices), kept in sync with the inserts and
+# renames done through this module. Rows inserted by other processes
+# are picked up by refresh(), which only reads ids above the last seen one.
+class NameIndex:
+
+    # query -> returns (id, name, parent_id) rows with id > ?
+    def __init__(self, query):
+        self.query = query
+        self.lock = Lock()
+        self.by_name = {}  # name -> dict of ids (used as an ordered set)
+        self.names = {}  # id -> name
+        self.parents = {}  # id -> parent id
+        self.last_id = 0
+
+    def add(self, id, name, parent=None):
+        with self.lock:
+            old = self.names.get(id)
+            if old is not None and old != name:
+                self.by_name[old].pop(id, None)
+                if not self.by_name[old]:
+                    del self.by_name[old]
+            self.names[id] = name
+            self.parents[id] = parent
+            self.by_name.setdefault(name, {})[id] = True
+            self.last_id = max(self.last_id, id)
+
+    def rename(self, id, name):
+        if id in self.names:
+            self.add(id, name, self.parents[id])
+
+    # Load the rows that are not indexed yet
+    def refresh(self):
+        for id, name, parent in execute_query(self.query, (self.last_id,)):
+            self.add(id, name, parent)
+
+    # Return the ids matching name, optionally restricted to the given parents
+    # The index is read under the lock, as other threads may be adding to it
+    def find(self, name, match=MATCH_EXACT, parents=None):
+        with self.lock:
+            if match == MATCH_EXACT:
+                ids = list(self.by_name.get(name, ()))
+            elif match == MATCH_PREFIX:
+                ids = [id for id, n in self.names.items() if n.startswith(name)]
+            else:
+                ids = [id for id, n in self.names.items() if name in n]
+            if parents is not None:
+                ids = [id for id in ids if self.parents[id] in parents]
+        return sorted(ids)
+
+    # Same as find, but reloads the index once if nothing was found.
+    # Without a match mode, an exact match is tried first and a substring
+    # search is done only if that finds nothing.
+    def lookup(self, name, match=None, parents=None):
+        modes = [match] if match else [MATCH_EXACT, MATCH_SUBSTRING]
+        for mode in modes:
+            ids = self.find(name, mode, parents)
+            if not ids:
+                self.refresh()
+                ids = self.find(name, mode, parents)
+            if ids:
+                return ids
+        return []
+
+
+GROUP_INDEX = NameIndex(
+    "SELECT group_id, group_name, NULL FROM Groups WHERE group_id > ?")
+NODE_INDEX = NameIndex(
+    "SELECT edge_node_id, edge_node_name, group_id FROM EdgeNode WHERE edge_node_id > ?")
+DEVICE_INDEX = NameIndex(
+    "SELECT device_id, device_name, edge_node_id FROM Device WHERE device_id > ?")
+
+
+# Keep the name indexes in sync with writes reported by other processes
+def update_indexes(type, id, attr, value):
+    index = {"group": GROUP_INDEX, "node": NODE_INDEX,
+             "device": DEVICE_INDEX}.get(type)
+    if index is None:
+        return
+    if attr == "insert" and id not in index.names:
+        index.refresh()
+    elif attr == "name":
+        index.rename(id, value)
+
+
+add_write_listener(update_indexes)
+
+
 # Get a device_id by name
-def get_device_by_name(group_name, edge_node_name, device_name):
-    query = "SELECT device_id from Device WHERE device_name like '%" + device_name + "%' "
+def get_device_by_name(group_name, edge_node_name, device_name, match=None):
+    nodes = None
     if edge_node_name:
-        query += "AND edge_node_id in (SELECT edge_node_id FROM EdgeNode WHERE edge_node_name like '%" + \
-            edge_node_name + "%' "
-        if group_name:
-            query += "AND group_id in (SELECT group_id FROM Groups WHERE group_name like '%" + \
-                group_name + "%')"
-        query += ")"
-    return flatten_tuple_list(execute_query(query))
+        nodes = get_node_by_name(group_name, edge_node_name, match)
+    return DEVICE_INDEX.lookup(device_name, match, nodes)
 
 
 # Get a edge_node_id by name
-def get_node_by_name(group_name, edge_node_name):
-    query = "SELECT edge_node_id from EdgeNode WHERE edge_node_name like '%" + \
-        edge_node_name + "%' "
+def get_node_by_name(group_name, edge_node_name, match=None):
+    groups = None
     if group_name:
-        query += "AND group_id in (SELECT group_id FROM Groups WHERE group_name like '%" + \
-            group_name + "%')"
-    return flatten_tuple_list(execute_query(query))
+        groups = get_group_by_name(group_name, match)
+    return NODE_INDEX.lookup(edge_node_name, match, groups)
 
 
 # Get a group_id by name
-def get_group_by_name(group_name):
-    return flatten_tuple_list(execute_query("SELECT group_id from Groups WHERE group_name like '%" + group_name + "%'"))
+def get_group_by_name(group_name, match=None):
+    return GROUP_INDEX.lookup(group_name, match)
+
+
+# metric_id -> name of the table storing its values
+# A metric never changes its type, so this is never invalidated
+VALUE_TABLE_CACHE = {}
+
+
+# Get the name of the table storing the values of a metric
+def get_value_table(metric_id):
+    if metric_id not in VALUE_TABLE_CACHE:
+        metric_type = execute_query(
+            "SELECT metric_type FROM Metric WHERE metric_id = ?", (metric_id,))[0][0]
+        VALUE_TABLE_CACHE[metric_id] = "Metric" + metric_type.capitalize()
+    return VALUE_TABLE_CACHE[metric_id]
+
+
+# Get the device_id and the group/node/device/metric path of a metric
+def get_metric_path(metric_id):
+    device_id, *names = execute_query(
+        "SELECT Device.device_id, group_name, edge_node_name, device_name, metric_name FROM Metric " +
+        "JOIN Device ON Device.device_id = Metric.device_id " +
+        "JOIN EdgeNode ON EdgeNode.edge_node_id = Device.edge_node_id " +
+        "JOIN Groups ON Groups.group_id = EdgeNode.group_id " +
+        "WHERE metric_id = ?", (metric_id,))[0]
+    return device_id, "/".join(names)
+
+
+# Build the condition and arguments selecting the values of a metric,
+# optionally bounded by inclusive start and end timestamps
+def values_condition(metric_id, start=None, end=None):
+    condition = "metric_id = ?"
+    args = [metric_id]
+    if start is not None:
+        condition += " AND metric_timestamp >= ?"
+        args.append(start)
+    if end is not None:
+        condition += " AND metric_timestamp <= ?"
+        args.append(end)
+    return condition, args
+
+
+# Get one page of the (value, timestamp, rowid) history of a metric in
+# timestamp order
+# start and end are optional inclusive timestamp bounds
+# after is the (timestamp, rowid) of the last row of the previous page
+# The page is read with a dedicated cursor that is closed before returning,
+# so no statement is left open between pages
+def get_values_page(metric_id, start=None, end=None, after=None, chunk=CHUNK_SIZE):
+    condition, args = values_condition(metric_id, start, end)
+    query = "SELECT metric_value, metric_timestamp, rowid FROM {} WHERE {}".format(
+        get_value_table(metric_id), condition)
+    if after is not None:
+        query += " AND (metric_timestamp, rowid) > (?, ?)"
+        args += list(after)
+    query += " ORDER BY metric_timestamp, rowid LIMIT ?"
+    args.append(chunk)
+    c = reader().cursor()
+    start = time.perf_counter()
+    c.execute(query, args)
+    rows = c.fetchmany(chunk)
+    c.close()
+    if QUERY_LISTENERS:
+        notify_query(query, args, time.perf_counter() - start)
+    return rows
+
+
+# Iterate over the (value, timestamp) history of a metric in timestamp order
+# start and end are optional inclusive timestamp bounds
+# Pages are fetched one at a time, resuming after the last seen
+# (timestamp, rowid), so only one page is held in memory
+def iter_values(metric_id, start=None, end=None, chunk=CHUNK_SIZE):
+    after = None
+    while True:
+        rows = get_values_page(metric_id, start, end, after, chunk)
+        for value, timestamp, _ in rows:
+            yield (value, timestamp)
+        if len(rows) < chunk:
+            return
+        after = (rows[-1][1], rows[-1][2])
+
+
+# Finish a list query with the given conditions, ordered by id_column
+# after_id and limit implement keyset pagination: only the first limit
+# rows with an id greater than after_id are returned
+# Aggregate queries are grouped by id_column if group is True
+def run_list_query(query, conditions, args, id_column, after_id=None, limit=None, group=False):
+    if after_id is not None:
+        conditions.append(id_column + " > ?")
+        args.append(after_id)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if group:
+        query += " GROUP BY " + id_column
+    query += " ORDER BY " + id_column
+    if limit is not None:
+        query += " LIMIT ?"
+        args.append(limit)
+    return execute_query(query, args)
+
+
+# Count the values of a metric between start and end (inclusive)
+def count_values(metric_id, start=None, end=None):
+    condition, args = values_condition(metric_id, start, end)
+    return execute_query("SELECT COUNT(*) FROM {} WHERE {}".format(
+        get_value_table(metric_id), condition), args)[0][0]
+
+
+# Get the (first, last) timestamps of the history of a metric, (None, None)
+# if it has no values
+def get_time_range(metric_id):
+    return tuple(execute_query(
+        "SELECT MIN(metric_timestamp), MAX(metric_timestamp) FROM {} WHERE metric_id = ?".format(get_value_table(metric_id)), (metric_id,))[0])
+
+
+# Downsample the history of a metric to at most points (timestamp, value)
+# rows by splitting [start, end] into equal time buckets and averaging each
+# of them. Missing bounds default to the first and last timestamps.
+def get_series(metric_id, start=None, end=None, points=500):
+    table_name = get_value_table(metric_id)
+    if start is None or end is None:
+        first, last = get_time_range(metric_id)
+        if first is None:
+            return []
+        start = first if start is None else start
+        end = last if end is None else end
+    if end < start:
+        return []
+    return execute_query(
+        "SELECT MIN(metric_timestamp), AVG(metric_value) FROM {} WHERE metric_id = ? AND metric_timestamp BETWEEN ? AND ? ".format(table_name) +
+        "GROUP BY (metric_timestamp - ?) * ? / ? ORDER BY 1",
+        (metric_id, start, end, start, points, end - start + 1))
+
+
+# Summarise the history of a metric between start and end (inclusive) in
+# buckets of step seconds, as (bucket, count, sum, min, max) rows in bucket
+# order, bucket being the timestamp divided by step rounded down
+# The buckets are aligned on multiples of step rather than on start, so
+# that the buckets of overlapping ranges are the same
+def get_buckets(metric_id, start, end, step):
+    condition, args = values_condition(metric_id, start, end)
+    return execute_query(
+        "SELECT CAST(metric_timestamp / ? AS INTEGER) AS bucket, COUNT(*), SUM(metric_value), MIN(metric_value), MAX(metric_value) " +
+        "FROM {} WHERE {} GROUP BY bucket ORDER BY bucket".format(get_value_table(metric_id), condition), [float(step)] + args)
+
+
+# Get (group_id, group_name) rows, optionally only for one group
+def list_groups(group_id=None, after_id=None, limit=None):
+    conditions, args = [], []
+    if group_id is not None:
+        conditions.append("group_id = ?")
+        args.append(group_id)
+    return run_list_query("SELECT group_id, group_name FROM Groups",
+                          conditions, args, "group_id", after_id, limit)
+
+
+# Get (edge_node_id, edge_node_name, status, birth_timestamp, death_timestamp)
+# rows, optionally only for one group or one node
+def list_nodes(group_id=None, edge_node_id=None, after_id=None, limit=None):
+    conditions, args = [], []
+    if group_id is not None:
+        conditions.append("group_id = ?")
+        args.append(group_id)
+    if edge_node_id is not None:
+        conditions.append("edge_node_id = ?")
+        args.append(edge_node_id)
+    return run_list_query("SELECT edge_node_id, edge_node_name, edge_node_status, edge_node_birth_timestamp, edge_node_death_timestamp FROM EdgeNode",
+                          conditions, args, "edge_node_id", after_id, limit)
+
+
+# Get (device_id, device_name, status, birth_timestamp, death_timestamp)
+# rows, optionally only for one group, one node or one device
+def list_devices(group_id=None, edge_node_id=None, device_id=None, after_id=None, limit=None):
+    conditions, args = [], []
+    if group_id is not None:
+        conditions.append(
+            "edge_node_id IN (SELECT edge_node_id FROM EdgeNode WHERE group_id = ?)")
+        args.append(group_id)
+    if edge_node_id is not None:
+        conditions.append("edge_node_id = ?")
+        args.append(edge_node_id)
+    if device_id is not None:
+        conditions.append("device_id = ?")
+        args.append(device_id)
+    return run_list_query("SELECT device_id, device_name, device_status, device_birth_timestamp, device_death_timestamp FROM Device",
+                          conditions, args, "device_id", after_id, limit)
+
+
+# Get (metric_id, metric_name, metric_type, value, timestamp) rows with the
+# latest value of every metric of a device
+def list_metrics(device_id, after_id=None, limit=None):
+    return run_list_query(
+        "SELECT Metric.metric_id, metric_name, metric_type, metric_value, metric_timestamp FROM Metric " +
+        "LEFT JOIN MetricLatest ON MetricLatest.metric_id = Metric.metric_id",
+        ["device_id = ?"], [device_id], "Metric.metric_id", after_id, limit)
+
+
+# Get (group_id, group_name, node count, device count) rows
+def list_group_summaries(after_id=None, limit=None):
+    return run_list_query(
+        "SELECT Groups.group_id, group_name, COUNT(DISTINCT EdgeNode.edge_node_id), COUNT(Device.device_id) FROM Groups " +
+        "LEFT JOIN EdgeNode ON EdgeNode.group_id = Groups.group_id " +
+        "LEFT JOIN Device ON Device.edge_node_id = EdgeNode.edge_node_id",
+        [], [], "Groups.group_id", after_id, limit, group=True)
+
+
+# Get (edge_node_id, edge_node_name, group_name, device count, status) rows
+def list_node_summaries(after_id=None, limit=None):
+    return run_list_query(
+        "SELECT EdgeNode.edge_node_id, edge_node_name, group_name, COUNT(Device.device_id), edge_node_status FROM EdgeNode " +
+        "JOIN Groups ON Groups.group_id = EdgeNode.group_id " +
+        "LEFT JOIN Device ON Device.edge_node_id = EdgeNode.edge_node_id",
+        [], [], "EdgeNode.edge_node_id", after_id, limit, group=True)
+
+
+# Get (device_id, device_name, group_name, edge_node_name, status) rows
+def list_device_summaries(after_id=None, limit=None):
+    return run_list_query(
+        "SELECT device_id, device_name, group_name, edge_node_name, device_status FROM Device " +
+        "JOIN EdgeNode ON EdgeNode.edge_node_id = Device.edge_node_id " +
+        "JOIN Groups ON Groups.group_id = EdgeNode.group_id",
+        [], [], "device_id", after_id, limit)
+
+
+# Get the whole hierarchy below the first groups groups with an id greater
+# than after_id, with the latest value of every metric, as
+# (group_id, group_name, edge_node_id, edge_node_name, device_id,
+# device_name, metric_id, metric_name, metric_type, value, timestamp) rows
+# ordered by group, node, device and metric
+# The columns of missing nodes, devices and metrics are None
+def list_topology(after_id=None, groups=None):
+    condition, args = "", []
+    if after_id is not None:
+        condition = " WHERE group_id > ?"
+        args.append(after_id)
+    return execute_query(
+        "SELECT Groups.group_id, group_name, EdgeNode.edge_node_id, edge_node_name, Device.device_id, device_name, " +
+        "Metric.metric_id, metric_name, metric_type, metric_value, metric_timestamp FROM Groups " +
+        "LEFT JOIN EdgeNode ON EdgeNode.group_id = Groups.group_id " +
+        "LEFT JOIN Device ON Device.edge_node_id = EdgeNode.edge_node_id " +
+        "LEFT JOIN Metric ON Metric.device_id = Device.device_id " +
+        "LEFT JOIN MetricLatest ON MetricLatest.metric_id = Metric.metric_id " +
+        "WHERE Groups.group_id IN (SELECT group_id FROM Groups" + condition + " ORDER BY group_id LIMIT ?) " +
+        "ORDER BY Groups.group_id, EdgeNode.edge_node_id, Device.device_id, Metric.metric_id",
+        args + [-1 if groups is None else groups])
+
+
+# Get the latest values of a set of metrics in a single query
+# metric_ids -> list of metric ids
+# patterns -> list of (group, node, device, metric) glob tuples
+# limit -> maximum number of rows returned
+# device_ids -> list of device ids, all of whose metrics are selected
+# Returns (metric_id, group, node, device, metric, type, value, timestamp,
+# device_id, device_status) rows for every metric selected by an id or
+# matching a pattern
+def latest_values(metric_ids=(), patterns=(), limit=None, device_ids=()):
+    query, conditions, args = "", [], []
+    if patterns:
+        # the patterns are joined as a table rather than OR'd, which hits
+        # the expression depth limit of SQLite at about 1000 terms
+        query = ("WITH Patterns (group_glob, node_glob, device_glob, metric_glob) AS (VALUES " +
+                 ", ".join(["(?, ?, ?, ?)"] * len(patterns)) + ") ")
+        for pattern in patterns:
+            args += list(pattern)
+        conditions.append("EXISTS (SELECT 1 FROM Patterns WHERE group_name GLOB group_glob AND edge_node_name GLOB node_glob " +
+                          "AND device_name GLOB device_glob AND metric_name GLOB metric_glob)")
+    if metric_ids:
+        conditions.append("Metric.metric_id IN (" +
+                          ", ".join("?" * len(metric_ids)) + ")")
+        args += list(metric_ids)
+    if device_ids:
+        conditions.append("Metric.device_id IN (" +
+                          ", ".join("?" * len(device_ids)) + ")")
+        args += list(device_ids)
+    if not conditions:
+        return []
+    query += ("SELECT Metric.metric_id, group_name, edge_node_name, device_name, metric_name, metric_type, metric_value, metric_timestamp, " +
+             "Device.device_id, device_status FROM Metric " +
+             "JOIN Device ON Device.device_id = Metric.device_id " +
+             "JOIN EdgeNode ON EdgeNode.edge_node_id = Device.edge_node_id " +
+             "JOIN Groups ON Groups.group_id = EdgeNode.group_id " +
+             "LEFT JOIN MetricLatest ON MetricLatest.metric_id = Metric.metric_id " +
+             "WHERE " + " OR ".join(conditions) + " ORDER BY Metric.metric_id")
+    if limit is not None:
+        query += " LIMIT ?"
+        args.append(limit)
+    return execute_query(query, args)
+
+
+# Get (device_id, group_id, edge_node_id, path, status, node status) rows
+# of all devices, or only of the given ones, path being group/node/device
+def fleet_devices(device_ids=()):
+    query = ("SELECT device_id, Groups.group_id, EdgeNode.edge_node_id, group_name || '/' || edge_node_name || '/' || device_name, " +
+             "device_status, edge_node_status FROM Device " +
+             "JOIN EdgeNode ON EdgeNode.edge_node_id = Device.edge_node_id " +
+             "JOIN Groups ON Groups.group_id = EdgeNode.group_id")
+    if device_ids:
+        query += " WHERE device_id IN (" + ", ".join("?" * len(device_ids)) + ")"
+    return execute_query(query, list(device_ids))
+
+
+# Get (metric_id, device_id, metric_name, metric_type, value, timestamp)
+# rows of all metrics, or only of the given ones, with their latest value
+# if they have one
+def fleet_metrics(metric_ids=()):
+    query = ("SELECT Metric.metric_id, device_id, metric_name, metric_type, metric_value, metric_timestamp FROM Metric " +
+             "LEFT JOIN MetricLatest ON MetricLatest.metric_id = Metric.metric_id")
+    if metric_ids:
+        query += " WHERE Metric.metric_id IN (" + ", ".join("?" * len(metric_ids)) + ")"
+    return execute_query(query, list(metric_ids))
+
+
+# SQL aggregate functions supported by aggregate()
+AGGREGATE_FUNCTIONS = {"avg": "AVG", "min": "MIN",
+                       "max": "MAX", "sum": "SUM", "count": "COUNT"}
+
+# Grouping keys supported by aggregate()
+# Device types are the device names without their numeric suffix
+AGGREGATE_KEYS = {
+    "group": "group_name",
+    "node": "group_name || '/' || edge_node_name",
+    "device_type": "rtrim(device_name, '0123456789')",
+}
+
+
+# Aggregate the values of all metrics named metric_name across the fleet
+# func -> one of AGGREGATE_FUNCTIONS
+# by -> one of AGGREGATE_KEYS
+# window -> if given, aggregate all values of the last window seconds,
+#           otherwise only the latest value of each metric
+# value -> if given, only values equal to it are aggregated
+# Returns a list of (key, result) rows
+def aggregate(metric_name, func, by, window=None, value=None):
+    if func not in AGGREGATE_FUNCTIONS:
+        raise ValueError("Invalid aggregate function: " + func)
+    if by not in AGGREGATE_KEYS:
+        raise ValueError("Invalid aggregate key: " + by)
+    args = []
+    if window is None:
+        source = "MetricLatest"
+    else:
+        since = int(time.time() - window)
+        source = "(" + " UNION ALL ".join(
+            "SELECT metric_id, metric_value FROM {} WHERE metric_timestamp >= ? AND metric_id IN (SELECT metric_id FROM Metric WHERE metric_name = ?)".format(table_name)
+            for table_name in VALUE_TABLES) + ")"
+        args += [since, metric_name] * len(VALUE_TABLES)
+    query = ("SELECT {0}, {1}(v.metric_value) FROM {2} v " +
+             "JOIN Metric ON Metric.metric_id = v.metric_id " +
+             "JOIN Device ON Device.device_id = Metric.device_id " +
+             "JOIN EdgeNode ON EdgeNode.edge_node_id = Device.edge_node_id " +
+             "JOIN Groups ON Groups.group_id = EdgeNode.group_id " +
+             "WHERE Metric.metric_name = ?").format(AGGREGATE_KEYS[by], AGGREGATE_FUNCTIONS[func], source)
+    args.append(metric_name)
+    if value is not None:
+        query += " AND v.metric_value = ?"
+        args.append(value)
+    query += " GROUP BY 1 ORDER BY 1"
+    return execute_query(query, args)
+
+
+# Columns of the value tables that history_aggregate_query can aggregate
+VALUE_COLUMNS = ("metric_value", "metric_timestamp")
+
+
+# Build the query aggregating the whole history of a metric
+# func -> one of AGGREGATE_FUNCTIONS, the query returns one
+#         (number of values, result) row
+# column -> one of VALUE_COLUMNS
+# If rows is True, func must be min or max and the query returns the
+# (value, timestamp) row that min/max would pick from Metric.values, or no
+# row if the history is empty
+# Returns (query, args)
+def history_aggregate_query(metric_id, func, column="metric_value", rows=False):
+    if func not in AGGREGATE_FUNCTIONS:
+        raise ValueError("Invalid aggregate function: " + func)
+    if column not in VALUE_COLUMNS:
+        raise ValueError("Invalid column: " + column)
+    table_name = get_value_table(metric_id)
+    if rows:
+        if func not in ("min", "max"):
+            raise ValueError("Only min and max can select a row")
+        order = "" if func == "min" else " DESC"
+        return ("SELECT metric_value, metric_timestamp FROM {0} WHERE metric_id = ? ".format(table_name) +
+                "ORDER BY metric_value{0}, metric_timestamp{0} LIMIT 1".format(order), (metric_id,))
+    return ("SELECT COUNT(*), {}({}) FROM {} WHERE metric_id = ?".format(
+        AGGREGATE_FUNCTIONS[func], column, table_name), (metric_id,))
+
+
+# Build the query aggregating the latest values of all metrics named
+# metric_name, returning one (number of values, result) row
+# func -> one of AGGREGATE_FUNCTIONS
+# column -> one of VALUE_COLUMNS
+# Returns (query, args)
+def latest_aggregate_query(metric_name, func, column="metric_value"):
+    if func not in AGGREGATE_FUNCTIONS:
+        raise ValueError("Invalid aggregate function: " + func)
+    if column not in VALUE_COLUMNS:
+        raise ValueError("Invalid column: " + column)
+    return ("SELECT COUNT(*), {}(MetricLatest.{}) FROM Metric ".format(AGGREGATE_FUNCTIONS[func], column) +
+            "JOIN MetricLatest ON MetricLatest.metric_id = Metric.metric_id WHERE metric_name = ?", (metric_name,))
+
+
+# Describe the metrics named metric_name across the fleet as
+# (devices, devices with such a metric, metrics, metrics with a latest
+# value, distinct metric types, a metric type)
+def metric_name_summary(metric_name):
+    return execute_query(
+        "SELECT (SELECT COUNT(*) FROM Device), COUNT(DISTINCT Metric.device_id), COUNT(*), COUNT(MetricLatest.metric_id), " +
+        "COUNT(DISTINCT metric_type), MIN(metric_type) FROM Metric " +
+        "LEFT JOIN MetricLatest ON MetricLatest.metric_id = Metric.metric_id WHERE metric_name = ?", (metric_name,))[0]
 
 
 # Implementation of the get function for all types defined in the model
@@ -205,26 +903,13 @@ def get(type, id, attr):
             return execute_query("SELECT metric_name FROM Metric WHERE metric_id = ?", (id,))[0][0]
         elif attr == "type":
             return execute_query("SELECT metric_type FROM Metric WHERE metric_id = ?", (id,))[0][0]
-        elif attr == "value" or attr == "values":
-            metric_type = execute_query(
-                "SELECT metric_type FROM Metric WHERE metric_id = ?", (id,))[0][0]
-            table_name = "Metric" + metric_type.capitalize()
-            query = "SELECT metric_value"
-            if attr == "values":
-                query += ", metric_timestamp"
-            query += " FROM {} WHERE metric_id = ?".format(
-                table_name)
-            if attr == "value":
-                query += " ORDER BY metric_timestamp DESC LIMIT 1"
-                return execute_query(query, (id,))[0][0]
-            else:
-                return execute_query(query, (id,))
-        elif attr == "timestamp":
-            metric_type = execute_query(
-                "SELECT metric_type FROM Metric WHERE metric_id = ?", (id,))[0][0]
-            table_name = "Metric" + metric_type.capitalize()
+        elif attr == "value":
+            return execute_query("SELECT metric_value FROM MetricLatest WHERE metric_id = ?", (id,))[0][0]
+        elif attr == "values":
             return execute_query(
-                "SELECT metric_timestamp FROM {} WHERE metric_id = ? ORDER BY metric_timestamp DESC LIMIT 1".format(table_name), (id,))[0][0]
+                "SELECT metric_value, metric_timestamp FROM {} WHERE metric_id = ?".format(get_value_table(id)), (id,))
+        elif attr == "timestamp":
+            return execute_query("SELECT metric_timestamp FROM MetricLatest WHERE metric_id = ?", (id,))[0][0]
         else:
             raise ValueError("Invalid attribute for type metric: " + attr)
     else:
@@ -238,12 +923,14 @@ def set(type, id, attr, value):
         if attr == "name":
             execute_query(
                 "UPDATE Groups SET group_name = ? WHERE group_id = ?", (value, id))
+            GROUP_INDEX.rename(id, value)
         else:
             raise ValueError("Invalid attribute for group: " + attr)
     elif type == "node":
         if attr == "name":
             execute_query(
                 "UPDATE EdgeNode SET edge_node_name = ? WHERE edge_node_id = ?", (value, id))
+            NODE_INDEX.rename(id, value)
         elif attr == "status":
             execute_query(
                 "UPDATE EdgeNode SET edge_node_status = ? WHERE edge_node_id = ?", (value, id))
@@ -259,6 +946,7 @@ def set(type, id, attr, value):
         if attr == "name":
             execute_query(
                 "UPDATE Device SET device_name = ? WHERE device_id = ?", (value, id))
+            DEVICE_INDEX.rename(id, value)
         elif attr == "status":
             execute_query(
                 "UPDATE Device SET device_status = ? WHERE device_id = ?", (value, id))
@@ -272,14 +960,20 @@ def set(type, id, attr, value):
             raise ValueError("Invalid attribute for device: " + attr)
     elif type == "metric":
         if attr == "value":
-            metric_type = execute_query(
-                "SELECT metric_type FROM Metric WHERE metric_id = ?", (id,))[0][0]
-            table_name = "Metric" + metric_type.capitalize()
-            execute_query(
-                "INSERT INTO {} (metric_id, metric_value, metric_timestamp) VALUES (?, ?, ?)".format(
-                    table_name),
-                (id, value[0], value[1]))
+            table_name = get_value_table(id)
+            # one commit for both, so that the latest value never
+            # disagrees with the history
+            execute_writes([
+                ("INSERT INTO {} (metric_id, metric_value, metric_timestamp) VALUES (?, ?, ?)".format(table_name),
+                 (id, value[0], value[1])),
+                # out of order writes must not replace a newer latest value
+                ("INSERT INTO MetricLatest (metric_id, metric_value, metric_timestamp) VALUES (?, ?, ?) " +
+                 "ON CONFLICT (metric_id) DO UPDATE SET metric_value = excluded.metric_value, metric_timestamp = excluded.metric_timestamp " +
+                 "WHERE excluded.metric_timestamp >= MetricLatest.metric_timestamp",
+                 (id, value[0], value[1])),
+            ])
         else:
             raise ValueError("Invalid write attribute for metric: " + attr)
     else:
         raise ValueError("Invalid type")
+    notify_write(type, id, attr, value)
@@ -0,0 +1,106 @@
+import pytest
+import re
+from fastapi.testclient import TestClient
+import api
+import async_storage
+import storage
+
+# The list endpoints, with the ids of the first fleet's group, node and
+# device filled in
+LIST_ENDPOINTS = [
+    "/groups",
+    "/nodes",
+    "/devices",
+    "/groups/{group_id}/nodes",
+    "/groups/{group_id}/devices",
+    "/nodes/{node_id}/devices",
+    "/devices/{device_id}/metrics",
+]
+
+
+# Add groups x nodes per group x devices per node devices named after
+# prefix, each with one metric, skipping the ones that were already added
+# Returns the ids of the first group, node and device
+def add_fleet(prefix, groups, nodes, devices, added=set()):
+    ids = {}
+    for g in range(groups):
+        for n in range(nodes):
+            for d in range(devices):
+                names = (prefix + "group" + str(g), "node" + str(n), "device" + str(d))
+                if names[:1] not in added:
+                    ids.setdefault("group_id", storage.insert_group(*names[:1]))
+                if names[:2] not in added:
+                    ids.setdefault("node_id", storage.insert_node(*names[:2], "ONLINE", 0, 0))
+                if names not in added:
+                    ids.setdefault("device_id", storage.insert_device(*names, "ONLINE", 0, 0))
+                    storage.insert_metric(*names, "temperature", "float")
+                added.update((names[:1], names[:2], names))
+    return ids
+
+
+# The number of queries a request runs
+def count_queries(client, monkeypatch, url):
+    calls = []
+    execute_query = storage.execute_query
+
+    def counting(*args):
+        calls.append(args)
+        return execute_query(*args)
+    monkeypatch.setattr(storage, "execute_query", counting)
+    try:
+        response = client.get(url)
+    finally:
+        monkeypatch.setattr(storage, "execute_query", execute_query)
+    assert response.status_code == 200
+    return len(calls)
+
+
+@pytest.fixture(scope="module")
+def client():
+    # the app is not started, so that it does not connect to a running host
+    async_storage.startup()
+    yield TestClient(api.app)
+    async_storage.shutdown()
+
+
+# The list endpoints run as many queries for a large fleet as for a small one
+def test_list_queries_constant(client, monkeypatch):
+    devices = len(client.get("/devices").json())
+    ids = add_fleet("fleet", 2, 1, 5)
+    urls = [url.format(**ids) for url in LIST_ENDPOINTS]
+    small = {url: count_queries(client, monkeypatch, url) for url in urls}
+    assert all(small.values())
+    add_fleet("fleet", 4, 5, 50)
+    assert len(client.get("/devices").json()) == devices + 1000
+    assert len(client.get("/groups/{group_id}/devices".format(**ids)).json()) == 250
+    large = {url: count_queries(client, monkeypatch, url) for url in urls}
+    assert large == small
+
+
+# Items past the cut of a truncated answer are not reported as missing
+def test_query_latest_truncated(client, monkeypatch):
+    storage.insert_group("latest")
+    storage.insert_node("latest", "node", "ONLINE", 0, 0)
+    storage.insert_device("latest", "node", "device", "ONLINE", 0, 0)
+    metric_ids = [storage.insert_metric("latest", "node", "device", "metric" + str(i), "int")
+                  for i in range(6)]
+    monkeypatch.setattr(api, "MAX_QUERY_RESULTS", 3)
+    body = client.post("/query/latest", json={"metrics": metric_ids[::-1] + ["latest/*/*/*"]}).json()
+    assert body["truncated"]
+    assert [result["id"] for result in body["results"]] == metric_ids[:3]
+    assert body["errors"] == []
+    body = client.post("/query/latest", json={"metrics": metric_ids[:2] + [-1, "latest/*/*/none"]}).json()
+    assert not body["truncated"]
+    assert [result["id"] for result in body["results"]] == metric_ids[:2]
+    assert body["errors"] == [{"item": -1, "error": "No such metric"},
+                              {"item": "latest/*/*/none", "error": "No matching metric"}]
+
+
+# The Server-Timing header counts every statement the request ran
+def test_server_timing_queries(client, monkeypatch):
+    ids = add_fleet("timing", 1, 1, 2)
+    for url in LIST_ENDPOINTS:
+        url = url.format(**ids)
+        queries = count_queries(client, monkeypatch, url)
+        timing = client.get(url).headers["Server-Timing"]
+        assert re.search(r'desc="(\d+) queries"', timing).group(1) == str(queries)
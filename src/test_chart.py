@@ -0,0 +1,31 @@
+import chart
+
+
+def cell(*dots):
+    return chr(chart.BRAILLE_BLANK + sum(chart.DOTS[row][column] for row, column in dots))
+
+
+# Consecutive columns are joined, a gap breaks the line
+def test_braille():
+    lines = chart.braille([(0, 0), (1, 1), None, (0, 1)], 1, 0, 1)
+    assert lines == [cell((3, 0), (0, 1), (1, 1), (2, 1)) +
+                     cell((0, 1), (1, 1), (2, 1), (3, 1))]
+
+
+def test_braille_rows():
+    lines = chart.braille([(0, 0), (7, 7)], 2, 0, 7)
+    assert lines == [cell((0, 1), (1, 1), (2, 1), (3, 1)),
+                     cell((3, 0), (0, 1), (1, 1), (2, 1))]
+
+
+def test_render():
+    lines = chart.render([(1, 1), (2, 2), (3, 3), (4, 4)], 2, 0, 3600)
+    assert [line[:chart.LABEL_WIDTH] for line in lines[:2]] == ["         4", "         1"]
+    assert lines[2] == " " * (chart.LABEL_WIDTH + 1) + chart.format_time(0) + \
+        " " + chart.format_time(3600)
+
+
+# A flat or empty series is drawn around the middle
+def test_render_flat():
+    assert chart.render([(5, 5)], 1, 0, 60)[0] == "         6 " + cell((1, 0))
+    assert chart.render([None, None], 1, 0, 60)[0] == "         1 " + cell()
@@ -0,0 +1,79 @@
+import pytest
+import definitions
+import events
+import model
+import storage
+
+
+@pytest.fixture(scope="module")
+def metrics():
+    storage.insert_group("definitions")
+    storage.insert_node("definitions", "node", "ONLINE", 0, 0)
+    storage.insert_device("definitions", "node", "device", "ONLINE", 0, 0)
+    return [model.Metric(storage.insert_metric("definitions", "node", "device", name, "int"))
+            for name in ("a", "b")]
+
+
+# Definitions of a namespace holding the metrics as a and b, evaluated as
+# if connected to the host, so that their results are memoized
+@pytest.fixture
+def variables(metrics):
+    namespace = dict(model.RUNTIME_DICT, a=metrics[0], b=metrics[1])
+    variables = definitions.Definitions(namespace)
+    events.CONNECTED.set()
+    yield variables
+    events.CONNECTED.clear()
+    variables.close()
+
+
+# The (reused, evaluated) counts of a definition
+def counts(variables, name):
+    return {row[0]: row[3:5] for row in variables.stats()}[name]
+
+
+def test_memoized_until_read_metric_written(variables, metrics):
+    storage.set("metric", metrics[0].id, "value", (1, 100))
+    variables.define("latest", "a.value")
+    assert variables.evaluate("@latest") == 1
+    assert variables.evaluate("@latest") == 1
+    assert counts(variables, "latest") == (1, 1)
+    # a metric it did not read
+    storage.set("metric", metrics[1].id, "value", (5, 100))
+    assert variables.evaluate("@latest") == 1
+    assert counts(variables, "latest") == (2, 1)
+    storage.set("metric", metrics[0].id, "value", (2, 101))
+    assert variables.evaluate("@latest") == 2
+    assert counts(variables, "latest") == (2, 2)
+
+
+def test_dependents_invalidated(variables, metrics):
+    variables.define("x", "a.id")
+    variables.define("y", "@x + 1")
+    assert variables.evaluate("@y") == metrics[0].id + 1
+    variables.define("x", "b.id")
+    assert variables.evaluate("@y") == metrics[1].id + 1
+    variables.assign("x", "0")
+    assert variables.evaluate("@y") == 1
+    assert counts(variables, "y") == (0, 3)
+
+
+def test_not_memoized_when_disconnected(variables):
+    variables.define("z", "a.id")
+    events.CONNECTED.clear()
+    variables.evaluate("@z")
+    variables.evaluate("@z")
+    assert counts(variables, "z") == (0, 2)
+
+
+def test_iterators_evaluated_again(variables, metrics):
+    storage.set("metric", metrics[1].id, "value", (6, 101))
+    variables.define("history", "b.iter_values()")
+    assert list(variables.evaluate("@history")) == [(5, 100), (6, 101)]
+    assert list(variables.evaluate("@history")) == [(5, 100), (6, 101)]
+
+
+def test_close_stops_following_writes(metrics):
+    variables = definitions.Definitions(dict(model.RUNTIME_DICT))
+    assert variables.on_write in storage.WRITE_LISTENERS
+    variables.close()
+    assert variables.on_write not in storage.WRITE_LISTENERS
@@ -0,0 +1,30 @@
+import events
+import storage
+
+
+# Add a device with the given metrics, returns their ids
+def add_device(group, metrics):
+    storage.insert_group(group)
+    storage.insert_node(group, "node", "ONLINE", 0, 0)
+    storage.insert_device(group, "node", "device", "ONLINE", 0, 0)
+    return [storage.insert_metric(group, "node", "device", metric, "int") for metric in metrics]
+
+
+# Path subscriptions get the writes of the metrics and devices they match,
+# including after subscriptions were added and removed
+def test_path_subscriptions():
+    temperature, humidity = add_device("events", ["temperature", "humidity"])
+    received = {"metric": [], "device": []}
+    metric = events.subscribe("events/*/temperature", lambda *event: received["metric"].append(event),
+                              inline=True)
+    storage.set("metric", temperature, "value", (1, 1))
+    storage.set("metric", humidity, "value", (2, 1))
+    device = events.subscribe("events/node/dev*", lambda *event: received["device"].append(event),
+                              inline=True)
+    storage.set("metric", temperature, "value", (3, 2))
+    metric.close()
+    storage.set("metric", temperature, "value", (4, 3))
+    device.close()
+    storage.set("metric", humidity, "value", (5, 3))
+    assert received["metric"] == [(temperature, 1, 1), (temperature, 3, 2)]
+    assert received["device"] == [(temperature, 3, 2), (temperature, 4, 3)]
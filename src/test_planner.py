@@ -0,0 +1,89 @@
+import statistics
+import pytest
+import model
+import planner
+import storage
+
+AGGREGATES = ["min", "max", "sum", "len", "statistics.mean"]
+
+
+# Add a device with metrics of the given types and values, returns the
+# namespace the expressions are evaluated with
+@pytest.fixture(scope="module")
+def namespace():
+    storage.insert_group("planner")
+    storage.insert_node("planner", "node", "ONLINE", 0, 0)
+    storage.insert_device("planner", "node", "device", "ONLINE", 0, 0)
+    namespace = dict(model.RUNTIME_DICT)
+    for name, type, values in [("ints", "int", [3, 1, 3, 2]),
+                               ("floats", "float", [0.5, 2.5, -1.0]),
+                               ("empty", "float", []),
+                               ("strings", "string", ["b", "a"])]:
+        metric_id = storage.insert_metric("planner", "node", "device", name, type)
+        for timestamp, value in enumerate(values):
+            storage.set("metric", metric_id, "value", (value, 100 + timestamp))
+        namespace[name] = model.Metric(metric_id)
+    namespace["metrics"] = [namespace["ints"], namespace["floats"]]
+    return namespace
+
+
+# The result of an expression, or the type and message of its error
+def outcome(function):
+    try:
+        return function()
+    except Exception as e:
+        return type(e), str(e)
+
+
+# Check that the plan of an expression pushes down the given number of
+# aggregates and gives the same result as evaluating it as is
+def check(expr, namespace, pushdowns):
+    plan = planner.plan(expr, dict(namespace))
+    assert len(plan.pushdowns) == pushdowns, plan.explain()
+    assert outcome(plan.run) == outcome(lambda: eval(expr, dict(namespace)))
+
+
+@pytest.mark.parametrize("metric", ["ints", "floats", "empty"])
+@pytest.mark.parametrize("aggregate", ["min", "max", "len"])
+def test_history_rows(namespace, metric, aggregate):
+    check(aggregate + "(" + metric + ".values)", namespace, 1)
+
+
+@pytest.mark.parametrize("metric", ["ints", "floats", "empty"])
+@pytest.mark.parametrize("aggregate", AGGREGATES)
+@pytest.mark.parametrize("shape", ["{}(v for v, t in {}.values)", "{}([t for v, t in {}.values])",
+                                   "{}([x[0] for x in {}.values])", "{}(x[1] for x in {}.values)"])
+def test_history_columns(namespace, metric, aggregate, shape):
+    # len of a generator raises, it is not pushed down
+    pushdowns = 0 if aggregate == "len" and not shape.startswith("{}([") else 1
+    check(shape.format(aggregate, metric), namespace, pushdowns)
+
+
+def test_string_values(namespace):
+    check("max(v for v, t in strings.values)", namespace, 1)
+    check("sum(v for v, t in strings.values)", namespace, 0)
+    check("statistics.mean([v for v, t in strings.values])", namespace, 0)
+
+
+def test_not_a_metric(namespace):
+    plan = planner.plan("max(metrics)", namespace)
+    assert not plan.pushdowns and plan.fallbacks
+
+
+@pytest.mark.parametrize("expr", [
+    "[max(m.values) for m in metrics]",
+    "[(len(m.values), sum(v for v, t in m.values)) for m in metrics]",
+    "list(map(lambda m: min(m.values), metrics))",
+    "[(m := x) and max(m.values) for x in metrics]",
+    "(lambda max: max(ints.values))(len)",
+    "[statistics.mean(v for v, t in ints.values) for statistics in [statistics]]",
+])
+def test_bound_names(namespace, expr):
+    check(expr, namespace, 0)
+
+
+def test_shadowed_names(namespace):
+    shadowed = dict(namespace, max=min, statistics=None)
+    check("max(ints.values)", shadowed, 0)
+    check("len(ints.values)", shadowed, 1)
+    assert planner.plan("statistics.mean(v for v, t in ints.values)", shadowed).pushdowns == []
@@ -0,0 +1,78 @@
+import io
+import pytest
+import repl
+import storage
+
+
+@pytest.fixture(scope="module")
+def device():
+    storage.insert_group("repl")
+    storage.insert_node("repl", "node", "ONLINE", 0, 0)
+    device_id = storage.insert_device("repl", "node", "repldevice", "ONLINE", 0, 0)
+    metric_id = storage.insert_metric("repl", "node", "repldevice", "count", "int")
+    storage.set("metric", metric_id, "value", (7, 100))
+    return device_id
+
+
+# Run commands in batch mode, returns the output and whether one failed
+def run(commands, format):
+    out = io.StringIO()
+    batch = repl.BatchREPL(format, out)
+    try:
+        for command in commands:
+            batch.onecmd(command)
+    finally:
+        batch.definitions.close()
+    return out.getvalue(), batch.failed
+
+
+def test_csv(device):
+    output, failed = run(['expr [1, "a,b", (2, None), {"x": 3}]',
+                          "get device repldevice"], "csv")
+    assert not failed
+    assert output == ('1\n"a,b"\n2,\n3\n'
+                      "id,name,group,node,status,metric,type,value,timestamp\n" +
+                      str(device) + ",repldevice,repl,node,ONLINE,count,int,7,100\n")
+
+
+def test_ndjson(device):
+    output, failed = run(['expr (x for x in [1, "a", (2, None), {"x": 3}])',
+                          "get device repldevice"], "ndjson")
+    assert not failed
+    assert output == ('[1]\n["a"]\n[2, null]\n{"x": 3}\n'
+                      '{"id": ' + str(device) + ', "name": "repldevice", "group": "repl", "node": "node", '
+                      '"status": "ONLINE", "metric": "count", "type": "int", "value": 7, "timestamp": 100}\n')
+
+
+def test_definitions(device):
+    output, failed = run(["define answer 6 * 7", "expr @answer", "define"], "csv")
+    assert not failed
+    assert output == "42\nname,expression,ttl,reused,evaluated,cached\nanswer,6 * 7,,0,1,False\n"
+
+
+def test_errors_go_to_stderr(device, capsys):
+    output, failed = run(["nosuchcommand", "expr 1 / 0", "watch"], "csv")
+    assert failed
+    assert output == ""
+    assert capsys.readouterr().err == ("Error: Unknown command: nosuchcommand (in 'help')\n"
+                                       "Error: ZeroDivisionError: division by zero (in 'expr')\n"
+                                       "Error: watch is not available in batch mode (in 'watch')\n")
+
+
+def test_measure_args(capsys):
+    batch = repl.BatchREPL("csv", io.StringIO())
+    batch.definitions.close()
+    assert batch.parse_measure_args("-n 3 max(a.values)", "timeit") == ("max(a.values)", 3)
+    assert batch.parse_measure_args("len( x )", "timeit") == ("len( x )", 1)
+    assert batch.parse_measure_args("-n 0 x", "timeit") is None
+    assert batch.parse_measure_args("-n 2", "profile") is None
+    assert capsys.readouterr().err == ("Error: Invalid number of runs (in 'timeit')\n"
+                                       "Error: No expression provided (in 'profile')\n")
+
+
+def test_timeit(device):
+    output, failed = run(["timeit -n 2 [d.name for d in get_devices()]"], "csv")
+    lines = output.splitlines()
+    assert not failed
+    assert lines[0] == "Runs,Best (ms),Mean (ms),SQL statements,Database (ms),Python (ms)"
+    assert lines[1].startswith("2,") and int(lines[1].split(",")[3]) > 0
@@ -0,0 +1,96 @@
+import random
+import time
+import pytest
+import events
+import storage
+import views
+
+GROUP = "views"
+
+
+# The fleet of the views tests: 2 nodes of 3 devices, each device with a
+# "load" metric
+@pytest.fixture(scope="module")
+def fleet():
+    storage.insert_group(GROUP)
+    nodes, metrics = [], []
+    for n in range(2):
+        node = "node" + str(n)
+        nodes.append(storage.insert_node(GROUP, node, "ONLINE", 0, 0))
+        for d in range(3):
+            device = "device" + str(d)
+            storage.insert_device(GROUP, node, device, "ONLINE", 0, 0)
+            metrics.append(storage.insert_metric(GROUP, node, device, "load", "int"))
+    return nodes, metrics
+
+
+# A state of the views kept up to date by the writes, as while connected
+# to the host
+@pytest.fixture
+def state(fleet):
+    state = views.FleetState()
+    events.CONNECTED.set()
+    yield state
+    events.CONNECTED.clear()
+    storage.remove_write_listener(state.on_write)
+
+
+# The state read again from the database
+def reloaded():
+    state = views.FleetState()
+    storage.remove_write_listener(state.on_write)
+    return state
+
+
+def group_rows(rows, column):
+    return [row for row in rows if row[column].startswith(GROUP + "/")]
+
+
+def counts(state):
+    return [row[2:] for row in state.device_counts() if row[1] == GROUP]
+
+
+def test_node_status(state, fleet):
+    nodes, _ = fleet
+    devices = [row[0] for row in storage.fleet_devices() if row[2] in nodes]
+    assert counts(state) == [(6, 6)]
+    storage.set("device", devices[0], "status", "OFFLINE")
+    storage.set("node", nodes[1], "status", "OFFLINE")
+    offline = group_rows(state.offline_devices(), 1)
+    assert [row[0] for row in offline] == [devices[0]] + devices[3:]
+    assert {row[2] for row in offline} == {"OFFLINE"}
+    assert counts(state) == [(6, 2)]
+    assert counts(reloaded()) == [(6, 2)]
+    storage.set("node", nodes[1], "status", "ONLINE")
+    storage.set("device", devices[0], "status", "ONLINE")
+    assert group_rows(state.offline_devices(), 1) == []
+    assert counts(state) == counts(reloaded()) == [(6, 6)]
+
+
+# The top and stale views stay the same as the ones read again from the
+# database through random value writes
+def test_values(state, fleet):
+    _, metrics = fleet
+    rng = random.Random(0)
+    now = int(time.time())
+    for metric_id in metrics:
+        storage.set("metric", metric_id, "value", (0, now - 1000))
+    assert state.top_values("load", 3)
+    for i in range(200):
+        metric_id = rng.choice(metrics)
+        # some values arrive out of order
+        timestamp = now - 1000 + i + rng.choice([0, 0, -100])
+        storage.set("metric", metric_id, "value", (rng.randint(0, 20), timestamp))
+        if i % 20 == 0:
+            assert state.top_values("load", 3) == reloaded().top_values("load", 3)
+            # (metric_id, path, timestamp), without the age
+            assert [row[:3] for row in group_rows(state.stale_metrics(500), 1)] == \
+                [row[:3] for row in group_rows(reloaded().stale_metrics(500), 1)]
+    for metric_id in metrics[:2]:
+        storage.set("metric", metric_id, "value", (100, now))
+    top = state.top_values("load", 2)
+    assert {row[0] for row in top} == set(metrics[:2])
+    stale = group_rows(state.stale_metrics(500), 1)
+    assert [row[0] for row in stale] == [row[0] for row in group_rows(reloaded().stale_metrics(500), 1)]
+    assert not set(metrics[:2]) & {row[0] for row in stale}
+    assert [row[2] for row in stale] == sorted(row[2] for row in stale)
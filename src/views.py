@@ -0,0 +1,302 @@
+import bisect
+import heapq
+import threading
+import time
+import events
+import storage
+
+# Predefined views of the fleet
+#
+# The views are read from a copy of the state of the fleet that is loaded
+# with two queries on first use and then kept up to date by the storage
+# writes, so that reading a view takes time proportional to its result
+# rather than to the fleet:
+#
+#   offline -> the devices that are not online, the devices of an
+#              offline node being offline whatever their own status
+#   stale   -> the metrics whose latest value is older than some seconds,
+#              oldest first
+#   top     -> the metrics of a name with the highest latest values
+#   counts  -> the number of devices and online devices of every group
+#
+# Writes are only seen while connected to the host, so otherwise the state
+# is loaded again on every read.
+
+# Default age above which a metric is stale, in seconds
+STALE_SECONDS = 300
+
+# Default number of metrics of the top view
+TOP_COUNT = 10
+
+# Default metric of the top view
+TOP_METRIC = "temperature"
+
+# Metric types whose values can be ranked by the top view
+NUMERIC_TYPES = ("int", "float", "boolean")
+
+
+# The state of the fleet the views are read from
+class FleetState:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.epoch = None  # storage.GENERATION_EPOCH when loaded
+        self.groups = {}  # group_id -> [name, devices, online devices]
+        self.devices = {}  # device_id -> [group_id, path, status, node_id]
+        # node_id -> [status, {device_id: None}] of the nodes with devices
+        self.nodes = {}
+        self.offline = {}  # device_id -> None, in the order they went offline
+        # metric_id -> [device_id, name, type, value, timestamp]
+        self.metrics = {}
+        # (timestamp, metric_id) of the latest values, with outdated
+        # entries removed lazily, see stale_metrics
+        self.timestamps = []
+        # metric name -> sorted [(value, metric_id)] of the metrics of the
+        # names the top view was read for
+        self.rankings = {}
+        # inserted devices and metrics, loaded on the next read
+        self.pending_devices = {}
+        self.pending_metrics = {}
+        storage.add_write_listener(self.on_write)
+
+    # Whether the writes since the state was loaded were all seen
+    def is_fresh(self):
+        return self.epoch is not None and events.CONNECTED.is_set() and self.epoch == storage.GENERATION_EPOCH
+
+    # Load the state, or the inserted devices and metrics if it is fresh
+    # Must be called with the lock held
+    def refresh(self):
+        if not self.is_fresh():
+            self.epoch = storage.GENERATION_EPOCH
+            self.groups = {group_id: [name, 0, 0]
+                           for group_id, name in storage.list_groups()}
+            self.devices, self.nodes, self.offline, self.metrics = {}, {}, {}, {}
+            self.timestamps, self.rankings = [], {}
+            self.pending_devices, self.pending_metrics = {}, {}
+            self.load_devices(storage.fleet_devices())
+            self.load_metrics(storage.fleet_metrics())
+            return
+        if self.pending_devices:
+            device_ids, self.pending_devices = list(self.pending_devices), {}
+            self.load_devices(storage.fleet_devices(device_ids))
+        if self.pending_metrics:
+            metric_ids, self.pending_metrics = list(self.pending_metrics), {}
+            self.load_metrics(storage.fleet_metrics(metric_ids))
+
+    def load_devices(self, rows):
+        for device_id, group_id, node_id, path, status, node_status in rows:
+            if device_id in self.devices:
+                continue
+            if group_id not in self.groups:
+                self.groups[group_id] = [path.split("/", 1)[0], 0, 0]
+            # the status of a node already loaded may have been written since
+            self.nodes.setdefault(node_id, [node_status, {}])[1][device_id] = None
+            self.devices[device_id] = [group_id, path, status, node_id]
+            self.groups[group_id][1] += 1
+            self.update_status(device_id, None)
+
+    def load_metrics(self, rows):
+        for metric_id, device_id, name, type, value, timestamp in rows:
+            if metric_id not in self.metrics:
+                self.metrics[metric_id] = [device_id, name, type, None, None]
+                self.set_value(metric_id, value, timestamp)
+
+    # The status of a device as seen by the views
+    def status(self, device_id):
+        device = self.devices[device_id]
+        if self.nodes[device[3]][0] == "OFFLINE":
+            return "OFFLINE"
+        return device[2]
+
+    # Count a device with its current status, previous being the status it
+    # was counted with, None if it was not counted yet
+    def update_status(self, device_id, previous):
+        status = self.status(device_id)
+        if status == previous:
+            return
+        group = self.groups[self.devices[device_id][0]]
+        if previous == "ONLINE":
+            group[2] -= 1
+        elif status == "ONLINE":
+            group[2] += 1
+        if status == "ONLINE":
+            self.offline.pop(device_id, None)
+        else:
+            self.offline[device_id] = None
+
+    def set_status(self, device_id, status):
+        previous = self.status(device_id)
+        self.devices[device_id][2] = status
+        self.update_status(device_id, previous)
+
+    def set_node_status(self, node_id, status):
+        node = self.nodes.get(node_id)
+        if node is None:
+            # no device of the node is loaded yet
+            return
+        previous = {device_id: self.status(device_id) for device_id in node[1]}
+        node[0] = status
+        for device_id, device_status in previous.items():
+            self.update_status(device_id, device_status)
+
+    def set_value(self, metric_id, value, timestamp):
+        metric = self.metrics[metric_id]
+        # out of order values do not replace a newer latest value
+        if timestamp is None or metric[4] is not None and timestamp < metric[4]:
+            return
+        ranking = self.rankings.get(metric[1])
+        if ranking is not None and metric[2] in NUMERIC_TYPES:
+            if metric[3] is not None:
+                del ranking[bisect.bisect_left(ranking, (metric[3], metric_id))]
+            bisect.insort(ranking, (value, metric_id))
+        metric[3], metric[4] = value, timestamp
+        heapq.heappush(self.timestamps, (timestamp, metric_id))
+        # drop the outdated entries once they are the majority
+        if len(self.timestamps) > 2 * len(self.metrics) + 1000:
+            self.timestamps = [(metric[4], metric_id) for metric_id, metric in self.metrics.items()
+                               if metric[4] is not None]
+            heapq.heapify(self.timestamps)
+
+    # Storage write listener applying the writes to the state
+    # The loaded rows may already include a write that is notified after
+    # they were read, so applying a write must be idempotent
+    def on_write(self, type, id, attr, value):
+        with self.lock:
+            if self.epoch is None:
+                return
+            if attr == "name":
+                # the paths are stale, load everything again
+                self.epoch = None
+            elif attr == "insert":
+                if type == "group":
+                    self.groups.setdefault(id, [value, 0, 0])
+                elif type == "device":
+                    self.pending_devices[id] = None
+                elif type == "metric":
+                    self.pending_metrics[id] = None
+            elif type == "device" and attr == "status":
+                if id in self.devices:
+                    self.set_status(id, value)
+            elif type == "node" and attr == "status":
+                self.set_node_status(id, value)
+            elif type == "metric" and attr == "value":
+                if id in self.metrics:
+                    self.set_value(id, value[0], value[1])
+
+    def metric_path(self, metric_id):
+        metric = self.metrics[metric_id]
+        return self.devices[metric[0]][1] + "/" + metric[1]
+
+    # Get (device_id, path, status) rows of the devices that are not online
+    def offline_devices(self):
+        with self.lock:
+            self.refresh()
+            return [(device_id, self.devices[device_id][1], self.status(device_id))
+                    for device_id in self.offline]
+
+    # Get (metric_id, path, timestamp, age) rows of the metrics whose
+    # latest value is more than seconds old, oldest first
+    # Metrics without any value are not included
+    def stale_metrics(self, seconds=STALE_SECONDS):
+        now = time.time()
+        rows = []
+        with self.lock:
+            self.refresh()
+            heap = self.timestamps
+            current = {}
+            while heap and heap[0][0] < now - seconds:
+                timestamp, metric_id = heapq.heappop(heap)
+                # drop the entries of values replaced since
+                if self.metrics[metric_id][4] != timestamp or metric_id in current:
+                    continue
+                current[metric_id] = None
+                rows.append((metric_id, self.metric_path(metric_id),
+                             timestamp, now - timestamp))
+            for metric_id in current:
+                heapq.heappush(heap, (self.metrics[metric_id][4], metric_id))
+        return rows
+
+    # Get (metric_id, path, value, timestamp) rows of the count metrics
+    # named metric_name with the highest latest values, highest first
+    # The first read of a metric name ranks all metrics of that name, the
+    # ranking is kept up to date from then on
+    def top_values(self, metric_name=TOP_METRIC, count=TOP_COUNT):
+        with self.lock:
+            self.refresh()
+            ranking = self.rankings.get(metric_name)
+            if ranking is None:
+                ranking = sorted((metric[3], metric_id) for metric_id, metric in self.metrics.items()
+                                 if metric[1] == metric_name and metric[2] in NUMERIC_TYPES and metric[3] is not None)
+                self.rankings[metric_name] = ranking
+            return [(metric_id, self.metric_path(metric_id), value, self.metrics[metric_id][4])
+                    for value, metric_id in reversed(ranking[-count:] if count > 0 else [])]
+
+    # Get (group_id, group, devices, online devices) rows of every group
+    def device_counts(self):
+        with self.lock:
+            self.refresh()
+            return [(group_id, name, devices, online)
+                    for group_id, (name, devices, online) in sorted(self.groups.items())]
+
+
+FLEET = FleetState()
+
+
+def offline_devices():
+    return FLEET.offline_devices()
+
+
+def stale_metrics(seconds=STALE_SECONDS):
+    return FLEET.stale_metrics(seconds)
+
+
+def top_values(metric_name=TOP_METRIC, count=TOP_COUNT):
+    return FLEET.top_values(metric_name, count)
+
+
+def device_counts():
+    return FLEET.device_counts()
+
+
+# A named view
+# arguments -> (name, type, default) of the arguments of function, in order
+class View:
+
+    def __init__(self, function, description, columns, arguments=()):
+        self.function = function
+        self.description = description
+        self.columns = columns
+        self.arguments = arguments
+
+    # Read the view, converting the given argument strings
+    def read(self, *args):
+        if len(args) > len(self.arguments):
+            raise ValueError("Too many arguments")
+        values = []
+        for text, (name, type, _) in zip(args, self.arguments):
+            try:
+                values.append(type(text))
+            except ValueError:
+                raise ValueError("Invalid " + name + ": " + text)
+        return self.function(*values)
+
+
+VIEWS = {
+    "offline": View(offline_devices, "Devices that are not online",
+                    ["id", "device", "status"]),
+    "stale": View(stale_metrics, "Metrics without a value for some seconds, oldest first",
+                  ["id", "metric", "timestamp", "age"],
+                  [("seconds", float, STALE_SECONDS)]),
+    "top": View(top_values, "Metrics of a name with the highest values",
+                ["id", "metric", "value", "timestamp"],
+                [("metric", str, TOP_METRIC), ("count", int, TOP_COUNT)]),
+    "counts": View(device_counts, "Devices and online devices per group",
+                   ["id", "group", "devices", "online"]),
+}
+
+
+# Read a view by name, see View.read
+def read_view(name, *args):
+    if name not in VIEWS:
+        raise ValueError("Unknown view: " + name)
+    return VIEWS[name].read(*args)